@@ -0,0 +1,61 @@
+"""
+Small process-local cache with per-entry expiry.
+
+Used for values that are read on every outbound API call (credentials,
+invoice lookups) and are cheap to reload when they expire.
+"""
+import threading
+import time
+
+
+class ExpiringCache:
+    """
+    Thread-safe in-memory cache where every entry carries its own expiry.
+
+    Entries are only visible to the current process; call invalidate() when
+    the underlying value is known to have changed.
+    """
+
+    def __init__(self, default_ttl=None):
+        self.default_ttl = default_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing/expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return default
+
+            return value
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        """
+        Store a value.
+
+        Args:
+            key: Cache key
+            value: Value to store
+            ttl: Lifetime in seconds (falls back to default_ttl)
+            expires_at: Absolute expiry as epoch seconds (overrides ttl)
+        """
+        if expires_at is None:
+            ttl = ttl if ttl is not None else self.default_ttl
+            expires_at = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+
+    def invalidate(self, key=None):
+        """Drop one key, or every entry when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
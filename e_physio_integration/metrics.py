@@ -0,0 +1,304 @@
+"""
+Counters, gauges and histograms shared by all processes.
+
+Recording a metric only updates an in-process buffer; a background thread
+per process adds the buffered values to Redis every METRICS_FLUSH_INTERVAL
+seconds, so instrumented code never waits on Redis. render() reads the
+totals of all processes back in the Prometheus text format (served by the
+/metrics endpoint).
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import redis
+from django.conf import settings
+
+from e_physio_integration.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "ephysio_integration_"
+REDIS_KEY_PREFIX = "metrics:"
+
+# Histogram upper bounds in seconds (API calls up to whole sync stages)
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+# name -> (type, help)
+METRICS = {
+    "http_request_duration_seconds": (
+        "histogram", "Outbound e-Physio/GHL request latency by api, method, endpoint and status"
+    ),
+    "http_retries_total": ("counter", "Outbound requests retried, by api and reason"),
+    "reauth_total": ("counter", "Re-authentications after a 401, by api"),
+    "rate_limit_wait_seconds": ("histogram", "Time outbound requests waited for a rate limit token, by api"),
+    "sync_rows_total": ("counter", "Rows ingested from e-Physio, by entity and outcome"),
+    "ghl_push_total": ("counter", "Rows pushed to GHL, by entity and outcome"),
+    "sync_stage_duration_seconds": ("histogram", "Time spent per sync run, by entity and stage"),
+    "ghl_push_backlog": ("gauge", "Rows still waiting for their GHL push, by entity"),
+    "ghl_push_concurrency": ("gauge", "Pushes allowed in flight after GHL throttling, by api"),
+    "task_runs_skipped_total": ("counter", "Periodic task runs skipped because a run was still going, by task"),
+    "task_lease_lost_total": ("counter", "Task runs that lost their lease before finishing, by task"),
+}
+
+_pending = {}
+_pending_lock = threading.Lock()
+_pending_pid = None
+_flusher_pid = None
+
+
+def _field(labels, *suffix):
+    """Encode labels (plus a histogram suffix) as a Redis hash field."""
+    return json.dumps([sorted((labels or {}).items()), *suffix])
+
+
+def _add(name, field, value, replace=False):
+    global _pending, _pending_pid
+
+    if name not in METRICS:
+        raise ValueError(f"Unknown metric: {name}")
+
+    pid = os.getpid()
+    with _pending_lock:
+        # A forked child starts with its own buffer (the parent flushes its own)
+        if _pending_pid != pid:
+            _pending = {}
+            _pending_pid = pid
+
+        key = (name, field)
+        if replace:
+            _pending[key] = ("set", value)
+        else:
+            _, previous = _pending.get(key, ("incr", 0))
+            _pending[key] = ("incr", previous + value)
+
+    _ensure_flusher(pid)
+
+
+def increment(name, labels=None, amount=1):
+    """Add amount to a counter."""
+    if amount:
+        _add(name, _field(labels), amount)
+
+
+def set_gauge(name, value, labels=None):
+    """Set a gauge to value."""
+    _add(name, _field(labels), value, replace=True)
+
+
+def observe(name, value, labels=None, buckets=DEFAULT_BUCKETS):
+    """Record one observation (e.g. a duration in seconds) in a histogram."""
+    bucket = next((bound for bound in buckets if value <= bound), "+Inf")
+    _add(name, _field(labels, "bucket", bucket), 1)
+    _add(name, _field(labels, "sum"), value)
+    _add(name, _field(labels, "count"), 1)
+
+
+@contextmanager
+def timer(name, labels=None):
+    """Observe how long the block took."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, labels)
+
+
+def endpoint_label(path):
+    """
+    Turn a request path into a low-cardinality endpoint label.
+
+    Path segments containing digits (record IDs) become "{id}", e.g.
+    /contacts/aBc123 -> /contacts/{id}.
+    """
+    segments = urlsplit(path).path.split("/")
+    return "/".join(
+        "{id}" if any(c.isdigit() for c in segment) else segment
+        for segment in segments
+    ) or "/"
+
+
+def timed_request(session, api, method, url, endpoint, **kwargs):
+    """
+    Send a request through session and record its latency and status.
+
+    Args:
+        session: requests.Session
+        api: "ephysio" or "ghl"
+        method: HTTP method
+        url: Full URL
+        endpoint: Path relative to the API base URL (see endpoint_label())
+        **kwargs: Passed through to session.request
+
+    Returns:
+        requests.Response
+    """
+    labels = {"api": api, "method": method, "endpoint": endpoint_label(endpoint)}
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except Exception:
+        observe("http_request_duration_seconds", time.perf_counter() - started,
+                dict(labels, status="error"))
+        raise
+
+    observe("http_request_duration_seconds", time.perf_counter() - started,
+            dict(labels, status=str(response.status_code)))
+    return response
+
+
+class StageTimer:
+    """
+    Adds up the time a sync run spends per stage and records the totals once.
+
+    Args:
+        entity: "contact" or "appointment"
+    """
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0) + seconds
+
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def timed_iter(self, stage, iterable):
+        """Yield from iterable, counting the time spent waiting for items as stage."""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - started)
+                return
+            self.add(stage, time.perf_counter() - started)
+            yield item
+
+    def record(self):
+        for stage, seconds in self.totals.items():
+            observe("sync_stage_duration_seconds", seconds, {"entity": self.entity, "stage": stage})
+
+
+def flush():
+    """Write this process's buffered metrics to Redis."""
+    global _pending
+
+    with _pending_lock:
+        if not _pending or _pending_pid != os.getpid():
+            return
+        pending, _pending = _pending, {}
+
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for (name, field), (op, value) in pending.items():
+            if op == "set":
+                pipe.hset(REDIS_KEY_PREFIX + name, field, value)
+            else:
+                pipe.hincrbyfloat(REDIS_KEY_PREFIX + name, field, value)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not write metrics to Redis, dropping {len(pending)} updates: {e}")
+
+
+def _flush_loop():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Metrics flush failed")
+
+
+def _ensure_flusher(pid):
+    global _flusher_pid
+
+    if _flusher_pid == pid:
+        return
+    with _pending_lock:
+        if _flusher_pid == pid:
+            return
+        _flusher_pid = pid
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+atexit.register(flush)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(items):
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render():
+    """
+    Return all metrics in the Prometheus text exposition format.
+
+    Raises:
+        redis.exceptions.RedisError: If Redis is unreachable
+    """
+    client = get_redis()
+    pipe = client.pipeline(transaction=False)
+    for name in METRICS:
+        pipe.hgetall(REDIS_KEY_PREFIX + name)
+    stored = pipe.execute()
+
+    lines = []
+    for (name, (metric_type, help_text)), values in zip(METRICS.items(), stored):
+        full_name = METRIC_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+
+        decoded = []
+        for field, value in values.items():
+            labels, *suffix = json.loads(field)
+            decoded.append((tuple(map(tuple, labels)), suffix, float(value)))
+
+        if metric_type != "histogram":
+            for labels, _, value in sorted(decoded):
+                lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+            continue
+
+        series = {}
+        for labels, suffix, value in decoded:
+            entry = series.setdefault(labels, {"buckets": {}, "sum": 0, "count": 0})
+            if suffix[0] == "bucket":
+                entry["buckets"][suffix[1]] = value
+            else:
+                entry[suffix[0]] = value
+
+        for labels in sorted(series):
+            entry = series[labels]
+            cumulative = 0
+            for bound in DEFAULT_BUCKETS:
+                cumulative += entry["buckets"].get(bound, 0)
+                bucket_labels = labels + (("le", _format_value(bound)),)
+                lines.append(f"{full_name}_bucket{_format_labels(bucket_labels)} {_format_value(cumulative)}")
+            lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {_format_value(entry['count'])}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(entry['sum'])}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {_format_value(entry['count'])}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,242 @@
+"""
+Token-bucket rate limits shared by all processes.
+
+Every outbound e-Physio and GHL request takes a token from the bucket of its
+API and account (the GHL location), kept in Redis, so Celery workers, webhook
+handlers and management commands running at the same time stay under the
+upstream limits together.
+
+Taking a token is one atomic Lua call that reserves the next free slot and
+returns how long to wait for it. Callers sleep after the call, never while
+holding a lock, so threads waiting for the same bucket do not serialize
+each other. If Redis is unreachable, a process-local bucket with the same
+rate is used instead.
+
+The configured rate is a starting point: clients that learn the real quota
+from response headers store it with set_quota() (all processes switch to
+it), and pause() holds every caller of a bucket back after a 429.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+
+import redis
+
+from e_physio_integration import metrics
+from e_physio_integration.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = "ratelimit:"
+QUOTA_KEY_PREFIX = "ratelimit-quota:"
+
+# Seconds a quota learned from response headers is used without being seen again
+QUOTA_TTL = 600
+
+# Refill the bucket for the time since the last call (Redis clock, so all
+# hosts agree), take ARGV[3] tokens and return the wait in microseconds until
+# they are covered. A negative balance is a queue of reserved slots. A quota
+# stored under KEYS[2] overrides the rate and burst passed in.
+TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local quota = redis.call('HMGET', KEYS[2], 'rate', 'burst')
+if quota[1] then
+    rate = tonumber(quota[1])
+    burst = tonumber(quota[2])
+end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000000 + tonumber(clock[2])
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+if now > ts then
+    tokens = math.min(burst, tokens + (now - ts) * rate / 1000000)
+else
+    now = ts
+end
+
+tokens = tokens - tonumber(ARGV[3])
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', string.format('%.0f', now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+
+if tokens >= 0 then
+    return 0
+end
+return math.ceil(-tokens * 1000000 / rate)
+"""
+
+
+class LocalTokenBucket:
+    """
+    Process-local token bucket: rate tokens per second, up to burst at once.
+
+    The lock only guards the bookkeeping; acquire() sleeps after releasing it.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take tokens; returns the seconds to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def pause(self, seconds):
+        """Hold all callers back for at least seconds."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def acquire(self):
+        """Wait until a token is available; returns the seconds waited."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class TokenBucket:
+    """
+    Token bucket in Redis, shared by every process using the same key.
+
+    Args:
+        key: Bucket name, e.g. "ghl:<location_id>"
+        rate: Tokens (requests) per second
+        burst: Tokens that can be taken at once after an idle period (default: rate)
+    """
+
+    def __init__(self, key, rate, burst=None):
+        self.key = key
+        self.rate = rate
+        self.burst = burst or rate
+        self._fallback = None
+        self._fallback_lock = threading.Lock()
+        self._warned_at = 0
+
+    def _local_bucket(self):
+        if self._fallback is None:
+            with self._fallback_lock:
+                if self._fallback is None:
+                    self._fallback = LocalTokenBucket(self.rate, self.burst)
+        return self._fallback
+
+    def _redis_unavailable(self, error):
+        # Warn at most once a minute per bucket
+        if time.monotonic() - self._warned_at > 60:
+            self._warned_at = time.monotonic()
+            logger.warning(f"Redis unavailable for rate limit {self.key}, limiting per process: {error}")
+
+    def reserve(self, tokens=1):
+        """Take tokens; returns the seconds to wait before using them."""
+        try:
+            # register_script() sends EVALSHA (the script body only on a cache miss)
+            take_token = get_redis().register_script(TAKE_TOKEN_SCRIPT)
+            micros = take_token(
+                keys=[REDIS_KEY_PREFIX + self.key, QUOTA_KEY_PREFIX + self.key],
+                args=[self.rate, self.burst, tokens]
+            )
+            return int(micros) / 1000000
+        except redis.exceptions.RedisError as e:
+            self._redis_unavailable(e)
+            return self._local_bucket().reserve(tokens)
+
+    def pause(self, seconds):
+        """
+        Hold every caller of the bucket back for at least seconds.
+
+        Reserves seconds worth of tokens, so callers already waiting keep
+        their place and nobody sleeps on a lock.
+        """
+        try:
+            rate = get_redis().hget(QUOTA_KEY_PREFIX + self.key, "rate")
+            rate = float(rate) if rate else self.rate
+            waiting = self.reserve(0)
+            if waiting < seconds:
+                self.reserve((seconds - waiting) * rate)
+        except redis.exceptions.RedisError as e:
+            self._redis_unavailable(e)
+            self._local_bucket().pause(seconds)
+
+    def acquire(self):
+        """Wait until a token is available; returns the seconds waited."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+# 429 responses seen by this process, per api (see record_throttle())
+_throttled = Counter()
+
+
+def get_bucket(api, scope, rate, burst=None):
+    """Return this process's TokenBucket for api/scope (e.g. "ghl", location ID)."""
+    key = f"{api}:{scope}"
+    bucket = _buckets.get(key)
+    if bucket is None or bucket.rate != rate or bucket.burst != (burst or rate):
+        with _buckets_lock:
+            bucket = _buckets[key] = TokenBucket(key, rate, burst)
+    return bucket
+
+
+def acquire(api, scope, rate, burst=None):
+    """
+    Wait for a request slot of api/scope (e.g. "ghl", location ID).
+
+    rate and burst apply until a quota is stored with set_quota(). The
+    waiting time is recorded in the rate_limit_wait_seconds metric.
+
+    Returns:
+        float: Seconds waited
+    """
+    waited = get_bucket(api, scope, rate, burst).acquire()
+    if waited > 0:
+        metrics.observe("rate_limit_wait_seconds", waited, {"api": api})
+    return waited
+
+
+def set_quota(api, scope, rate, burst):
+    """
+    Use rate/burst for api/scope in all processes (for QUOTA_TTL seconds).
+
+    Meant for limits reported by the upstream API itself.
+    """
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hset(f"{QUOTA_KEY_PREFIX}{api}:{scope}", mapping={"rate": rate, "burst": burst})
+        pipe.expire(f"{QUOTA_KEY_PREFIX}{api}:{scope}", QUOTA_TTL)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not store rate limit quota for {api}:{scope}: {e}")
+
+
+def pause(api, scope, seconds, rate, burst=None):
+    """Hold all callers of api/scope back for seconds (e.g. after a 429)."""
+    get_bucket(api, scope, rate, burst).pause(seconds)
+
+
+def record_throttle(api):
+    """Count a rate-limited (429) response of api in this process."""
+    with _buckets_lock:
+        _throttled[api] += 1
+
+
+def throttle_count(api):
+    """Rate-limited responses of api seen by this process so far."""
+    return _throttled[api]
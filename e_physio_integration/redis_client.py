@@ -0,0 +1,29 @@
+"""
+Shared Redis connection used for cross-process coordination.
+
+Celery workers, the web process and management commands all talk to the same
+Redis instance as the Celery broker (settings.REDIS_URL).
+"""
+import threading
+
+import redis
+from django.conf import settings
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis():
+    """Return the process-wide Redis client (redis-py pools connections per pid)."""
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(
+                    settings.REDIS_URL,
+                    socket_timeout=5,
+                    socket_connect_timeout=2,
+                )
+
+    return _client
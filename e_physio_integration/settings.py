@@ -17,6 +17,84 @@ load_dotenv()   # 👈 THIS LINE IS THE FIX
 EPHYSIO_EMAIL = os.getenv("EPHYSIO_EMAIL")
 EPHYSIO_PASSWORD = os.getenv("EPHYSIO_PASSWORD")
 
+# Max pooled keep-alive connections per process to the e-Physio API
+EPHYSIO_HTTP_POOL_SIZE = int(os.getenv("EPHYSIO_HTTP_POOL_SIZE", "10"))
+
+# Max pooled connections per process to the GHL API (callers block beyond this)
+GHL_HTTP_POOL_SIZE = int(os.getenv("GHL_HTTP_POOL_SIZE", "10"))
+
+# Request rate of all processes together (Redis token buckets, see
+# e_physio_integration/rate_limit.py). GHL allows 100 requests per 10 seconds
+# per location: 9/s with a burst of 10 never exceeds that. Once GHL reports
+# its quota in the X-RateLimit-* headers, that quota is used instead, less
+# GHL_RATE_HEADROOM (the share of it left unused).
+GHL_RATE_LIMIT = float(os.getenv("GHL_RATE_LIMIT", "9"))
+GHL_RATE_BURST = int(os.getenv("GHL_RATE_BURST", "10"))
+GHL_RATE_HEADROOM = float(os.getenv("GHL_RATE_HEADROOM", "0.1"))
+EPHYSIO_RATE_LIMIT = float(os.getenv("EPHYSIO_RATE_LIMIT", "10"))
+EPHYSIO_RATE_BURST = int(os.getenv("EPHYSIO_RATE_BURST", "20"))
+
+# Max concurrency of the contact/appointment push to GHL (lowered while GHL
+# throttles) and an optional per-run cap in rows per second (0: none, the
+# shared GHL rate limit decides)
+GHL_PUSH_WORKERS = int(os.getenv("GHL_PUSH_WORKERS", "8"))
+GHL_PUSH_RATE_LIMIT = int(os.getenv("GHL_PUSH_RATE_LIMIT", "0"))
+
+# GHL IDs returned by the push are saved in bulk every N rows or T seconds
+GHL_WRITE_BACK_BATCH_SIZE = int(os.getenv("GHL_WRITE_BACK_BATCH_SIZE", "100"))
+GHL_WRITE_BACK_INTERVAL = float(os.getenv("GHL_WRITE_BACK_INTERVAL", "5"))
+
+# Rows GHL rejects are retried after BASE * 2^(attempts-1) seconds (capped at
+# MAX) and become dead letters after MAX_ATTEMPTS (see manage.py sync_failures)
+GHL_PUSH_MAX_ATTEMPTS = int(os.getenv("GHL_PUSH_MAX_ATTEMPTS", "8"))
+GHL_PUSH_BACKOFF_BASE = int(os.getenv("GHL_PUSH_BACKOFF_BASE", "3600"))
+GHL_PUSH_BACKOFF_MAX = int(os.getenv("GHL_PUSH_BACKOFF_MAX", "604800"))
+
+# The outbox dispatcher claims N rows at a time (for up to CLAIM_SECONDS),
+# stops claiming after DISPATCH_SECONDS per run, and retries transient push
+# failures after RETRY_DELAY seconds (doubled per attempt, at most an hour)
+GHL_OUTBOX_BATCH_SIZE = int(os.getenv("GHL_OUTBOX_BATCH_SIZE", "200"))
+GHL_OUTBOX_CLAIM_SECONDS = int(os.getenv("GHL_OUTBOX_CLAIM_SECONDS", "600"))
+GHL_OUTBOX_DISPATCH_SECONDS = int(os.getenv("GHL_OUTBOX_DISPATCH_SECONDS", "300"))
+GHL_OUTBOX_RETRY_DELAY = int(os.getenv("GHL_OUTBOX_RETRY_DELAY", "60"))
+
+# Periodic sync tasks hold a lease per task and location while they run
+# (e_physio_integration/task_lock.py): it outlives a crashed run by at most
+# LEASE_SECONDS, and a second run waits LOCK_WAIT seconds for it (0: skip)
+SYNC_TASK_LEASE_SECONDS = int(os.getenv("SYNC_TASK_LEASE_SECONDS", "120"))
+SYNC_TASK_LOCK_WAIT = int(os.getenv("SYNC_TASK_LOCK_WAIT", "0"))
+# A run that fans out into chunk tasks hands its lease on with this TTL, long
+# enough for queued chunks to start (each chunk extends it again)
+SYNC_TASK_HANDOFF_SECONDS = int(os.getenv("SYNC_TASK_HANDOFF_SECONDS", "1800"))
+
+# The hourly syncs upsert more than N patients / a window longer than N days
+# in chunk subtasks spread over all workers (see ghl_accounts/tasks.py)
+SYNC_PATIENT_CHUNK_SIZE = int(os.getenv("SYNC_PATIENT_CHUNK_SIZE", "2000"))
+SYNC_APPOINTMENT_CHUNK_DAYS = int(os.getenv("SYNC_APPOINTMENT_CHUNK_DAYS", "28"))
+
+# GHL webhook events failing with a retryable error are retried after
+# RETRY_DELAY seconds (doubled per attempt) and marked failed after MAX_ATTEMPTS
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_RETRY_DELAY = int(os.getenv("WEBHOOK_RETRY_DELAY", "30"))
+
+# Rolling window fetched by the hourly e-Physio appointment sync
+EPHYSIO_APPOINTMENT_LOOKBACK_DAYS = int(os.getenv("EPHYSIO_APPOINTMENT_LOOKBACK_DAYS", "7"))
+EPHYSIO_APPOINTMENT_LOOKAHEAD_DAYS = int(os.getenv("EPHYSIO_APPOINTMENT_LOOKAHEAD_DAYS", "90"))
+
+# e-Physio event ranges are fetched as concurrent sub-window requests
+EPHYSIO_EVENT_SHARD_DAYS = int(os.getenv("EPHYSIO_EVENT_SHARD_DAYS", "7"))
+EPHYSIO_EVENT_FETCH_WORKERS = int(os.getenv("EPHYSIO_EVENT_FETCH_WORKERS", "4"))
+EPHYSIO_EVENT_FETCH_ATTEMPTS = int(os.getenv("EPHYSIO_EVENT_FETCH_ATTEMPTS", "3"))
+
+# Seconds an open e-Physio invoice ID is reused for a patient's appointments on the same day
+EPHYSIO_INVOICE_CACHE_TTL = int(os.getenv("EPHYSIO_INVOICE_CACHE_TTL", "900"))
+
+# Metrics are buffered per process and written to Redis every N seconds
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# /api/metrics/ requires "Authorization: Bearer <METRICS_TOKEN>" and answers 403
+# while no token is set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -142,3 +220,6 @@ CELERY_ENABLE_UTC = True
 
 # Celery Beat Configuration (for periodic tasks)
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+
+# Redis used for cross-process coordination (token refresh locks, ...)
+REDIS_URL = CELERY_BROKER_URL
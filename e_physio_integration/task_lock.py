@@ -0,0 +1,264 @@
+"""
+Leases that keep a periodic task from overlapping itself.
+
+A run of a task holds a Redis lock per task and location (e.g. GHL
+location) for its whole duration. The lock is taken with a short TTL and
+extended by a heartbeat thread while the run is alive, so a long run keeps
+it however long it takes, and the lease of a crashed worker expires within
+one TTL instead of blocking the task for hours.
+
+A second run finds the lease held and either waits for it (queues behind
+the first run, up to wait seconds) or is skipped. Skipped runs and leases
+lost mid-run are counted in the task_runs_skipped_total and
+task_lease_lost_total metrics.
+
+A run that fans out into subtasks hands its lease over (hand_off()), with
+the longer SYNC_TASK_HANDOFF_SECONDS TTL so it survives while the chunks
+wait in the queue: each chunk task re-extends it while it works
+(continue_lease()) and the final aggregation step releases it, or
+release_handed_off() does when a chunk failed. A chunk that finds the lease
+expired raises LeaseLostError instead of running next to another run.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+from e_physio_integration import metrics
+from e_physio_integration.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = "task-lease:"
+
+
+class LeaseLostError(Exception):
+    """A handed-off lease expired before a chunk task could continue it."""
+
+
+class TaskLease:
+    """
+    Lease of one task run, kept alive by a heartbeat thread.
+
+    Args:
+        task: Task name
+        scope: What the run works on, e.g. the GHL location ID
+        ttl: Seconds the lease outlives a dead heartbeat (default:
+            settings.SYNC_TASK_LEASE_SECONDS); extended every ttl / 3
+        wait: Seconds to wait for a running holder (default:
+            settings.SYNC_TASK_LOCK_WAIT, 0: do not wait)
+    """
+
+    def __init__(self, task, scope, ttl=None, wait=None):
+        self.task = task
+        self.scope = scope
+        self.ttl = ttl or settings.SYNC_TASK_LEASE_SECONDS
+        self.wait = settings.SYNC_TASK_LOCK_WAIT if wait is None else wait
+        self.lost = False
+        self.handed_off = False
+        self._lock = None
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    @property
+    def key(self):
+        return f"{REDIS_KEY_PREFIX}{self.task}:{self.scope}"
+
+    def acquire(self):
+        """
+        Take the lease and start the heartbeat.
+
+        Returns:
+            bool: False if another run holds the lease (after waiting up to
+            wait seconds). If Redis is unreachable the run goes ahead without
+            a lease and True is returned.
+        """
+        try:
+            self._lock = get_redis().lock(self.key, timeout=self.ttl, thread_local=False)
+            acquired = self._lock.acquire(blocking=self.wait > 0, blocking_timeout=self.wait or None)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Redis unavailable for the {self.key} lease, running without it: {e}")
+            self._lock = None
+            return True
+
+        if not acquired:
+            self._lock = None
+            return False
+
+        self._start_heartbeat()
+        return True
+
+    def adopt(self, token):
+        """
+        Continue a lease handed over by another task (see hand_off()).
+
+        Returns:
+            bool: False if the lease expired meanwhile (counted as lost)
+        """
+        try:
+            self._lock = get_redis().lock(self.key, timeout=self.ttl, thread_local=False)
+            self._lock.local.token = token.encode()
+            self._lock.extend(self.ttl, replace_ttl=True)
+        except redis.exceptions.LockError:
+            self._lock = None
+            self.lost = True
+            metrics.increment("task_lease_lost_total", {"task": self.task})
+            logger.error(f"Lease {self.key} expired before it was handed over, another run may overlap this one")
+            return False
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Redis unavailable for the {self.key} lease, running without it: {e}")
+            self._lock = None
+            return True
+
+        self._start_heartbeat()
+        return True
+
+    def hand_off(self):
+        """
+        Stop the heartbeat but keep the lease, for tasks this run started.
+
+        The lease is extended to SYNC_TASK_HANDOFF_SECONDS, so it outlasts
+        the time the next task waits in the queue.
+
+        Returns:
+            str: Token to adopt() the lease with, or None without a lease
+        """
+        self._stop_heartbeat()
+        if self._lock is None or self.lost:
+            return None
+
+        try:
+            self._lock.extend(settings.SYNC_TASK_HANDOFF_SECONDS, replace_ttl=True)
+        except redis.exceptions.LockError:
+            self.lost = True
+            metrics.increment("task_lease_lost_total", {"task": self.task})
+            logger.error(f"Lease {self.key} was lost before it was handed over, another run may overlap this one")
+            return None
+        except redis.exceptions.RedisError as e:
+            # The lease keeps its current TTL
+            logger.warning(f"Could not extend lease {self.key} for the hand-over: {e}")
+
+        self.handed_off = True
+        return self._lock.local.token.decode()
+
+    def _start_heartbeat(self):
+        self._stopped.clear()
+        self._heartbeat = threading.Thread(
+            target=self._keep_alive, name=f"lease-{self.task}", daemon=True
+        )
+        self._heartbeat.start()
+
+    def _stop_heartbeat(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def _keep_alive(self):
+        while not self._stopped.wait(self.ttl / 3):
+            try:
+                self._lock.extend(self.ttl, replace_ttl=True)
+            except redis.exceptions.LockError:
+                # Expired and possibly taken by another run: nothing left to extend
+                self.lost = True
+                metrics.increment("task_lease_lost_total", {"task": self.task})
+                logger.error(f"Lease {self.key} was lost, another run may overlap this one")
+                return
+            except redis.exceptions.RedisError as e:
+                # Retried on the next beat, the TTL covers a few missed ones
+                logger.warning(f"Could not extend lease {self.key}: {e}")
+
+    def release(self):
+        """Stop the heartbeat and give the lease up (unless it was handed off)."""
+        self._stop_heartbeat()
+        if self._lock is None or self.lost or self.handed_off:
+            return
+
+        try:
+            self._lock.release()
+        except redis.exceptions.LockError:
+            metrics.increment("task_lease_lost_total", {"task": self.task})
+            logger.warning(f"Lease {self.key} expired before release")
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not release lease {self.key}, it expires in {self.ttl}s: {e}")
+
+
+@contextmanager
+def exclusive_run(task, scope, ttl=None, wait=None):
+    """
+    Hold the lease of task/scope for the block.
+
+    Yields the TaskLease, or None if another run holds it: that run is
+    counted in task_runs_skipped_total and the block should return without
+    doing any work.
+
+    Args:
+        task, scope, ttl, wait: See TaskLease
+    """
+    lease = TaskLease(task, scope, ttl=ttl, wait=wait)
+    if not lease.acquire():
+        metrics.increment("task_runs_skipped_total", {"task": task})
+        logger.info(f"{task} is already running for {scope}, skipping this run")
+        yield None
+        return
+
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+@contextmanager
+def continue_lease(task, scope, token, release=False):
+    """
+    Keep a handed-off lease alive during the block (chunk tasks of a run).
+
+    Args:
+        task, scope: See TaskLease
+        token: Token from TaskLease.hand_off() (None: the run had no lease)
+        release: Give the lease up afterwards (the run's last step) instead
+            of handing it on
+
+    Raises:
+        LeaseLostError: If the lease expired before the block (the block
+            is not run)
+    """
+    if token is None:
+        yield
+        return
+
+    lease = TaskLease(task, scope, ttl=settings.SYNC_TASK_HANDOFF_SECONDS)
+    if not lease.adopt(token):
+        raise LeaseLostError(f"Lease {lease.key} expired, not continuing the run")
+    try:
+        yield
+    finally:
+        if release:
+            lease.release()
+        else:
+            lease.hand_off()
+
+
+def release_handed_off(task, scope, token):
+    """
+    Give up a handed-off lease, e.g. when a chunk of the run failed and the
+    aggregation step that would release it will not run.
+
+    Args:
+        task, scope: See TaskLease
+        token: Token from TaskLease.hand_off() (None: the run had no lease)
+    """
+    if token is None:
+        return
+
+    lease = TaskLease(task, scope)
+    try:
+        lock = get_redis().lock(lease.key, thread_local=False)
+        lock.local.token = token.encode()
+        lock.release()
+    except redis.exceptions.LockError:
+        logger.info(f"Lease {lease.key} already expired or released")
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not release lease {lease.key}, it expires on its own: {e}")
@@ -0,0 +1,110 @@
+from unittest import mock, skipUnless
+
+from django.test import SimpleTestCase, override_settings
+
+from e_physio_integration import task_lock
+
+try:
+    import fakeredis
+except ImportError:  # optional, only needed by these tests
+    fakeredis = None
+
+TASK = 'sync_patients_incremental'
+SCOPE = 'location-1'
+
+
+@skipUnless(fakeredis, 'fakeredis is not installed')
+@override_settings(SYNC_TASK_LEASE_SECONDS=120, SYNC_TASK_LOCK_WAIT=0, SYNC_TASK_HANDOFF_SECONDS=1800)
+class TaskLeaseTests(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        redis_patcher = mock.patch.object(task_lock, 'get_redis', return_value=self.redis)
+        metrics_patcher = mock.patch.object(task_lock.metrics, 'increment')
+        redis_patcher.start()
+        self.increment = metrics_patcher.start()
+        self.addCleanup(redis_patcher.stop)
+        self.addCleanup(metrics_patcher.stop)
+        self.key = f'{task_lock.REDIS_KEY_PREFIX}{TASK}:{SCOPE}'
+
+    def hand_off(self):
+        """Start a run and hand its lease off, like a task fanning out."""
+        with task_lock.exclusive_run(TASK, SCOPE) as lease:
+            return lease.hand_off()
+
+    def test_overlapping_run_is_skipped(self):
+        with task_lock.exclusive_run(TASK, SCOPE) as lease:
+            self.assertIsNotNone(lease)
+            with task_lock.exclusive_run(TASK, SCOPE) as second:
+                self.assertIsNone(second)
+
+        self.increment.assert_called_once_with('task_runs_skipped_total', {'task': TASK})
+        self.assertFalse(self.redis.exists(self.key))
+
+        with task_lock.exclusive_run(TASK, SCOPE) as lease:
+            self.assertIsNotNone(lease)
+
+    def test_other_scope_is_not_blocked(self):
+        with task_lock.exclusive_run(TASK, SCOPE):
+            with task_lock.exclusive_run(TASK, 'location-2') as other:
+                self.assertIsNotNone(other)
+
+    def test_hand_off_keeps_the_lease_with_the_hand_off_ttl(self):
+        token = self.hand_off()
+
+        self.assertEqual(self.redis.get(self.key), token.encode())
+        self.assertGreater(self.redis.ttl(self.key), 120)
+        with task_lock.exclusive_run(TASK, SCOPE) as lease:
+            self.assertIsNone(lease)
+
+    def test_chunks_continue_and_the_last_step_releases(self):
+        token = self.hand_off()
+
+        with task_lock.continue_lease(TASK, SCOPE, token):
+            self.assertEqual(self.redis.get(self.key), token.encode())
+        self.assertGreater(self.redis.ttl(self.key), 120)
+
+        with task_lock.continue_lease(TASK, SCOPE, token, release=True):
+            pass
+        self.assertFalse(self.redis.exists(self.key))
+
+    def test_expired_lease_is_not_continued(self):
+        token = self.hand_off()
+        self.redis.delete(self.key)
+        ran = []
+
+        with self.assertRaises(task_lock.LeaseLostError):
+            with task_lock.continue_lease(TASK, SCOPE, token):
+                ran.append(True)
+
+        self.assertEqual(ran, [])
+        self.increment.assert_called_with('task_lease_lost_total', {'task': TASK})
+
+    def test_lease_taken_by_another_run_is_not_continued(self):
+        token = self.hand_off()
+        self.redis.delete(self.key)
+        with task_lock.exclusive_run(TASK, SCOPE) as other:
+            with self.assertRaises(task_lock.LeaseLostError):
+                with task_lock.continue_lease(TASK, SCOPE, token):
+                    pass
+            # The other run keeps its lease
+            self.assertEqual(self.redis.get(self.key), other._lock.local.token)
+
+    def test_release_after_failed_chunk(self):
+        token = self.hand_off()
+
+        task_lock.release_handed_off(TASK, SCOPE, token)
+
+        self.assertFalse(self.redis.exists(self.key))
+        with task_lock.exclusive_run(TASK, SCOPE) as lease:
+            self.assertIsNotNone(lease)
+            # A late release of the old run leaves the new run's lease alone
+            task_lock.release_handed_off(TASK, SCOPE, token)
+            self.assertTrue(self.redis.exists(self.key))
+
+    def test_run_without_lease(self):
+        with task_lock.continue_lease(TASK, SCOPE, None):
+            pass
+        task_lock.release_handed_off(TASK, SCOPE, None)
+
+        self.assertEqual(self.redis.keys('*'), [])
@@ -0,0 +1,133 @@
+"""
+Proactive, single-flight access token refresh.
+
+A TokenManager refreshes a token shortly before it expires. The refresh runs
+under a Redis lock, so exactly one worker (across all processes) calls the
+upstream token endpoint while the others wait and then reuse the new token.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+
+from e_physio_integration.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class TokenUnavailableError(RuntimeError):
+    """No credentials are stored and another worker's refresh did not finish in time."""
+
+
+class TokenManager:
+    """
+    Coordinates refreshes of one stored access token.
+
+    Args:
+        name: Short name used for the lock key and log lines
+        load: Callable returning the current credentials record from the DB (or None)
+        refresh: Callable performing the refresh and returning the new record (or None on failure)
+        expires_at: Callable(record) returning expiry as epoch seconds, or None if unknown
+        get_token: Callable(record) returning the access token string
+        refresh_before: Refresh when the token expires within this many seconds
+        lock_timeout: Seconds before a held lock auto-expires (crashed refresher)
+        wait_timeout: Max seconds a worker waits for another worker's refresh
+    """
+
+    def __init__(self, name, load, refresh, expires_at, get_token,
+                 refresh_before=300, lock_timeout=60, wait_timeout=30):
+        self.name = name
+        self.load = load
+        self.refresh = refresh
+        self.expires_at = expires_at
+        self.get_token = get_token
+        self.refresh_before = refresh_before
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self._local_lock = threading.Lock()
+
+    def needs_refresh(self, record):
+        """True if there is no token or it expires within refresh_before."""
+        if record is None:
+            return True
+
+        expires_at = self.expires_at(record)
+        return expires_at is not None and expires_at - time.time() <= self.refresh_before
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the cross-process refresh lock; yields whether it was acquired.
+
+        Falls back to a process-local lock if Redis is unreachable.
+        """
+        redis_lock = None
+        acquired = False
+        try:
+            redis_lock = get_redis().lock(
+                f"token-refresh:{self.name}",
+                timeout=self.lock_timeout,
+                blocking_timeout=self.wait_timeout,
+            )
+            acquired = redis_lock.acquire()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Redis unavailable for {self.name} token lock, using process lock: {e}")
+            redis_lock = None
+
+        if redis_lock is None:
+            with self._local_lock:
+                yield True
+            return
+
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    redis_lock.release()
+                except redis.exceptions.LockError:
+                    logger.warning(f"{self.name} token lock expired before release")
+
+    def ensure_fresh(self, record=None, force=False, stale_token=None):
+        """
+        Return usable credentials, refreshing them if needed.
+
+        Args:
+            record: Credentials the caller already has (skips the lock if still fresh)
+            force: Refresh even if the stored token doesn't look expired (e.g. after a 401)
+            stale_token: With force, the token that was rejected; if the stored token
+                differs, another worker already refreshed and no refresh is done
+
+        Returns:
+            The current credentials record (may be None if none are stored)
+
+        Raises:
+            TokenUnavailableError: If the wait for another worker's refresh
+                timed out and no credentials are stored
+        """
+        if not force and record is not None and not self.needs_refresh(record):
+            return record
+
+        with self.lock() as acquired:
+            # Re-read under the lock: another worker may have refreshed meanwhile
+            current = self.load()
+
+            if not acquired:
+                if current is None:
+                    raise TokenUnavailableError(
+                        f"{self.name} authentication unavailable: timed out waiting for the token refresh"
+                    )
+                logger.warning(f"Timed out waiting for {self.name} token refresh, using stored token")
+                return current
+
+            if force:
+                if stale_token is not None and current is not None and self.get_token(current) != stale_token:
+                    return current
+            elif not self.needs_refresh(current):
+                return current
+
+            logger.info(f"Refreshing {self.name} access token...")
+            refreshed = self.refresh()
+            return refreshed if refreshed is not None else self.load()
@@ -1,19 +1,48 @@
-import requests
-from ephysio.services.headers import get_ephysio_headers
-from ephysio.services.auth import authenticate_ephysio
+from e_physio_integration import metrics
+from e_physio_integration.cache import ExpiringCache
+from ephysio.services.client import BASE_URL, get_ephysio_client
 from ephysio.utils import datetime_to_epoch_ms
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
+from django.conf import settings
 from django.utils import timezone as django_timezone
+import time
 
-BASE_URL = "https://ehealth.pharmedsolutions.ch/api/1.0"
 EVENT_GET_URL = f"{BASE_URL}/events/events"  # For GET requests
 EVENT_CREATE_URL = f"{BASE_URL}/events"  # For POST requests (actual endpoint from screenshots)
 INVOICE_CREATE_URL = f"{BASE_URL}/invoices"  # For creating invoices
 
+DAY_MS = 24 * 60 * 60 * 1000
+SHARD_RETRY_DELAY = 2  # seconds, doubled after every failed round
+
+# Open invoice per (patient, invoice date); sessions on the same day share one
+_invoice_cache = ExpiringCache(default_ttl=settings.EPHYSIO_INVOICE_CACHE_TTL)
+
+
+def _invoice_datetime(appointment_date):
+    """Return the appointment date as an aware UTC datetime."""
+    if django_timezone.is_naive(appointment_date):
+        return appointment_date.replace(tzinfo=timezone.utc)
+    return appointment_date.astimezone(timezone.utc)
+
+
+def invoice_cache_key(patient_id, appointment_date):
+    return (str(patient_id), _invoice_datetime(appointment_date).date().isoformat())
+
+
+def invalidate_invoice(patient_id, appointment_date):
+    """Forget the cached invoice, e.g. after e-Physio rejected an appointment for it."""
+    _invoice_cache.invalidate(invoice_cache_key(patient_id, appointment_date))
+
+
 def get_or_create_invoice(patient_id, appointment_date):
     """
     Get existing invoice for patient or create a new one.
     
+    Invoice IDs are cached per patient and invoice date for
+    EPHYSIO_INVOICE_CACHE_TTL seconds, so further sessions of the same patient
+    skip the invoice lookups entirely. Failed lookups/creations are not cached.
+    
     Args:
         patient_id: e-Physio patient ID
         appointment_date: Appointment date (datetime object, should be UTC)
@@ -21,11 +50,61 @@ def get_or_create_invoice(patient_id, appointment_date):
     Returns:
         int: Invoice ID
     """
-    # Ensure appointment_date is UTC
-    if django_timezone.is_naive(appointment_date):
-        invoice_dt = appointment_date.replace(tzinfo=timezone.utc)
-    else:
-        invoice_dt = appointment_date.astimezone(timezone.utc)
+    key = invoice_cache_key(patient_id, appointment_date)
+    invoice_id = _invoice_cache.get(key)
+    if invoice_id:
+        print(f"✅ Using cached invoice {invoice_id} for patient {patient_id}")
+        return invoice_id
+    
+    invoice_id = _find_or_create_invoice(patient_id, appointment_date)
+    if invoice_id:
+        _invoice_cache.set(key, invoice_id)
+    return invoice_id
+
+
+def resolve_invoices(pairs, workers=None):
+    """
+    Resolve invoices for many (patient_id, appointment_date) pairs at once.
+    
+    Pairs are de-duplicated by cache key and the uncached ones are looked up
+    concurrently, which primes the cache for the appointment creations that
+    follow (e.g. when a backlog of webhook appointments is replayed).
+    
+    Args:
+        pairs: Iterable of (patient_id, appointment_date) tuples
+        workers: Concurrent lookups (default: settings.EPHYSIO_EVENT_FETCH_WORKERS)
+    
+    Returns:
+        dict: Cache key -> invoice ID (None where no invoice could be resolved)
+    """
+    pending = {}
+    for patient_id, appointment_date in pairs:
+        pending.setdefault(invoice_cache_key(patient_id, appointment_date), (patient_id, appointment_date))
+    
+    results = {}
+    if not pending:
+        return results
+    
+    workers = workers or settings.EPHYSIO_EVENT_FETCH_WORKERS
+    with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+        futures = {
+            executor.submit(get_or_create_invoice, patient_id, appointment_date): key
+            for key, (patient_id, appointment_date) in pending.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                print(f"⚠️ Could not resolve invoice for patient {key[0]} on {key[1]}: {str(e)}")
+                results[key] = None
+    
+    return results
+
+
+def _find_or_create_invoice(patient_id, appointment_date):
+    """Look up an open invoice for the patient in e-Physio, creating one if none exists."""
+    invoice_dt = _invoice_datetime(appointment_date)
     
     # Use the date part (set to a specific time like 18:30:00 UTC as seen in screenshots)
     # The invoice date should be the date of the appointment, not the exact time
@@ -39,9 +118,8 @@ def get_or_create_invoice(patient_id, appointment_date):
         print(f"🔍 Checking for existing open invoices for patient {patient_id}...")
         
         # Try with date parameter first (as seen in screenshot)
-        get_response = requests.get(
+        get_response = get_ephysio_client().get(
             f"{INVOICE_CREATE_URL}/patients/{patient_id}",
-            headers=get_ephysio_headers(),
             params={
                 "open": "true",
                 "date": invoice_date_epoch
@@ -49,19 +127,6 @@ def get_or_create_invoice(patient_id, appointment_date):
             timeout=10
         )
         
-        if get_response.status_code == 401:
-            print("🔐 e-Physio token expired, re-authenticating...")
-            authenticate_ephysio()
-            get_response = requests.get(
-                f"{INVOICE_CREATE_URL}/patients/{patient_id}",
-                headers=get_ephysio_headers(),
-                params={
-                    "open": "true",
-                    "date": invoice_date_epoch
-                },
-                timeout=10
-            )
-        
         if get_response.status_code == 200:
             invoices = get_response.json()
             print(f"📥 Invoice GET response: {invoices}")
@@ -100,9 +165,8 @@ def get_or_create_invoice(patient_id, appointment_date):
             
         # If date parameter didn't work, try without date
         print(f"🔍 Trying to get invoices without date parameter...")
-        get_response2 = requests.get(
+        get_response2 = get_ephysio_client().get(
             f"{INVOICE_CREATE_URL}/patients/{patient_id}",
-            headers=get_ephysio_headers(),
             params={"open": "true"},
             timeout=10
         )
@@ -160,23 +224,12 @@ def get_or_create_invoice(patient_id, appointment_date):
     print(f"📤 Attempting to create invoice for patient {patient_id}...")
     print(f"📤 Invoice payload: {invoice_payload}")
     
-    response = requests.post(
+    response = get_ephysio_client().post(
         INVOICE_CREATE_URL,
         json=invoice_payload,
-        headers=get_ephysio_headers(),
         timeout=10
     )
     
-    if response.status_code == 401:
-        print("🔐 e-Physio token expired, re-authenticating...")
-        authenticate_ephysio()
-        response = requests.post(
-            INVOICE_CREATE_URL,
-            json=invoice_payload,
-            headers=get_ephysio_headers(),
-            timeout=10
-        )
-    
     if response.status_code != 200:
         error_text = response.text
         print(f"❌ Error creating invoice: {response.status_code} - {error_text}")
@@ -289,30 +342,20 @@ def create_ephysio_appointment(appt_sync):
 
     # Use query parameters (as seen in screenshots - this is what works in UI)
     # The screenshots showed POST to /events with query params returning 200 OK
-    response = requests.post(
+    response = get_ephysio_client().post(
         EVENT_CREATE_URL,
         json=payload,
-        headers=get_ephysio_headers(),
         params=query_params,
         timeout=10
     )
 
-    if response.status_code == 401:
-        print("🔐 e-Physio token expired, re-authenticating...")
-        authenticate_ephysio()
-        
-        response = requests.post(
-            EVENT_CREATE_URL,
-            json=payload,
-            headers=get_ephysio_headers(),
-            timeout=10
-        )
-
     print("📥 RESPONSE:", response.status_code, response.text)
     
     if response.status_code != 200:
         print("❌ STATUS:", response.status_code)
         print("❌ RESPONSE:", response.text)
+        # The cached invoice may have been closed meanwhile - look it up again next time
+        invalidate_invoice(appt_sync.ephysio_patient_id, appt_sync.start_time)
         # Try to parse error details
         try:
             error_data = response.json()
@@ -348,28 +391,106 @@ def get_ephysio_appointments(from_timestamp, to_timestamp):
         "to": to_timestamp
     }
     
-    response = requests.get(
+    response = get_ephysio_client().get(
         EVENT_GET_URL,
-        headers=get_ephysio_headers(),
         params=params,
         timeout=30
     )
     
-    if response.status_code == 401:
-        print("🔐 e-Physio token expired, re-authenticating...")
-        authenticate_ephysio()
-        
-        response = requests.get(
-            EVENT_GET_URL,
-            headers=get_ephysio_headers(),
-            params=params,
-            timeout=30
-        )
-    
     response.raise_for_status()
     return response.json()
 
 
+def split_window(from_timestamp, to_timestamp, shard_ms):
+    """
+    Split [from_timestamp, to_timestamp] into consecutive sub-windows.
+    
+    Neighbouring shards share their boundary timestamp, so callers must
+    de-duplicate events that fall on it.
+    
+    Returns:
+        list: (from_ms, to_ms) tuples covering the whole range
+    """
+    shards = []
+    start = from_timestamp
+    while start < to_timestamp:
+        end = min(start + shard_ms, to_timestamp)
+        shards.append((start, end))
+        start = end
+    return shards or [(from_timestamp, to_timestamp)]
+
+
+def iter_ephysio_appointments_sharded(from_timestamp, to_timestamp, shard_days=None,
+                                      workers=None, max_attempts=None):
+    """
+    Fetch appointments/events for a large range as concurrent sub-window requests.
+    
+    The range is split into shard_days windows which are fetched by a bounded
+    thread pool. Events are yielded as each window completes, de-duplicated by
+    id across window boundaries. Failed windows are retried (only those) with
+    backoff; if a window still fails after max_attempts the last error is
+    raised once every other window has been yielded.
+    
+    Args:
+        from_timestamp: Start timestamp in milliseconds (epoch ms). Required.
+        to_timestamp: End timestamp in milliseconds (epoch ms). Required.
+        shard_days: Window size in days (default: settings.EPHYSIO_EVENT_SHARD_DAYS)
+        workers: Concurrent requests (default: settings.EPHYSIO_EVENT_FETCH_WORKERS)
+        max_attempts: Attempts per window (default: settings.EPHYSIO_EVENT_FETCH_ATTEMPTS)
+    
+    Yields:
+        dict: Appointment/event dictionaries
+    """
+    if from_timestamp is None or to_timestamp is None:
+        raise ValueError("from_timestamp and to_timestamp are required")
+    
+    shard_days = shard_days or settings.EPHYSIO_EVENT_SHARD_DAYS
+    workers = workers or settings.EPHYSIO_EVENT_FETCH_WORKERS
+    max_attempts = max_attempts or settings.EPHYSIO_EVENT_FETCH_ATTEMPTS
+    
+    pending = split_window(from_timestamp, to_timestamp, shard_days * DAY_MS)
+    seen_ids = set()
+    last_error = None
+    
+    with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+        for attempt in range(max_attempts):
+            if attempt:
+                delay = SHARD_RETRY_DELAY * (2 ** (attempt - 1))
+                print(f"🔁 Retrying {len(pending)} failed e-Physio event window(s) in {delay}s...")
+                metrics.increment("http_retries_total", {"api": "ephysio", "reason": "event_window"}, len(pending))
+                time.sleep(delay)
+            
+            futures = {
+                executor.submit(get_ephysio_appointments, start, end): (start, end)
+                for start, end in pending
+            }
+            failed = []
+            
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    events = future.result()
+                except Exception as e:
+                    print(f"⚠️ e-Physio event window {shard[0]}-{shard[1]} failed: {str(e)}")
+                    failed.append(shard)
+                    last_error = e
+                    continue
+                
+                for event in events:
+                    event_id = event.get("id")
+                    if event_id is not None:
+                        if event_id in seen_ids:
+                            continue
+                        seen_ids.add(event_id)
+                    yield event
+            
+            pending = failed
+            if not pending:
+                return
+    
+    raise last_error
+
+
 def epoch_ms_to_datetime(epoch_ms):
     """
     Convert epoch milliseconds to datetime.
@@ -1,12 +1,112 @@
-import requests
+import time
+
 from django.conf import settings
+from e_physio_integration.cache import ExpiringCache
+from e_physio_integration.tokens import TokenManager
 from ephysio.models import EPhysioAuth
+from ephysio.services.client import BASE_URL, get_ephysio_client
+
+# Refresh tokens this long before they expire so in-flight requests don't hit 401
+EXPIRY_MARGIN = 300  # seconds
+# Used when e-Physio doesn't tell us when the token expires
+FALLBACK_TTL = 15 * 60  # seconds
+
+_auth_cache = ExpiringCache()
+
+
+class EPhysioAuthError(Exception):
+    """No usable e-Physio credentials are stored and authenticating failed."""
+
+
+def auth_expires_at(auth):
+    """
+    Return the token expiry of an EPhysioAuth as epoch seconds, or None.
+
+    e-Physio's `exp` is stored as-is; accept both seconds and milliseconds.
+    """
+    if not auth.expires_at:
+        return None
+
+    expires_at = auth.expires_at
+    if expires_at > 10 ** 11:
+        expires_at = expires_at / 1000.0
+    return expires_at
+
+
+def cache_ephysio_auth(auth, practice_id=None):
+    """Store an EPhysioAuth in the process-local cache until shortly before it expires."""
+    expires_at = auth_expires_at(auth)
+    if expires_at is None:
+        expires_at = time.time() + FALLBACK_TTL
+    else:
+        expires_at -= EXPIRY_MARGIN
+
+    _auth_cache.set(practice_id, auth, expires_at=expires_at)
+    if practice_id is None and auth.practice_id:
+        _auth_cache.set(str(auth.practice_id), auth, expires_at=expires_at)
+
+
+def invalidate_ephysio_auth(practice_id=None):
+    """Forget cached e-Physio credentials (all practices when practice_id is None)."""
+    _auth_cache.invalidate(None if practice_id is None else str(practice_id))
+
+
+def get_cached_ephysio_auth(practice_id=None):
+    """
+    Return e-Physio credentials, hitting the database only on a cache miss.
+
+    Args:
+        practice_id: e-Physio practice ID (default: the first stored credentials)
+
+    Returns:
+        EPhysioAuth or None if nothing is stored yet
+    """
+    key = None if practice_id is None else str(practice_id)
+    auth = _auth_cache.get(key)
+    if auth is not None:
+        return auth
+
+    queryset = EPhysioAuth.objects.all()
+    if key is not None:
+        queryset = queryset.filter(practice_id=key)
+    auth = queryset.first()
+
+    if ephysio_token_manager.needs_refresh(auth):
+        auth = ephysio_token_manager.ensure_fresh(auth)
+
+    if auth:
+        cache_ephysio_auth(auth, key)
+    return auth
+
+
+def refresh_ephysio_auth(stale_token=None):
+    """
+    Re-authenticate after e-Physio rejected a token.
+
+    Only one worker re-authenticates per rejected token; the others reuse
+    the token it stored.
+
+    Args:
+        stale_token: The token that got the 401
+
+    Returns:
+        EPhysioAuth: The current credentials
+
+    Raises:
+        EPhysioAuthError: If no credentials could be obtained
+    """
+    invalidate_ephysio_auth()
+    auth = ephysio_token_manager.ensure_fresh(force=True, stale_token=stale_token)
+    if auth is None:
+        raise EPhysioAuthError("e-Physio authentication unavailable")
+    cache_ephysio_auth(auth)
+    return auth
 
-BASE_URL = "https://ehealth.pharmedsolutions.ch/api/1.0"
 
 def authenticate_ephysio():
-    response = requests.post(
+    response = get_ephysio_client().post(
         f"{BASE_URL}/token",
+        authenticated=False,
         json={
             "email": settings.EPHYSIO_EMAIL,
             "password": settings.EPHYSIO_PASSWORD
@@ -27,4 +127,17 @@ def authenticate_ephysio():
         }
     )
 
+    invalidate_ephysio_auth()
+    cache_ephysio_auth(auth)
+
     return auth
+
+
+ephysio_token_manager = TokenManager(
+    name="ephysio",
+    load=lambda: EPhysioAuth.objects.first(),
+    refresh=authenticate_ephysio,
+    expires_at=auth_expires_at,
+    get_token=lambda auth: auth.token,
+    refresh_before=EXPIRY_MARGIN,
+)
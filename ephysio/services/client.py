@@ -0,0 +1,184 @@
+"""
+Shared HTTP client for the e-Physio API.
+
+Every e-Physio call goes through one pooled keep-alive requests.Session per
+process, so webhook handlers and Celery workers reuse TCP/TLS connections
+instead of paying a new handshake on every request. Each request first takes
+a token of the e-Physio rate limit shared by all processes
+(EPHYSIO_RATE_LIMIT, see e_physio_integration/rate_limit.py).
+
+Large list endpoints (patients, events) can be read with stream=True and
+iter_json_array(), which yields records while the body is still arriving
+instead of materialising the whole response.
+"""
+import codecs
+import json
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from e_physio_integration import metrics, rate_limit
+
+BASE_URL = "https://ehealth.pharmedsolutions.ch/api/1.0"
+DEFAULT_TIMEOUT = 10
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class EPhysioClient:
+    """
+    Thin wrapper around a pooled requests.Session.
+
+    Authenticated requests carry the e-Physio headers and are retried once
+    after re-authenticating (single-flight across workers) when the API
+    answers 401.
+    """
+
+    def __init__(self, pool_size=None):
+        pool_size = pool_size or settings.EPHYSIO_HTTP_POOL_SIZE
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, authenticated=True, timeout=DEFAULT_TIMEOUT, **kwargs):
+        """
+        Send a request to e-Physio.
+
+        Args:
+            method: HTTP method
+            url: Full endpoint URL
+            authenticated: Attach e-Physio auth headers and handle 401 (default: True)
+            timeout: Request timeout in seconds
+            **kwargs: Passed through to requests (params, json, ...)
+
+        Returns:
+            requests.Response
+        """
+        if not authenticated:
+            return self._send(method, url, timeout=timeout, **kwargs)
+
+        from ephysio.services.auth import refresh_ephysio_auth
+        from ephysio.services.headers import get_ephysio_headers
+
+        headers = get_ephysio_headers()
+        response = self._send(method, url, headers=headers, timeout=timeout, **kwargs)
+
+        if response.status_code == 401:
+            print("🔐 e-Physio token expired, re-authenticating...")
+            metrics.increment("reauth_total", {"api": "ephysio"})
+            # Release the connection of a streamed response before retrying
+            response.close()
+            refresh_ephysio_auth(stale_token=headers["Authorization"][len("Bearer "):])
+
+            response = self._send(
+                method, url, headers=get_ephysio_headers(), timeout=timeout, **kwargs
+            )
+
+        return response
+
+    def _send(self, method, url, **kwargs):
+        rate_limit.acquire(
+            "ephysio", "default", settings.EPHYSIO_RATE_LIMIT, settings.EPHYSIO_RATE_BURST
+        )
+        endpoint = url[len(BASE_URL):] if url.startswith(BASE_URL) else url
+        return metrics.timed_request(self.session, "ephysio", method, url, endpoint, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+def iter_json_array(response, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield the elements of a top-level JSON array as the body streams in.
+
+    Only the current chunk and the element being parsed are held in memory.
+    The response should be requested with stream=True.
+
+    Args:
+        response: requests.Response whose body is a JSON array
+        chunk_size: Bytes read from the socket per chunk
+
+    Raises:
+        ValueError: If the body is not a complete JSON array
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    buffer = ""
+    started = False
+
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buffer += text_decoder.decode(chunk)
+        pos = 0
+
+        while True:
+            # Skip whitespace and separators between elements
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array from e-Physio")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element not complete yet - wait for the next chunk
+                break
+
+            # A number cut by the chunk boundary decodes too ("22" of "223",
+            # "4.5" of "4.5e3"): only take the element once the separator
+            # after it has arrived
+            while end < len(buffer) and buffer[end] in " \t\r\n":
+                end += 1
+            if end >= len(buffer):
+                break
+            if buffer[end] not in ",]":
+                if isinstance(item, (int, float)) and not isinstance(item, bool):
+                    break
+                raise ValueError("Invalid JSON array from e-Physio")
+
+            yield item
+            pos = end
+
+        buffer = buffer[pos:]
+
+    raise ValueError("Truncated JSON array from e-Physio")
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_ephysio_client():
+    """
+    Return the per-process e-Physio client.
+
+    The client is recreated after a fork so prefork Celery workers never
+    share pooled sockets with their parent.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = EPhysioClient()
+                _client_pid = pid
+
+    return _client
@@ -1,11 +1,13 @@
-from ephysio.services.auth import authenticate_ephysio
-from ephysio.models import EPhysioAuth
+from ephysio.services.auth import EPhysioAuthError, get_cached_ephysio_auth
 
-def get_ephysio_headers():
-    auth = EPhysioAuth.objects.first()
-
-    if not auth:
-        auth = authenticate_ephysio()
+def get_ephysio_headers(practice_id=None):
+    # Authenticates (once, across workers) if no usable token is stored
+    auth = get_cached_ephysio_auth(practice_id)
+    if auth is None or not auth.token:
+        raise EPhysioAuthError(
+            "No e-Physio credentials available: check EPHYSIO_EMAIL / EPHYSIO_PASSWORD "
+            "and the e-Physio login"
+        )
 
     return {
         "Authorization": f"Bearer {auth.token}",
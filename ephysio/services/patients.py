@@ -1,44 +1,57 @@
-import requests
-from ephysio.services.headers import get_ephysio_headers
+from ephysio.services.client import BASE_URL, get_ephysio_client, iter_json_array
 from ephysio.utils import normalize_phone
-from ephysio.services.auth import authenticate_ephysio
-
-
-BASE_URL = "https://ehealth.pharmedsolutions.ch/api/1.0"
 
 
 def get_active_patients():
-    response = requests.get(
+    response = get_ephysio_client().get(
         f"{BASE_URL}/patients",
-        headers=get_ephysio_headers(),
         params={"status": 1},
         timeout=10
     )
 
-    if response.status_code == 401:
-        print("🔐 e-Physio token expired, re-authenticating...")
-        authenticate_ephysio()
-
-        response = requests.get(
-            f"{BASE_URL}/patients",
-            headers=get_ephysio_headers(),
-            params={"status": 1},
-            timeout=10
-        )
-
     response.raise_for_status()
     return response.json()
 
 
+def iter_active_patients():
+    """
+    Yield active patients one by one while the response is still streaming.
+
+    Use instead of get_active_patients() when the whole list does not need
+    to be in memory at once (hourly sync, phone scan).
+    """
+    response = get_ephysio_client().get(
+        f"{BASE_URL}/patients",
+        params={"status": 1},
+        timeout=10,
+        stream=True
+    )
+
+    with response:
+        response.raise_for_status()
+        yield from iter_json_array(response)
+
 
 def find_patient_by_phone(phone):
+    from ghl_accounts.models import ContactSync
+
     if not phone:
         return None
 
     target = normalize_phone(phone)
-    patients = get_active_patients()
 
-    for patient in patients:
+    # Indexed lookup against patients mirrored by the hourly sync / webhooks
+    match = ContactSync.objects.filter(
+        normalized_phone=target,
+        ephysio_patient_id__isnull=False
+    ).order_by("id").values("ephysio_patient_id", "phone").first()
+
+    if match:
+        return {"id": match["ephysio_patient_id"], "phone": match["phone"]}
+
+    # Not mirrored yet → fall back to scanning e-Physio
+    print("🔍 Phone not in local index, scanning e-Physio patients...")
+    for patient in iter_active_patients():
         p_phone = normalize_phone(patient.get("phone"))
         if p_phone == target:
             return patient
@@ -47,24 +60,12 @@ def find_patient_by_phone(phone):
 
 def create_patient(payload):
     print("📤 E-PHYSIO PAYLOAD >>>", payload)
-    response = requests.post(
+    response = get_ephysio_client().post(
         f"{BASE_URL}/patients/request",
-        headers=get_ephysio_headers(),
         json=payload,
         timeout=10
     )
 
-    if response.status_code == 401:
-        print("🔐 Token expired during create, re-authenticating...")
-        authenticate_ephysio()
-
-        response = requests.post(
-            f"{BASE_URL}/patients/request",
-            headers=get_ephysio_headers(),
-            json=payload,
-            timeout=10
-        )
-
     if response.status_code != 200:
         print("❌ STATUS:", response.status_code)
         print("❌ RESPONSE:", response.text)
@@ -1,3 +1,83 @@
-from django.test import TestCase
+import json
+from contextlib import contextmanager
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+
+from e_physio_integration.tokens import TokenUnavailableError
+from ephysio.services import auth
+from ephysio.services.client import iter_json_array
+from ephysio.services.headers import get_ephysio_headers
+
+
+class FakeResponse:
+    """Streams a body through iter_content like a requests.Response."""
+
+    encoding = "utf-8"
+
+    def __init__(self, body):
+        self.body = body.encode("utf-8")
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class IterJsonArrayTests(SimpleTestCase):
+    BODIES = [
+        '[1, 22, 333]',
+        '[]',
+        ' [ -4.5e3 , 10 ,true,null, "a, b]" ] ',
+        '[{"id": 12, "firstName": "Zoë", "tags": [1, 23]}, {"id": 345}]',
+    ]
+
+    def test_one_byte_at_a_time(self):
+        for body in self.BODIES:
+            with self.subTest(body=body):
+                items = list(iter_json_array(FakeResponse(body), chunk_size=1))
+                self.assertEqual(items, json.loads(body))
+
+    def test_every_chunk_size(self):
+        body = self.BODIES[3]
+        for chunk_size in range(1, len(body) + 2):
+            with self.subTest(chunk_size=chunk_size):
+                items = list(iter_json_array(FakeResponse(body), chunk_size=chunk_size))
+                self.assertEqual(items, json.loads(body))
+
+    def test_incomplete_array(self):
+        for body in ['[1, 2', '[1, 2,', '']:
+            with self.subTest(body=body):
+                with self.assertRaises(ValueError):
+                    list(iter_json_array(FakeResponse(body), chunk_size=1))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(FakeResponse('{"id": 1}')))
+
+
+@contextmanager
+def timed_out_lock():
+    yield False
+
+
+class EPhysioAuthUnavailableTests(TestCase):
+    """Another worker holds the refresh lock too long and no token is stored yet."""
+
+    def setUp(self):
+        auth.invalidate_ephysio_auth()
+        patcher = mock.patch.object(auth.ephysio_token_manager, 'lock', timed_out_lock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_headers_raise_clear_error(self):
+        with self.assertRaises(TokenUnavailableError):
+            get_ephysio_headers()
+
+    def test_refresh_raises_clear_error(self):
+        with self.assertRaises(TokenUnavailableError):
+            auth.refresh_ephysio_auth(stale_token='expired')
+
+    def test_refresh_without_credentials(self):
+        with mock.patch.object(auth.ephysio_token_manager, 'ensure_fresh', return_value=None):
+            with self.assertRaises(auth.EPhysioAuthError):
+                auth.refresh_ephysio_auth()
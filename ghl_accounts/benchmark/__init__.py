@@ -0,0 +1,7 @@
+"""
+Offline benchmark harness for the sync paths.
+
+stubs.py serves stand-in e-Physio and GHL APIs on localhost; scenarios.py
+runs the real tasks, commands and webhook view against them. Run it with
+`python manage.py benchmark_sync`.
+"""
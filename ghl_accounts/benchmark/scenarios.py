@@ -0,0 +1,335 @@
+"""
+Scripted benchmark scenarios.
+
+Each scenario brings the database and the stubs into its starting state
+(untimed), then times one sync path: the hourly tasks, the bulk management
+commands or the webhook view. Scenarios only use the test database the
+benchmark_sync command creates.
+"""
+import json
+import time
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import RequestFactory
+from django.utils import timezone
+
+from e_physio_integration.celery import app as celery_app
+from ephysio.models import EPhysioAuth
+from ephysio.services import appointments as ephysio_appointments
+from ephysio.services.auth import invalidate_ephysio_auth
+from ghl_accounts.benchmark.stubs import STUB_GHL_ACCESS_TOKEN, STUB_GHL_LOCATION_ID
+from ghl_accounts.models import (
+    AppointmentSync,
+    ContactSync,
+    GHLAuthCredentials,
+    PushOutbox,
+    SyncState,
+    WebhookEvent,
+)
+from ghl_accounts.services.client import get_ghl_client
+from ghl_accounts.tasks import sync_appointments_incremental, sync_patients_incremental
+from ghl_accounts.views import ghl_webhook
+
+
+def reset_caches():
+    """Drop process-local credentials and invoices left over from earlier scenarios."""
+    invalidate_ephysio_auth()
+    get_ghl_client().invalidate_headers()
+    ephysio_appointments._invoice_cache.invalidate()
+
+
+def fresh_start(stubs):
+    """Empty the sync tables and the stubs, and store GHL credentials for the GHL stub."""
+    stubs.reset()
+    WebhookEvent.objects.all().delete()
+    PushOutbox.objects.all().delete()
+    AppointmentSync.objects.all().delete()
+    ContactSync.objects.all().delete()
+    SyncState.objects.all().delete()
+    GHLAuthCredentials.objects.all().delete()
+    # No stored e-Physio token: the first call authenticates against the stub
+    EPhysioAuth.objects.all().delete()
+
+    GHLAuthCredentials.objects.create(
+        access_token=STUB_GHL_ACCESS_TOKEN,
+        refresh_token="stub-refresh-token",
+        expires_in=86400,
+        location_id=STUB_GHL_LOCATION_ID,
+    )
+    reset_caches()
+
+
+def ensure_contacts_synced(stubs):
+    """Make sure patients are ingested and pushed to GHL (from a fresh start if needed)."""
+    if not ContactSync.objects.filter(ghl_contact_id__isnull=False).exists():
+        fresh_start(stubs)
+        run_task(sync_patients_incremental)
+
+
+def clear_appointments():
+    PushOutbox.objects.filter(entity='appointment').delete()
+    AppointmentSync.objects.all().delete()
+    SyncState.objects.all().delete()
+
+
+def row_counts():
+    return {
+        'contacts': ContactSync.objects.count(),
+        'contacts_in_ghl': ContactSync.objects.filter(ghl_contact_id__isnull=False).count(),
+        'appointments': AppointmentSync.objects.count(),
+        'appointments_in_ghl': AppointmentSync.objects.filter(ghl_appointment_id__isnull=False).count(),
+        'outbox': PushOutbox.objects.count(),
+    }
+
+
+def task_summary(result):
+    """Drop the task result fields that differ on every run."""
+    return {k: v for k, v in result.items() if k not in ('message', 'timestamp')}
+
+
+@contextmanager
+def eager_celery():
+    """
+    Run .delay() calls inline, so webhook processing and the outbox
+    dispatch the sync tasks start are part of the timing.
+    """
+    previous = celery_app.conf.task_always_eager
+    celery_app.conf.task_always_eager = True
+    try:
+        yield
+    finally:
+        celery_app.conf.task_always_eager = previous
+
+
+def run_task(task):
+    """Run a task through Celery (inline), so its chunk subtasks run too."""
+    return task.apply().get()
+
+
+def run_command(name, *args):
+    call_command(name, *args, stdout=StringIO(), stderr=StringIO())
+    return row_counts()
+
+
+# -------------------------
+# SCENARIOS
+# -------------------------
+
+def setup_patients_initial(stubs, options):
+    fresh_start(stubs)
+
+
+def run_patients_incremental(stubs, options):
+    return task_summary(run_task(sync_patients_incremental))
+
+
+def setup_patients_steady(stubs, options):
+    ensure_contacts_synced(stubs)
+    stubs.dataset.touch(options['change_rate'])
+
+
+def setup_patients_duplicates(stubs, options):
+    fresh_start(stubs)
+    # Contacts GHL already has (created there by hand or by an earlier lost write-back)
+    patients = stubs.dataset.patients
+    for patient in patients[:int(len(patients) * options['duplicate_rate'])]:
+        stubs.ghl.add_contact({
+            'firstName': patient['firstName'],
+            'lastName': patient['lastName'],
+            'email': patient['email'],
+            'phone': patient['phone'],
+        })
+
+
+def setup_appointments_initial(stubs, options):
+    ensure_contacts_synced(stubs)
+    clear_appointments()
+
+
+def run_appointments_incremental(stubs, options):
+    return task_summary(run_task(sync_appointments_incremental))
+
+
+def setup_appointments_steady(stubs, options):
+    ensure_contacts_synced(stubs)
+    if not AppointmentSync.objects.exists():
+        run_task(sync_appointments_incremental)
+
+
+def setup_bulk_ephysio_patients(stubs, options):
+    fresh_start(stubs)
+
+
+def run_bulk_ephysio_patients(stubs, options):
+    return run_command('sync_ephysio_patients')
+
+
+def setup_bulk_contacts_to_ghl(stubs, options):
+    fresh_start(stubs)
+    run_command('sync_ephysio_patients')
+
+
+def run_bulk_contacts_to_ghl(stubs, options):
+    return run_command('sync_contacts_to_ghl')
+
+
+def setup_bulk_ephysio_appointments(stubs, options):
+    ensure_contacts_synced(stubs)
+    clear_appointments()
+
+
+def run_bulk_ephysio_appointments(stubs, options):
+    return run_command('sync_ephysio_appointments')
+
+
+def setup_bulk_appointments_to_ghl(stubs, options):
+    ensure_contacts_synced(stubs)
+    clear_appointments()
+    run_command('sync_ephysio_appointments')
+
+
+def run_bulk_appointments_to_ghl(stubs, options):
+    return run_command('sync_appointments_to_ghl')
+
+
+def setup_webhooks(stubs, options):
+    ensure_contacts_synced(stubs)
+    WebhookEvent.objects.all().delete()
+    AppointmentSync.objects.filter(source='ghl').delete()
+    ContactSync.objects.filter(source='ghl').delete()
+
+
+def webhook_payloads(count):
+    """
+    Build GHL webhooks: half new contacts (unknown to e-Physio), half
+    appointments for contacts that are already linked.
+    """
+    linked = list(
+        ContactSync.objects.filter(
+            ghl_contact_id__isnull=False,
+            ephysio_patient_id__isnull=False
+        ).values_list('ghl_contact_id', flat=True)[:count]
+    )
+    start = (timezone.now() + timedelta(days=1)).replace(minute=0, second=0, microsecond=0)
+
+    payloads = []
+    for i in range(count):
+        if i % 2 == 0 or not linked:
+            payloads.append({
+                'type': 'ContactCreate',
+                'id': f'bench-contact-{i}',
+                'firstName': 'Webhook',
+                'lastName': f'Contact{i}',
+                'phone': f'+4178{i:07d}',
+                'email': f'webhook{i}@bench.example',
+            })
+        else:
+            appointment_start = start + timedelta(hours=i)
+            payloads.append({
+                'type': 'AppointmentCreate',
+                'appointment': {
+                    'id': f'bench-appointment-{i}',
+                    'contactId': linked[i % len(linked)],
+                    'startTime': appointment_start.isoformat(),
+                    'endTime': (appointment_start + timedelta(minutes=30)).isoformat(),
+                    'appointmentStatus': 'confirmed',
+                },
+            })
+    return payloads
+
+
+def run_webhooks(stubs, options):
+    factory = RequestFactory()
+    payloads = webhook_payloads(options['webhooks'])
+
+    with eager_celery():
+        for payload in payloads:
+            request = factory.post('/webhooks/', data=json.dumps(payload), content_type='application/json')
+            ghl_webhook(request)
+
+    return {
+        'events': len(payloads),
+        'done': WebhookEvent.objects.filter(status='done').count(),
+        'failed': WebhookEvent.objects.filter(status='failed').count(),
+        'pending': WebhookEvent.objects.filter(status='pending').count(),
+    }
+
+
+# name -> (description, setup, run), in the order they run by default
+SCENARIOS = {
+    'patients_initial': (
+        'sync_patients_incremental on an empty database',
+        setup_patients_initial, run_patients_incremental,
+    ),
+    'patients_steady': (
+        'sync_patients_incremental again, with --change-rate of patients edited',
+        setup_patients_steady, run_patients_incremental,
+    ),
+    'patients_duplicates': (
+        'sync_patients_incremental when --duplicate-rate of patients already exist in GHL',
+        setup_patients_duplicates, run_patients_incremental,
+    ),
+    'appointments_initial': (
+        'sync_appointments_incremental with no appointments stored yet',
+        setup_appointments_initial, run_appointments_incremental,
+    ),
+    'appointments_steady': (
+        'sync_appointments_incremental again, nothing changed',
+        setup_appointments_steady, run_appointments_incremental,
+    ),
+    'bulk_ephysio_patients': (
+        'sync_ephysio_patients command on an empty database',
+        setup_bulk_ephysio_patients, run_bulk_ephysio_patients,
+    ),
+    'bulk_contacts_to_ghl': (
+        'sync_contacts_to_ghl command for all ingested patients',
+        setup_bulk_contacts_to_ghl, run_bulk_contacts_to_ghl,
+    ),
+    'bulk_ephysio_appointments': (
+        'sync_ephysio_appointments command with no appointments stored yet',
+        setup_bulk_ephysio_appointments, run_bulk_ephysio_appointments,
+    ),
+    'bulk_appointments_to_ghl': (
+        'sync_appointments_to_ghl command for all ingested appointments',
+        setup_bulk_appointments_to_ghl, run_bulk_appointments_to_ghl,
+    ),
+    'webhooks': (
+        'GHL webhooks through the view, processed inline (--webhooks events)',
+        setup_webhooks, run_webhooks,
+    ),
+}
+
+
+def run_scenario(name, stubs, options, verbose=False):
+    """
+    Prepare and time one scenario.
+
+    Args:
+        name: Key of SCENARIOS
+        stubs: Running StubServers the clients are routed to
+        options: dict with 'change_rate', 'duplicate_rate' and 'webhooks'
+        verbose: Show what the sync code prints (hidden by default)
+
+    Returns:
+        dict: {'scenario', 'seconds', 'result', 'rows', 'requests'}
+    """
+    description, setup, run = SCENARIOS[name]
+    with nullcontext() if verbose else redirect_stdout(StringIO()), eager_celery():
+        setup(stubs, options)
+        stubs.reset_calls()
+
+        started = time.perf_counter()
+        result = run(stubs, options)
+        seconds = time.perf_counter() - started
+
+    return {
+        'scenario': name,
+        'seconds': round(seconds, 3),
+        'result': result,
+        'rows': row_counts(),
+        'requests': stubs.call_summary(),
+    }
+
@@ -0,0 +1,547 @@
+"""
+Stand-in e-Physio and GHL APIs for offline benchmarks.
+
+Each stub is a threaded HTTP server on 127.0.0.1 serving a generated
+dataset, with configurable latency, error rate and rate limit.
+route_clients_to() points the shared e-Physio and GHL clients at the stubs,
+so the real client code (pooling, retries, streaming, re-auth) runs without
+touching the production APIs.
+"""
+import bisect
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from ephysio.services.client import BASE_URL, get_ephysio_client
+from ephysio.utils import datetime_to_epoch_ms
+from ghl_accounts.services.client import GHL_BASE_URL, get_ghl_client
+
+FIRST_PATIENT_ID = 100000
+FIRST_EVENT_ID = 500000
+EVENT_DURATION_MS = 30 * 60 * 1000
+HOUR_MS = 60 * 60 * 1000
+
+STUB_GHL_LOCATION_ID = "stub-location"
+STUB_GHL_ACCESS_TOKEN = "stub-access-token"
+GHL_DUPLICATE_MESSAGE = "This location does not allow duplicated contacts."
+
+
+class StubConfig:
+    """
+    Dataset size and API behaviour of the stubs.
+
+    Args:
+        patients: Active e-Physio patients
+        events: e-Physio events, spread over the rolling sync window
+        latency_ms: Delay added to every response
+        error_rate: Fraction of requests answered with 503
+        rate_limit: Requests per second per API before answering 429 (None: unlimited)
+        duplicate_meta: Name the existing contact in GHL duplicate errors
+            (when False, callers have to use the duplicate search)
+        seed: Random seed, so runs with the same settings are comparable
+    """
+
+    def __init__(self, patients=1000, events=2000, latency_ms=20, error_rate=0.0,
+                 rate_limit=None, duplicate_meta=True, seed=42):
+        self.patients = patients
+        self.events = events
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.duplicate_meta = duplicate_meta
+        self.seed = seed
+
+    def __repr__(self):
+        return (
+            f"StubConfig(patients={self.patients}, events={self.events}, "
+            f"latency_ms={self.latency_ms}, error_rate={self.error_rate}, "
+            f"rate_limit={self.rate_limit})"
+        )
+
+
+class Dataset:
+    """Generated e-Physio patients and events, shared by both stubs."""
+
+    def __init__(self, config):
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.patients = [self._make_patient(i) for i in range(config.patients)]
+        self._patients_body = None
+
+        # Events fall inside the window sync_appointments_incremental fetches
+        now = timezone.now()
+        window_from = datetime_to_epoch_ms(
+            now - timedelta(days=settings.EPHYSIO_APPOINTMENT_LOOKBACK_DAYS)
+        ) + HOUR_MS
+        window_to = datetime_to_epoch_ms(
+            now + timedelta(days=settings.EPHYSIO_APPOINTMENT_LOOKAHEAD_DAYS)
+        ) - HOUR_MS
+
+        events = []
+        if self.patients:
+            for i in range(config.events):
+                start = self.random.randrange(window_from, window_to)
+                start -= start % (15 * 60 * 1000)
+                events.append({
+                    "id": FIRST_EVENT_ID + i,
+                    "patientId": self.random.choice(self.patients)["id"],
+                    "start": start,
+                    "end": start + EVENT_DURATION_MS,
+                    "status": 2,
+                    "eventTypeId": 29330,
+                    "user_id": 0,
+                    "clientId": 1,
+                    "adminInfoId": 5770,
+                })
+        events.sort(key=lambda event: event["start"])
+        self.events = events
+        self._event_starts = [event["start"] for event in events]
+
+    def _make_patient(self, i):
+        return {
+            "id": FIRST_PATIENT_ID + i,
+            "salutation": "Herr" if i % 2 else "Frau",
+            "firstName": f"Patient{i}",
+            "lastName": f"Bench{i % 97}",
+            "phone": f"+4179{i:07d}",
+            "email": f"patient{i}@bench.example",
+            "street": f"Teststrasse {i % 200 + 1}",
+            "zip": f"{8000 + i % 900}",
+            "city": "Zürich",
+            "birthDate": f"{i % 28 + 1:02d}.{i % 12 + 1:02d}.{1950 + i % 50}",
+            "sex": bool(i % 2),
+        }
+
+    def touch(self, fraction):
+        """
+        Change the address of a random fraction of patients, as if they were edited in e-Physio.
+
+        Returns:
+            int: Number of patients changed
+        """
+        count = int(len(self.patients) * fraction)
+        with self.lock:
+            for patient in self.random.sample(self.patients, count):
+                patient["street"] = f"Neue Strasse {self.random.randrange(1, 500)}"
+            self._patients_body = None
+        return count
+
+    def patients_body(self):
+        """Return the /patients response body, encoded once per dataset version."""
+        with self.lock:
+            if self._patients_body is None:
+                self._patients_body = json.dumps(self.patients).encode()
+            return self._patients_body
+
+    def events_between(self, from_ms, to_ms):
+        lo = bisect.bisect_left(self._event_starts, from_ms)
+        hi = bisect.bisect_right(self._event_starts, to_ms)
+        return self.events[lo:hi]
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the clients' connection pools behave as in production
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+
+        body = None
+        if raw:
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                body = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        status, payload, headers = self.server.dispatch(
+            self.command, parts.path, query, body, self.headers
+        )
+
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Base class for a stub API.
+
+    Subclasses list their routes as (method, path regex, handler name); a
+    handler gets (match, query, body, headers) and returns (status, payload).
+    """
+    daemon_threads = True
+    name = None
+    routes = ()
+    public_routes = ()
+
+    def __init__(self, config, dataset):
+        super().__init__(("127.0.0.1", 0), StubRequestHandler)
+        self.config = config
+        self.dataset = dataset
+        self.random = random.Random(config.seed)
+        self.state_lock = threading.RLock()
+        self.calls = Counter()
+        self._recent = deque()
+        self._rate_lock = threading.Lock()
+        self._routes = [(method, re.compile(f"^{pattern}$"), handler) for method, pattern, handler in self.routes]
+        self.reset()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=f"{self.name}-stub", daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset(self):
+        """Forget everything created through the API."""
+        self.calls.clear()
+
+    def record_call(self, route, status):
+        with self.state_lock:
+            self.calls[(route, status)] += 1
+
+    def _take_rate_slot(self):
+        """Return (allowed, remaining) for a request under the per-second limit."""
+        limit = self.config.rate_limit
+        if not limit:
+            return True, None
+
+        now = time.monotonic()
+        with self._rate_lock:
+            while self._recent and now - self._recent[0] >= 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= limit:
+                return False, 0
+            self._recent.append(now)
+            return True, limit - len(self._recent)
+
+    def rate_limit_headers(self, remaining):
+        return {}
+
+    def is_authorized(self, headers):
+        return True
+
+    def dispatch(self, method, path, query, body, headers):
+        if self.config.latency_ms:
+            time.sleep(self.config.latency_ms / 1000.0)
+
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self.record_call(f"{method} {path}", 404)
+            return 404, {"message": "Not found"}, {}
+
+        route = f"{method} {re.sub(r'[(][^)]*[)]', '{id}', pattern.pattern[1:-1])}"
+        allowed, remaining = self._take_rate_slot()
+        extra_headers = self.rate_limit_headers(remaining)
+
+        if not allowed:
+            status, payload = 429, {"message": "Too many requests"}
+            extra_headers["Retry-After"] = "1"
+        elif self.config.error_rate and self.random.random() < self.config.error_rate:
+            status, payload = 503, {"message": "Service unavailable"}
+        elif handler not in self.public_routes and not self.is_authorized(headers):
+            status, payload = 401, {"message": "Unauthorized"}
+        else:
+            status, payload = getattr(self, handler)(match, query, body or {}, headers)
+
+        self.record_call(route, status)
+        return status, payload, extra_headers
+
+
+class EPhysioStub(StubServer):
+    """Stand-in for the e-Physio API (paths relative to BASE_URL)."""
+    name = "ephysio"
+    routes = (
+        ("POST", r"/token", "issue_token"),
+        ("GET", r"/patients", "list_patients"),
+        ("POST", r"/patients/request", "create_patient"),
+        ("GET", r"/events/events", "list_events"),
+        ("POST", r"/events", "create_event"),
+        ("GET", r"/invoices/patients/(\d+)", "list_invoices"),
+        ("POST", r"/invoices", "create_invoice"),
+    )
+    public_routes = ("issue_token",)
+
+    def reset(self):
+        super().reset()
+        self.current_token = None
+        self.invoices = {}
+        self.created_patients = 0
+        self.created_events = 0
+        self._next_id = 900000
+
+    def _new_id(self):
+        with self.state_lock:
+            self._next_id += 1
+            return self._next_id
+
+    def is_authorized(self, headers):
+        return self.current_token is not None and headers.get("Authorization") == f"Bearer {self.current_token}"
+
+    def issue_token(self, match, query, body, headers):
+        self.current_token = uuid.uuid4().hex
+        return 200, {
+            "token": self.current_token,
+            "keys": [{"key": "stub-crypto-key"}],
+            "id": "1",
+            "exp": int(time.time()) + 3600,
+        }
+
+    def list_patients(self, match, query, body, headers):
+        return 200, self.dataset.patients_body()
+
+    def create_patient(self, match, query, body, headers):
+        with self.state_lock:
+            self.created_patients += 1
+        return 200, {"id": self._new_id()}
+
+    def list_events(self, match, query, body, headers):
+        try:
+            from_ms, to_ms = int(query["from"]), int(query["to"])
+        except (KeyError, ValueError):
+            return 400, {"message": "from and to are required"}
+        return 200, self.dataset.events_between(from_ms, to_ms)
+
+    def create_event(self, match, query, body, headers):
+        with self.state_lock:
+            self.created_events += 1
+        return 200, {"id": self._new_id(), "events": []}
+
+    def list_invoices(self, match, query, body, headers):
+        with self.state_lock:
+            invoices = list(self.invoices.get(match.group(1), []))
+        return 200, invoices
+
+    def create_invoice(self, match, query, body, headers):
+        invoice = {"id": self._new_id(), "stati": {"status": 0, "statusDetail": 0}}
+        with self.state_lock:
+            self.invoices.setdefault(str(body.get("patientId")), []).append(invoice)
+        return 200, invoice
+
+
+class GHLStub(StubServer):
+    """Stand-in for the GHL (LeadConnector) API."""
+    name = "ghl"
+    routes = (
+        ("POST", r"/oauth/token", "oauth_token"),
+        ("POST", r"/contacts/", "create_contact"),
+        ("GET", r"/contacts/search/duplicate", "search_duplicate"),
+        ("GET", r"/contacts/([\w-]+)", "get_contact"),
+        ("PUT", r"/contacts/([\w-]+)", "update_contact"),
+        ("POST", r"/calendars/events/appointments", "create_appointment"),
+    )
+    public_routes = ("oauth_token",)
+
+    def reset(self):
+        super().reset()
+        self.access_tokens = {STUB_GHL_ACCESS_TOKEN}
+        self.contacts = {}
+        self.contact_keys = {}
+        self.appointments = {}
+
+    def rate_limit_headers(self, remaining):
+        if remaining is None:
+            return {}
+        return {
+            "X-RateLimit-Max": str(self.config.rate_limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Interval-Milliseconds": "1000",
+        }
+
+    def is_authorized(self, headers):
+        authorization = headers.get("Authorization") or ""
+        return authorization[len("Bearer "):] in self.access_tokens
+
+    def oauth_token(self, match, query, body, headers):
+        token = uuid.uuid4().hex
+        with self.state_lock:
+            self.access_tokens.add(token)
+        return 200, {
+            "access_token": token,
+            "refresh_token": uuid.uuid4().hex,
+            "expires_in": 86400,
+            "locationId": STUB_GHL_LOCATION_ID,
+        }
+
+    def _find_duplicate(self, email, phone):
+        """Return (field, contact ID) of an existing contact with this email or phone."""
+        for field, value in (("email", email), ("phone", phone)):
+            existing = value and self.contact_keys.get((field, value.lower()))
+            if existing:
+                return field, existing
+        return None, None
+
+    def add_contact(self, data):
+        """Store a contact as if it had been created in GHL; returns it."""
+        contact = dict(data, id=uuid.uuid4().hex[:20])
+        with self.state_lock:
+            self.contacts[contact["id"]] = contact
+            for field in ("email", "phone"):
+                if contact.get(field):
+                    self.contact_keys[(field, contact[field].lower())] = contact["id"]
+        return contact
+
+    def create_contact(self, match, query, body, headers):
+        # GHL rejects a second contact with the same email or phone
+        with self.state_lock:
+            field, existing = self._find_duplicate(body.get("email"), body.get("phone"))
+            if not existing:
+                return 201, {"contact": self.add_contact(body)}
+
+        meta = {"matchingField": field}
+        if self.config.duplicate_meta:
+            meta["contactId"] = existing
+        return 400, {"statusCode": 400, "message": GHL_DUPLICATE_MESSAGE, "meta": meta}
+
+    def search_duplicate(self, match, query, body, headers):
+        with self.state_lock:
+            _, existing = self._find_duplicate(query.get("email"), query.get("number"))
+        return 200, {"contact": self.contacts.get(existing)}
+
+    def get_contact(self, match, query, body, headers):
+        contact = self.contacts.get(match.group(1))
+        if not contact:
+            return 404, {"message": "Contact not found"}
+        return 200, {"contact": contact}
+
+    def update_contact(self, match, query, body, headers):
+        with self.state_lock:
+            contact = self.contacts.get(match.group(1))
+            if not contact:
+                return 400, {"message": "Contact not found"}
+            contact.update(body)
+        return 200, {"contact": contact}
+
+    def create_appointment(self, match, query, body, headers):
+        if body.get("contactId") not in self.contacts:
+            return 400, {"message": "Contact not found"}
+
+        appointment = dict(body, id=uuid.uuid4().hex[:20])
+        with self.state_lock:
+            self.appointments[appointment["id"]] = appointment
+        return 201, appointment
+
+
+class StubServers:
+    """
+    Both stubs and their shared dataset.
+
+    Use as a context manager: the servers run in background threads until
+    the block exits.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.dataset = Dataset(config)
+        self.ephysio = EPhysioStub(config, self.dataset)
+        self.ghl = GHLStub(config, self.dataset)
+
+    def __enter__(self):
+        self.ephysio.start()
+        self.ghl.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.ephysio.stop()
+        self.ghl.stop()
+
+    def reset(self):
+        self.ephysio.reset()
+        self.ghl.reset()
+
+    def reset_calls(self):
+        self.ephysio.calls.clear()
+        self.ghl.calls.clear()
+
+    def call_summary(self):
+        """
+        Summarize the requests served since the last reset_calls().
+
+        Returns:
+            dict: {'ephysio': n, 'ghl': n, 'non_2xx': n, 'by_route': {...}}
+        """
+        summary = {"ephysio": 0, "ghl": 0, "non_2xx": 0, "by_route": {}}
+        for stub in (self.ephysio, self.ghl):
+            for (route, status), count in stub.calls.items():
+                summary[stub.name] += count
+                if not 200 <= status < 300:
+                    summary["non_2xx"] += count
+                key = f"{stub.name} {route} {status}"
+                summary["by_route"][key] = summary["by_route"].get(key, 0) + count
+        return summary
+
+
+class StubAdapter(HTTPAdapter):
+    """HTTPAdapter that sends requests for base_url to target_url instead."""
+
+    def __init__(self, base_url, target_url, **kwargs):
+        self.base_url = base_url
+        self.target_url = target_url
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = self.target_url + request.url[len(self.base_url):]
+        return super().send(request, **kwargs)
+
+
+@contextmanager
+def route_clients_to(stubs):
+    """
+    Send all e-Physio and GHL client requests of this process to the stubs.
+
+    The adapters are mounted on the shared client sessions for the API base
+    URLs only, and removed again on exit.
+    """
+    mounts = [
+        (get_ephysio_client().session, BASE_URL, StubAdapter(
+            BASE_URL, stubs.ephysio.url,
+            pool_connections=1, pool_maxsize=settings.EPHYSIO_HTTP_POOL_SIZE,
+        )),
+        (get_ghl_client().session, GHL_BASE_URL, StubAdapter(
+            GHL_BASE_URL, stubs.ghl.url,
+            pool_connections=1, pool_maxsize=settings.GHL_HTTP_POOL_SIZE, pool_block=True,
+        )),
+    ]
+    for session, prefix, adapter in mounts:
+        session.mount(prefix, adapter)
+    try:
+        yield stubs
+    finally:
+        for session, prefix, adapter in mounts:
+            session.adapters.pop(prefix, None)
+            adapter.close()
@@ -0,0 +1,157 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from ghl_accounts.benchmark.scenarios import SCENARIOS, run_scenario
+from ghl_accounts.benchmark.stubs import StubConfig, StubServers, route_clients_to
+import json
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the sync tasks, bulk commands and webhook path against local stand-in '
+        'e-Physio and GHL APIs. Runs in a throwaway test database (the database user '
+        'needs CREATEDB). Locks still use the configured REDIS_URL, so run it from a '
+        'development environment.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenarios',
+            nargs='*',
+            help=f'Scenarios to run (default: all): {", ".join(SCENARIOS)}',
+        )
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=1000,
+            help='Active patients served by the e-Physio stub (default: 1000)',
+        )
+        parser.add_argument(
+            '--events',
+            type=int,
+            default=2000,
+            help='Events in the rolling sync window (default: 2000)',
+        )
+        parser.add_argument(
+            '--latency-ms',
+            type=int,
+            default=20,
+            help='Latency added to every stub response (default: 20)',
+        )
+        parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0.0,
+            help='Fraction of stub requests answered with 503 (default: 0)',
+        )
+        parser.add_argument(
+            '--rate-limit',
+            type=int,
+            default=None,
+            help='Requests per second each stub accepts before answering 429 (default: unlimited)',
+        )
+        parser.add_argument(
+            '--change-rate',
+            type=float,
+            default=0.05,
+            help='Fraction of patients edited before patients_steady (default: 0.05)',
+        )
+        parser.add_argument(
+            '--duplicate-rate',
+            type=float,
+            default=0.1,
+            help='Fraction of patients already in GHL before patients_duplicates (default: 0.1)',
+        )
+        parser.add_argument(
+            '--no-duplicate-meta',
+            action='store_true',
+            help='Leave the existing contact ID out of GHL duplicate errors (forces the duplicate search)',
+        )
+        parser.add_argument(
+            '--webhooks',
+            type=int,
+            default=50,
+            help='Webhooks sent in the webhooks scenario (default: 50)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=42,
+            help='Random seed for the generated dataset (default: 42)',
+        )
+        parser.add_argument(
+            '--json',
+            type=str,
+            help='Also write the full results (including requests per route) to this file',
+        )
+        parser.add_argument(
+            '--keepdb',
+            action='store_true',
+            help='Keep the test database between runs',
+        )
+        parser.add_argument(
+            '--show-output',
+            action='store_true',
+            help='Show what the sync code prints while it runs',
+        )
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or list(SCENARIOS)
+        unknown = [name for name in names if name not in SCENARIOS]
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(unknown)}')
+
+        config = StubConfig(
+            patients=options['patients'],
+            events=options['events'],
+            latency_ms=options['latency_ms'],
+            error_rate=options['error_rate'],
+            rate_limit=options['rate_limit'],
+            duplicate_meta=not options['no_duplicate_meta'],
+            seed=options['seed'],
+        )
+        scenario_options = {
+            'change_rate': options['change_rate'],
+            'duplicate_rate': options['duplicate_rate'],
+            'webhooks': options['webhooks'],
+        }
+
+        self.stdout.write(self.style.SUCCESS(f'Benchmark with {config}'))
+        self.stdout.write('Creating test database...')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=options['keepdb']
+        )
+
+        results = []
+        try:
+            with StubServers(config) as stubs, route_clients_to(stubs):
+                for name in names:
+                    self.stdout.write(f'Running {name}: {SCENARIOS[name][0]}...')
+                    result = run_scenario(name, stubs, scenario_options, verbose=options['show_output'])
+                    results.append(result)
+
+                    requests = result['requests']
+                    self.stdout.write(self.style.SUCCESS(
+                        f'  {result["seconds"]:.2f}s | e-Physio requests: {requests["ephysio"]} | '
+                        f'GHL requests: {requests["ghl"]} | non-2xx: {requests["non_2xx"]}'
+                    ))
+                    self.stdout.write(f'  result: {result["result"]}')
+        finally:
+            connection.close()
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        # Final summary
+        self.stdout.write(self.style.SUCCESS('\n' + '='*60))
+        self.stdout.write(self.style.SUCCESS('Benchmark Summary:'))
+        for result in results:
+            requests = result['requests']
+            self.stdout.write(self.style.SUCCESS(
+                f'  {result["scenario"]:<28} {result["seconds"]:>8.2f}s '
+                f'{requests["ephysio"] + requests["ghl"]:>8} requests'
+            ))
+        self.stdout.write(self.style.SUCCESS('='*60))
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({'config': vars(config), 'results': results}, f, indent=2, default=str)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["json"]}'))
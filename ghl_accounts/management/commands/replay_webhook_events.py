@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+from ghl_accounts.models import WebhookEvent
+from ghl_accounts.tasks import process_ghl_webhook_event
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay GHL webhook events that failed (or are stuck pending): reset them '
+        'to pending and queue them for processing again, in arrival order per entity'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ids',
+            type=int,
+            nargs='+',
+            help='Only these WebhookEvent ids',
+        )
+        parser.add_argument(
+            '--since',
+            type=int,
+            metavar='HOURS',
+            help='Only events received in the last HOURS hours',
+        )
+        parser.add_argument(
+            '--stuck-pending',
+            type=int,
+            metavar='MINUTES',
+            help='Also requeue events still pending after MINUTES minutes (e.g. lost tasks)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only show which events would be replayed',
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        events = WebhookEvent.objects.filter(status='failed')
+        if options['stuck_pending']:
+            events = WebhookEvent.objects.filter(status__in=['failed', 'pending']).exclude(
+                status='pending',
+                received_at__gt=now - timedelta(minutes=options['stuck_pending'])
+            )
+        if options['ids']:
+            events = events.filter(id__in=options['ids'])
+        if options['since']:
+            events = events.filter(received_at__gte=now - timedelta(hours=options['since']))
+
+        total = events.count()
+        if total == 0:
+            self.stdout.write(self.style.SUCCESS('No webhook events to replay.'))
+            return
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'DRY RUN MODE - would replay {total} events:'))
+            for event in events.order_by('id')[:50]:
+                self.stdout.write(
+                    f'{event.id} {event.event_type} {event.entity_key} [{event.status}] - {(event.error or "")[:200]}'
+                )
+            return
+
+        event_ids = list(events.values_list('id', flat=True))
+        replayed = WebhookEvent.objects.filter(id__in=event_ids)
+        replayed.update(status='pending', attempts=0, error=None, processed_at=None)
+
+        # One task per entity: it applies all pending events of the entity up
+        # to the latest one, in id order
+        latest = list(replayed.values('entity_key').annotate(last_id=Max('id')))
+        for row in latest:
+            process_ghl_webhook_event.delay(row['last_id'])
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Replaying {total} webhook events ({len(latest)} entities queued)')
+        )
@@ -67,7 +67,7 @@ class Command(BaseCommand):
                 'task': 'sync_patients_incremental',
                 'interval': schedule,
                 'enabled': True,
-                'description': 'Fetches patients from e-Physio, updates ContactSync table, and syncs new patients to GHL. Runs every hour.',
+                'description': 'Fetches patients from e-Physio, updates ContactSync table, and queues new patients for the GHL push. Runs every hour.',
             }
         )
         
@@ -80,7 +80,7 @@ class Command(BaseCommand):
             patient_task.task = 'sync_patients_incremental'
             patient_task.interval = schedule
             patient_task.enabled = True
-            patient_task.description = 'Fetches patients from e-Physio, updates ContactSync table, and syncs new patients to GHL. Runs every hour.'
+            patient_task.description = 'Fetches patients from e-Physio, updates ContactSync table, and queues new patients for the GHL push. Runs every hour.'
             patient_task.save()
             self.stdout.write(
                 self.style.SUCCESS('Updated periodic task: Sync Patients from e-Physio to GHL (Hourly)')
@@ -93,7 +93,7 @@ class Command(BaseCommand):
                 'task': 'sync_appointments_incremental',
                 'interval': schedule,
                 'enabled': True,
-                'description': 'Fetches appointments from e-Physio, updates AppointmentSync table, and syncs new appointments to GHL. Runs every hour.',
+                'description': 'Fetches appointments from e-Physio, updates AppointmentSync table, and queues new appointments for the GHL push. Runs every hour.',
             }
         )
         
@@ -106,7 +106,7 @@ class Command(BaseCommand):
             appointment_task.task = 'sync_appointments_incremental'
             appointment_task.interval = schedule
             appointment_task.enabled = True
-            appointment_task.description = 'Fetches appointments from e-Physio, updates AppointmentSync table, and syncs new appointments to GHL. Runs every hour.'
+            appointment_task.description = 'Fetches appointments from e-Physio, updates AppointmentSync table, and queues new appointments for the GHL push. Runs every hour.'
             appointment_task.save()
             self.stdout.write(
                 self.style.SUCCESS('Updated periodic task: Sync Appointments from e-Physio to GHL (Hourly)')
@@ -153,6 +153,38 @@ class Command(BaseCommand):
                 self.style.SUCCESS('Updated periodic task: Refresh GHL Access Token (Every 20 Hours)')
             )
         
+        # Create interval schedule for the outbox dispatcher (every minute)
+        dispatch_schedule, dispatch_schedule_created = IntervalSchedule.objects.get_or_create(
+            every=1,
+            period=IntervalSchedule.MINUTES,
+        )
+        
+        # Create periodic task for the GHL push outbox (also started after every sync)
+        dispatch_task, dispatch_created = PeriodicTask.objects.get_or_create(
+            name='Dispatch GHL Push Outbox (Every Minute)',
+            defaults={
+                'task': 'dispatch_ghl_outbox',
+                'interval': dispatch_schedule,
+                'enabled': True,
+                'description': 'Pushes the contacts and appointments queued by the syncs to GHL, with retries for transient failures. Runs every minute.',
+            }
+        )
+        
+        if dispatch_created:
+            self.stdout.write(
+                self.style.SUCCESS('Created periodic task: Dispatch GHL Push Outbox (Every Minute)')
+            )
+        else:
+            # Update existing task
+            dispatch_task.task = 'dispatch_ghl_outbox'
+            dispatch_task.interval = dispatch_schedule
+            dispatch_task.enabled = True
+            dispatch_task.description = 'Pushes the contacts and appointments queued by the syncs to GHL, with retries for transient failures. Runs every minute.'
+            dispatch_task.save()
+            self.stdout.write(
+                self.style.SUCCESS('Updated periodic task: Dispatch GHL Push Outbox (Every Minute)')
+            )
+        
         self.stdout.write(self.style.SUCCESS('\n' + '='*60))
         self.stdout.write(self.style.SUCCESS('Periodic Tasks Setup Complete!'))
         self.stdout.write(self.style.SUCCESS('='*60))
@@ -172,6 +204,11 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(f'   Task Function: {token_task.task}'))
         self.stdout.write(self.style.SUCCESS(f'   Schedule: Every {token_refresh_schedule.every} {token_refresh_schedule.period}'))
         self.stdout.write(self.style.SUCCESS(f'   Enabled: {token_task.enabled}'))
+        self.stdout.write(self.style.SUCCESS(f'\n4. GHL Push Outbox:'))
+        self.stdout.write(self.style.SUCCESS(f'   Task Name: {dispatch_task.name}'))
+        self.stdout.write(self.style.SUCCESS(f'   Task Function: {dispatch_task.task}'))
+        self.stdout.write(self.style.SUCCESS(f'   Schedule: Every {dispatch_schedule.every} {dispatch_schedule.period}'))
+        self.stdout.write(self.style.SUCCESS(f'   Enabled: {dispatch_task.enabled}'))
         self.stdout.write(self.style.SUCCESS('\nTo start Celery worker (Windows - REQUIRED: --pool=solo):'))
         self.stdout.write(self.style.WARNING('  celery -A e_physio_integration worker --pool=solo --loglevel=info'))
         self.stdout.write(self.style.SUCCESS('\nTo start Celery worker (Linux/Mac):'))
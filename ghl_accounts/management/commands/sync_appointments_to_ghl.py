@@ -2,38 +2,19 @@ from django.core.management.base import BaseCommand
 from ghl_accounts.models import AppointmentSync
 from ghl_accounts.services.appointments import (
     get_ghl_auth,
-    create_ghl_appointment,
     build_ghl_appointment_payload
 )
+from ghl_accounts.services.push import APPOINTMENT_PUSH_FIELDS, push_appointments_to_ghl
+from ghl_accounts.services.failures import exclude_backed_off
+from ghl_accounts.services.checkpoint import (
+    DEFAULT_CHUNK_SIZE,
+    finish_checkpoint,
+    iter_pk_chunks,
+    load_checkpoint,
+    save_checkpoint
+)
+from django.conf import settings
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
-import logging
-
-logger = logging.getLogger(__name__)
-
-# Rate limiting: max 10 requests per second, using 8 concurrent workers
-MAX_REQUESTS_PER_SECOND = 10
-CONCURRENT_WORKERS = 8
-
-# Rate limiter
-class RateLimiter:
-    def __init__(self, max_calls_per_second):
-        self.max_calls = max_calls_per_second
-        self.min_interval = 1.0 / max_calls_per_second
-        self.last_called = [0.0] * max_calls_per_second
-        self.lock = Lock()
-        self.index = 0
-    
-    def wait(self):
-        """Wait if necessary to respect rate limit"""
-        with self.lock:
-            now = time.time()
-            elapsed = now - self.last_called[self.index]
-            if elapsed < self.min_interval:
-                time.sleep(self.min_interval - elapsed)
-            self.last_called[self.index] = time.time()
-            self.index = (self.index + 1) % self.max_calls
 
 
 class Command(BaseCommand):
@@ -43,8 +24,14 @@ class Command(BaseCommand):
         parser.add_argument(
             '--workers',
             type=int,
-            default=CONCURRENT_WORKERS,
-            help=f'Number of concurrent workers (default: {CONCURRENT_WORKERS})',
+            default=settings.GHL_PUSH_WORKERS,
+            help=f'Number of concurrent workers (default: {settings.GHL_PUSH_WORKERS})',
+        )
+        parser.add_argument(
+            '--rate',
+            type=int,
+            default=settings.GHL_PUSH_RATE_LIMIT,
+            help=f'Max rows pushed per second by this run (default: {settings.GHL_PUSH_RATE_LIMIT}, 0 = only the shared GHL rate limit)',
         )
         parser.add_argument(
             '--source',
@@ -53,6 +40,22 @@ class Command(BaseCommand):
             default='ephysio',
             help='Source of appointments to sync (default: ephysio)',
         )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Also push appointments GHL rejected earlier that are in backoff or dead letters',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Continue after the checkpoint of an interrupted run (same --source) instead of starting over',
+        )
+        parser.add_argument(
+            '--checkpoint-every',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help=f'Rows pushed between checkpoints (default: {DEFAULT_CHUNK_SIZE})',
+        )
         parser.add_argument(
             '--dry-run',
             action='store_true',
@@ -61,8 +64,11 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         workers = options['workers']
+        rate = options['rate']
         source_filter = options['source']
         dry_run = options['dry_run']
+        retry_failed = options['retry_failed']
+        resume = options['resume']
         
         # Check GHL authentication
         access_token, location_id = get_ghl_auth()
@@ -74,6 +80,31 @@ class Command(BaseCommand):
         
         self.stdout.write(self.style.SUCCESS(f'GHL Location ID: {location_id}'))
         
+        # Progress of this command is checkpointed per --source
+        checkpoint_name = f'ghl_push_appointments:{source_filter}'
+        after_pk = None
+        counters = {}
+        if resume:
+            checkpoint = load_checkpoint(checkpoint_name)
+            if checkpoint is None:
+                self.stdout.write(self.style.WARNING('No checkpoint to resume from, starting from the beginning'))
+            elif checkpoint.last_success_at:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f'The last run finished at {checkpoint.last_success_at:%Y-%m-%d %H:%M}, nothing to resume'
+                    )
+                )
+                return
+            else:
+                after_pk = checkpoint.last_pk
+                counters = dict(checkpoint.counters)
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f'Resuming after AppointmentSync id {after_pk} '
+                        f'({counters.get("processed", 0)} appointments processed before the interruption)'
+                    )
+                )
+        
         # Get appointments to sync
         if source_filter == 'all':
             appointments = AppointmentSync.objects.all()
@@ -87,6 +118,15 @@ class Command(BaseCommand):
             ghl_appointment_id__isnull=True,
             ghl_contact_id__isnull=False
         )
+        in_backoff = 0
+        if not retry_failed:
+            # Rows GHL rejected earlier wait for their backoff (see sync_failures)
+            pending = appointments_to_sync.count()
+            appointments_to_sync = exclude_backed_off(appointments_to_sync, 'appointment')
+            in_backoff = pending - appointments_to_sync.count()
+        if after_pk is not None:
+            appointments_to_sync = appointments_to_sync.filter(pk__gt=after_pk)
+        appointments_to_sync = appointments_to_sync.only(*APPOINTMENT_PUSH_FIELDS)
         already_synced = appointments.filter(ghl_appointment_id__isnull=False).count()
         missing_contact = appointments.filter(
             ghl_appointment_id__isnull=True,
@@ -100,9 +140,13 @@ class Command(BaseCommand):
                 self.style.WARNING(
                     f'No appointments to sync. '
                     f'{already_synced} appointments already have GHL appointment IDs. '
-                    f'{missing_contact} appointments missing GHL contact link.'
+                    f'{missing_contact} appointments missing GHL contact link. '
+                    f'{in_backoff} appointments in failure backoff.'
                 )
             )
+            if not dry_run:
+                # Nothing left after the checkpoint: the interrupted run is complete
+                finish_checkpoint(checkpoint_name)
             return
         
         self.stdout.write(self.style.SUCCESS(f'Found {total} appointments to sync'))
@@ -116,6 +160,12 @@ class Command(BaseCommand):
                     f'{missing_contact} appointments missing GHL contact link (skipping)'
                 )
             )
+        if in_backoff > 0:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'{in_backoff} appointments in failure backoff (skipping, use --retry-failed to include)'
+                )
+            )
         
         if dry_run:
             self.stdout.write(self.style.WARNING('DRY RUN MODE - No API calls will be made'))
@@ -133,143 +183,64 @@ class Command(BaseCommand):
                     )
             return
         
-        # Rate limiter
-        rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND)
-        
-        # Statistics
-        stats = {
-            'created': 0,
-            'errors': 0,
-            'skipped': 0
-        }
-        stats_lock = Lock()
-        
-        def sync_appointment(appt):
-            """Sync a single appointment to GHL"""
-            try:
-                rate_limiter.wait()
-                
-                # Create new appointment
-                result = create_ghl_appointment(appt)
-                
-                if result and not result.get('error'):
-                    # Extract appointment ID from response
-                    appointment_data = result.get('appointment') or result
-                    ghl_appointment_id = appointment_data.get('id') or result.get('id')
-                    
-                    if ghl_appointment_id:
-                        # Update AppointmentSync with GHL appointment ID
-                        appt.ghl_appointment_id = ghl_appointment_id
-                        appt.save(update_fields=['ghl_appointment_id'])
-                        
-                        with stats_lock:
-                            stats['created'] += 1
-                        return {
-                            'status': 'created',
-                            'appointment': appt,
-                            'ghl_id': ghl_appointment_id
-                        }
-                    else:
-                        with stats_lock:
-                            stats['errors'] += 1
-                        return {
-                            'status': 'error',
-                            'appointment': appt,
-                            'error': 'No ID in response'
-                        }
-                else:
-                    # Check if it's a duplicate or validation error
-                    error_msg = result.get('error', '') if isinstance(result, dict) else str(result)
-                    error_lower = error_msg.lower()
-                    
-                    # GHL might return duplicate errors for appointments
-                    if ('duplicate' in error_lower or 
-                        'already exists' in error_lower or
-                        'conflict' in error_lower):
-                        # This is a duplicate - appointment already exists in GHL
-                        with stats_lock:
-                            stats['skipped'] += 1
-                        return {
-                            'status': 'skipped',
-                            'appointment': appt,
-                            'error': 'Duplicate in GHL'
-                        }
-                    else:
-                        with stats_lock:
-                            stats['errors'] += 1
-                        return {
-                            'status': 'error',
-                            'appointment': appt,
-                            'error': error_msg
-                        }
-                        
-            except Exception as e:
-                logger.error(f"Error syncing appointment {appt.id}: {str(e)}")
-                with stats_lock:
-                    stats['errors'] += 1
-                return {
-                    'status': 'error',
-                    'appointment': appt,
-                    'error': str(e)
-                }
-        
         # Process appointments concurrently
         self.stdout.write(
             self.style.SUCCESS(
-                f'Starting sync with {workers} concurrent workers '
-                f'(max {MAX_REQUESTS_PER_SECOND} requests/second)...'
+                f'Starting sync with up to {workers} concurrent workers'
+                + (f' (max {rate} rows/second)...' if rate else '...')
             )
         )
         
+        if after_pk is None:
+            # A new run: an older, interrupted run can no longer be resumed
+            save_checkpoint(checkpoint_name, None, counters)
+        
         start_time = time.time()
-        processed = 0
         
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            # Submit all tasks
-            future_to_appt = {
-                executor.submit(sync_appointment, appt): appt
-                for appt in appointments_to_sync
-            }
+        done_before = 0
+        
+        def report(appt, result, processed):
+            processed += done_before
+            if processed % 50 == 0:
+                elapsed = time.time() - start_time
+                rate_done = processed / elapsed if elapsed > 0 else 0
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f'Processed {processed}/{total} appointments '
+                        f'({rate_done:.1f} appointments/sec)'
+                    )
+                )
             
-            # Process completed tasks
-            for future in as_completed(future_to_appt):
-                appt = future_to_appt[future]
-                try:
-                    result = future.result()
-                    processed += 1
-                    
-                    if processed % 50 == 0:
-                        elapsed = time.time() - start_time
-                        rate = processed / elapsed if elapsed > 0 else 0
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f'Processed {processed}/{total} appointments '
-                                f'({rate:.1f} appointments/sec)'
-                            )
-                        )
-                    
-                    # Log errors
-                    if result['status'] == 'error':
-                        self.stdout.write(
-                            self.style.ERROR(
-                                f"Error syncing appointment #{appt.ephysio_appointment_id}: "
-                                f"{result.get('error', 'Unknown error')}"
-                            )
-                        )
-                        
-                except Exception as e:
-                    logger.error(f"Exception processing appointment {appt.id}: {str(e)}")
-                    with stats_lock:
-                        stats['errors'] += 1
+            # Log errors
+            if result['status'] == 'error':
+                self.stdout.write(
+                    self.style.ERROR(
+                        f"Error syncing appointment #{appt.ephysio_appointment_id}: "
+                        f"{result.get('error', 'Unknown error')}"
+                    )
+                )
+        
+        # Pushed in pk order, one chunk at a time; after each chunk (GHL IDs
+        # written back) the checkpoint moves past it
+        for chunk in iter_pk_chunks(appointments_to_sync, after_pk, options['checkpoint_every']):
+            stats = push_appointments_to_ghl(chunk, workers=workers, rate=rate, on_result=report)
+            done_before += len(chunk)
+            
+            for key, value in stats.items():
+                counters[key] = counters.get(key, 0) + value
+            counters['processed'] = counters.get('processed', 0) + len(chunk)
+            save_checkpoint(checkpoint_name, chunk[-1].pk, counters)
+        
+        finish_checkpoint(checkpoint_name)
         
         # Final summary
         elapsed = time.time() - start_time
         self.stdout.write(self.style.SUCCESS('\n' + '='*60))
         self.stdout.write(self.style.SUCCESS('Sync Summary:'))
-        self.stdout.write(self.style.SUCCESS(f'  Total appointments processed: {total}'))
-        self.stdout.write(self.style.SUCCESS(f'  Created in GHL: {stats["created"]}'))
-        self.stdout.write(self.style.SUCCESS(f'  Skipped (duplicates): {stats["skipped"]}'))
-        self.stdout.write(self.style.SUCCESS(f'  Errors: {stats["errors"]}'))
+        self.stdout.write(self.style.SUCCESS(f'  Total appointments processed: {counters.get("processed", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Created in GHL: {counters.get("created", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Skipped (duplicates): {counters.get("skipped", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Errors: {counters.get("errors", 0)}'))
         self.stdout.write(self.style.SUCCESS(f'  Time taken: {elapsed:.2f} seconds'))
         if elapsed > 0:
             self.stdout.write(
@@ -1,41 +1,20 @@
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from ghl_accounts.models import ContactSync
 from ghl_accounts.services.contacts import (
     get_ghl_auth,
-    create_ghl_contact,
-    update_ghl_contact,
     build_ghl_contact_payload
 )
+from ghl_accounts.services.push import CONTACT_PUSH_FIELDS, push_contacts_to_ghl
+from ghl_accounts.services.failures import exclude_backed_off
+from ghl_accounts.services.checkpoint import (
+    DEFAULT_CHUNK_SIZE,
+    finish_checkpoint,
+    iter_pk_chunks,
+    load_checkpoint,
+    save_checkpoint
+)
+from django.conf import settings
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
-import logging
-
-logger = logging.getLogger(__name__)
-
-# Rate limiting: max 10 requests per second, using 8 concurrent workers
-MAX_REQUESTS_PER_SECOND = 10
-CONCURRENT_WORKERS = 8
-
-# Rate limiter
-class RateLimiter:
-    def __init__(self, max_calls_per_second):
-        self.max_calls = max_calls_per_second
-        self.min_interval = 1.0 / max_calls_per_second
-        self.last_called = [0.0] * max_calls_per_second
-        self.lock = Lock()
-        self.index = 0
-    
-    def wait(self):
-        """Wait if necessary to respect rate limit"""
-        with self.lock:
-            now = time.time()
-            elapsed = now - self.last_called[self.index]
-            if elapsed < self.min_interval:
-                time.sleep(self.min_interval - elapsed)
-            self.last_called[self.index] = time.time()
-            self.index = (self.index + 1) % self.max_calls
 
 
 class Command(BaseCommand):
@@ -45,8 +24,14 @@ class Command(BaseCommand):
         parser.add_argument(
             '--workers',
             type=int,
-            default=CONCURRENT_WORKERS,
-            help=f'Number of concurrent workers (default: {CONCURRENT_WORKERS})',
+            default=settings.GHL_PUSH_WORKERS,
+            help=f'Number of concurrent workers (default: {settings.GHL_PUSH_WORKERS})',
+        )
+        parser.add_argument(
+            '--rate',
+            type=int,
+            default=settings.GHL_PUSH_RATE_LIMIT,
+            help=f'Max rows pushed per second by this run (default: {settings.GHL_PUSH_RATE_LIMIT}, 0 = only the shared GHL rate limit)',
         )
         parser.add_argument(
             '--source',
@@ -55,6 +40,22 @@ class Command(BaseCommand):
             default='ephysio',
             help='Source of contacts to sync (default: ephysio)',
         )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Also push contacts GHL rejected earlier that are in backoff or dead letters',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Continue after the checkpoint of an interrupted run (same --source) instead of starting over',
+        )
+        parser.add_argument(
+            '--checkpoint-every',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help=f'Rows pushed between checkpoints (default: {DEFAULT_CHUNK_SIZE})',
+        )
         parser.add_argument(
             '--dry-run',
             action='store_true',
@@ -63,8 +64,11 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         workers = options['workers']
+        rate = options['rate']
         source_filter = options['source']
         dry_run = options['dry_run']
+        retry_failed = options['retry_failed']
+        resume = options['resume']
         
         # Check GHL authentication
         access_token, location_id = get_ghl_auth()
@@ -76,6 +80,31 @@ class Command(BaseCommand):
         
         self.stdout.write(self.style.SUCCESS(f'GHL Location ID: {location_id}'))
         
+        # Progress of this command is checkpointed per --source
+        checkpoint_name = f'ghl_push_contacts:{source_filter}'
+        after_pk = None
+        counters = {}
+        if resume:
+            checkpoint = load_checkpoint(checkpoint_name)
+            if checkpoint is None:
+                self.stdout.write(self.style.WARNING('No checkpoint to resume from, starting from the beginning'))
+            elif checkpoint.last_success_at:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f'The last run finished at {checkpoint.last_success_at:%Y-%m-%d %H:%M}, nothing to resume'
+                    )
+                )
+                return
+            else:
+                after_pk = checkpoint.last_pk
+                counters = dict(checkpoint.counters)
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f'Resuming after ContactSync id {after_pk} '
+                        f'({counters.get("processed", 0)} contacts processed before the interruption)'
+                    )
+                )
+        
         # Get contacts to sync
         if source_filter == 'all':
             contacts = ContactSync.objects.all()
@@ -86,15 +115,28 @@ class Command(BaseCommand):
         # For now, we'll sync all contacts, but skip those that already have ghl_contact_id
         contacts_to_sync = contacts.filter(ghl_contact_id__isnull=True)
         already_synced = contacts.filter(ghl_contact_id__isnull=False).count()
+        in_backoff = 0
+        if not retry_failed:
+            # Rows GHL rejected earlier wait for their backoff (see sync_failures)
+            pending = contacts_to_sync.count()
+            contacts_to_sync = exclude_backed_off(contacts_to_sync, 'contact')
+            in_backoff = pending - contacts_to_sync.count()
+        if after_pk is not None:
+            contacts_to_sync = contacts_to_sync.filter(pk__gt=after_pk)
+        contacts_to_sync = contacts_to_sync.only(*CONTACT_PUSH_FIELDS)
         
         total = contacts_to_sync.count()
         
         if total == 0:
             self.stdout.write(
                 self.style.WARNING(
-                    f'No contacts to sync. {already_synced} contacts already have GHL contact IDs.'
+                    f'No contacts to sync. {already_synced} contacts already have GHL contact IDs. '
+                    f'{in_backoff} contacts in failure backoff.'
                 )
             )
+            if not dry_run:
+                # Nothing left after the checkpoint: the interrupted run is complete
+                finish_checkpoint(checkpoint_name)
             return
         
         self.stdout.write(self.style.SUCCESS(f'Found {total} contacts to sync'))
@@ -102,6 +144,12 @@ class Command(BaseCommand):
             self.stdout.write(
                 self.style.SUCCESS(f'{already_synced} contacts already synced (skipping)')
             )
+        if in_backoff > 0:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'{in_backoff} contacts in failure backoff (skipping, use --retry-failed to include)'
+                )
+            )
         
         if dry_run:
             self.stdout.write(self.style.WARNING('DRY RUN MODE - No API calls will be made'))
@@ -110,181 +158,66 @@ class Command(BaseCommand):
                 self.stdout.write(f"Would sync: {contact.first_name} {contact.last_name} - {contact.phone}")
             return
         
-        # Rate limiter
-        rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND)
-        
-        # Statistics
-        stats = {
-            'created': 0,
-            'updated': 0,
-            'errors': 0,
-            'skipped': 0
-        }
-        stats_lock = Lock()
-        
-        def sync_contact(contact):
-            """Sync a single contact to GHL"""
-            try:
-                rate_limiter.wait()
-                
-                # If contact already has ghl_contact_id, update it
-                if contact.ghl_contact_id:
-                    payload = build_ghl_contact_payload(contact)
-                    result = update_ghl_contact(contact.ghl_contact_id, payload)
-                    
-                    if result and not result.get('error'):
-                        with stats_lock:
-                            stats['updated'] += 1
-                        return {'status': 'updated', 'contact': contact, 'ghl_id': contact.ghl_contact_id}
-                    else:
-                        error_msg = result.get('error', 'Update failed') if isinstance(result, dict) else 'Update failed'
-                        with stats_lock:
-                            stats['errors'] += 1
-                        return {'status': 'error', 'contact': contact, 'error': error_msg}
-                
-                # Check if contact already exists in GHL by checking ContactSync table
-                # If another ContactSync has the same phone/email and ghl_contact_id, use that
-                # This helps avoid creating duplicates
-                existing_ghl_contact = None
-                if contact.phone:
-                    existing = ContactSync.objects.filter(
-                        phone=contact.phone,
-                        ghl_contact_id__isnull=False
-                    ).exclude(id=contact.id).first()
-                    if existing:
-                        existing_ghl_contact = existing.ghl_contact_id
-                
-                if not existing_ghl_contact and contact.email:
-                    existing = ContactSync.objects.filter(
-                        email=contact.email,
-                        ghl_contact_id__isnull=False
-                    ).exclude(id=contact.id).first()
-                    if existing:
-                        existing_ghl_contact = existing.ghl_contact_id
-                
-                if existing_ghl_contact:
-                    # Update existing contact in GHL
-                    payload = build_ghl_contact_payload(contact)
-                    result = update_ghl_contact(existing_ghl_contact, payload)
-                    
-                    if result and not result.get('error'):
-                        # Update ContactSync with GHL contact ID
-                        contact.ghl_contact_id = existing_ghl_contact
-                        contact.save(update_fields=['ghl_contact_id'])
-                        
-                        with stats_lock:
-                            stats['updated'] += 1
-                        return {'status': 'updated', 'contact': contact, 'ghl_id': existing_ghl_contact}
-                    else:
-                        error_msg = result.get('error', 'Update failed') if isinstance(result, dict) else 'Update failed'
-                        with stats_lock:
-                            stats['errors'] += 1
-                        return {'status': 'error', 'contact': contact, 'error': error_msg}
-                
-                # Create new contact
-                payload = build_ghl_contact_payload(contact)
-                result = create_ghl_contact(payload)
-                
-                if result and not result.get('error'):
-                    # Extract contact ID from response
-                    contact_data = result.get('contact') or result
-                    ghl_contact_id = contact_data.get('id') or result.get('id')
-                    
-                    if ghl_contact_id:
-                        # Update ContactSync with GHL contact ID
-                        contact.ghl_contact_id = ghl_contact_id
-                        contact.save(update_fields=['ghl_contact_id'])
-                        
-                        with stats_lock:
-                            stats['created'] += 1
-                        return {'status': 'created', 'contact': contact, 'ghl_id': ghl_contact_id}
-                    else:
-                        with stats_lock:
-                            stats['errors'] += 1
-                        return {'status': 'error', 'contact': contact, 'error': 'No ID in response'}
-                else:
-                    # Check if it's a duplicate error
-                    error_msg = result.get('error', '') if isinstance(result, dict) else str(result)
-                    error_lower = error_msg.lower()
-                    
-                    # GHL returns "This location does not allow duplicated contacts" for duplicates
-                    if ('duplicate' in error_lower or 
-                        'already exists' in error_lower or
-                        'does not allow duplicated' in error_lower):
-                        # This is a duplicate - contact already exists in GHL
-                        # We can't easily find it without a search API, so mark as skipped
-                        with stats_lock:
-                            stats['skipped'] += 1
-                        return {'status': 'skipped', 'contact': contact, 'error': 'Duplicate in GHL'}
-                    else:
-                        with stats_lock:
-                            stats['errors'] += 1
-                        return {'status': 'error', 'contact': contact, 'error': error_msg}
-                        
-            except Exception as e:
-                logger.error(f"Error syncing contact {contact.id}: {str(e)}")
-                with stats_lock:
-                    stats['errors'] += 1
-                return {'status': 'error', 'contact': contact, 'error': str(e)}
-        
         # Process contacts concurrently
         self.stdout.write(
             self.style.SUCCESS(
-                f'Starting sync with {workers} concurrent workers '
-                f'(max {MAX_REQUESTS_PER_SECOND} requests/second)...'
+                f'Starting sync with up to {workers} concurrent workers'
+                + (f' (max {rate} rows/second)...' if rate else '...')
             )
         )
         
+        if after_pk is None:
+            # A new run: an older, interrupted run can no longer be resumed
+            save_checkpoint(checkpoint_name, None, counters)
+        
         start_time = time.time()
-        processed = 0
         
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            # Submit all tasks
-            future_to_contact = {
-                executor.submit(sync_contact, contact): contact
-                for contact in contacts_to_sync
-            }
+        done_before = 0
+        
+        def report(contact, result, processed):
+            processed += done_before
+            if processed % 50 == 0:
+                elapsed = time.time() - start_time
+                rate_done = processed / elapsed if elapsed > 0 else 0
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f'Processed {processed}/{total} contacts '
+                        f'({rate_done:.1f} contacts/sec)'
+                    )
+                )
+            
+            # Log errors
+            if result['status'] == 'error':
+                self.stdout.write(
+                    self.style.ERROR(
+                        f"Error syncing {contact.first_name} {contact.last_name}: "
+                        f"{result.get('error', 'Unknown error')}"
+                    )
+                )
+        
+        # Pushed in pk order, one chunk at a time; after each chunk (GHL IDs
+        # written back) the checkpoint moves past it
+        for chunk in iter_pk_chunks(contacts_to_sync, after_pk, options['checkpoint_every']):
+            stats = push_contacts_to_ghl(chunk, workers=workers, rate=rate, on_result=report)
+            done_before += len(chunk)
             
-            # Process completed tasks
-            for future in as_completed(future_to_contact):
-                contact = future_to_contact[future]
-                try:
-                    result = future.result()
-                    processed += 1
-                    
-                    if processed % 50 == 0:
-                        elapsed = time.time() - start_time
-                        rate = processed / elapsed if elapsed > 0 else 0
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f'Processed {processed}/{total} contacts '
-                                f'({rate:.1f} contacts/sec)'
-                            )
-                        )
-                    
-                    # Log errors
-                    if result['status'] == 'error':
-                        self.stdout.write(
-                            self.style.ERROR(
-                                f"Error syncing {contact.first_name} {contact.last_name}: "
-                                f"{result.get('error', 'Unknown error')}"
-                            )
-                        )
-                        
-                except Exception as e:
-                    logger.error(f"Exception processing contact {contact.id}: {str(e)}")
-                    with stats_lock:
-                        stats['errors'] += 1
+            for key, value in stats.items():
+                counters[key] = counters.get(key, 0) + value
+            counters['processed'] = counters.get('processed', 0) + len(chunk)
+            save_checkpoint(checkpoint_name, chunk[-1].pk, counters)
+        
+        finish_checkpoint(checkpoint_name)
         
         # Final summary
         elapsed = time.time() - start_time
         self.stdout.write(self.style.SUCCESS('\n' + '='*60))
         self.stdout.write(self.style.SUCCESS('Sync Summary:'))
-        self.stdout.write(self.style.SUCCESS(f'  Total contacts processed: {total}'))
-        self.stdout.write(self.style.SUCCESS(f'  Created in GHL: {stats["created"]}'))
-        self.stdout.write(self.style.SUCCESS(f'  Updated in GHL: {stats["updated"]}'))
-        self.stdout.write(self.style.SUCCESS(f'  Skipped (duplicates): {stats["skipped"]}'))
-        self.stdout.write(self.style.SUCCESS(f'  Errors: {stats["errors"]}'))
+        self.stdout.write(self.style.SUCCESS(f'  Total contacts processed: {counters.get("processed", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Created in GHL: {counters.get("created", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Updated in GHL: {counters.get("updated", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Linked to existing GHL contacts: {counters.get("linked", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Skipped (duplicates): {counters.get("skipped", 0)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Errors: {counters.get("errors", 0)}'))
         self.stdout.write(self.style.SUCCESS(f'  Time taken: {elapsed:.2f} seconds'))
         self.stdout.write(self.style.SUCCESS(f'  Average rate: {total/elapsed:.2f} contacts/second'))
         self.stdout.write(self.style.SUCCESS('='*60))
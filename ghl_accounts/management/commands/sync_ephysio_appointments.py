@@ -1,29 +1,36 @@
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from ghl_accounts.models import AppointmentSync, ContactSync
-from ephysio.services.appointments import get_ephysio_appointments, epoch_ms_to_datetime
+from ephysio.services.appointments import iter_ephysio_appointments_sharded
+from django.conf import settings
+from ghl_accounts.services.ingestion import upsert_appointments
+from ghl_accounts.services.sync_window import (
+    FULL_FROM_TIMESTAMP,
+    FULL_TO_TIMESTAMP,
+    get_appointment_sync_window,
+    record_appointment_sync
+)
+from django.utils import timezone
 from datetime import datetime, timedelta
 
 
 class Command(BaseCommand):
-    help = 'Sync all appointments from ephysio to AppointmentSync table using bulk_create'
+    help = 'Sync all appointments from ephysio to AppointmentSync table using batched upserts'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--batch-size',
             type=int,
             default=1000,
-            help='Number of records to create in each batch (default: 1000)',
+            help='Number of records to upsert in each batch (default: 1000)',
         )
         parser.add_argument(
             '--from-date',
             type=str,
-            help='Start date in YYYY-MM-DD format (default: uses API default timestamp)',
+            help='Start date in YYYY-MM-DD format (default: start of the rolling sync window)',
         )
         parser.add_argument(
             '--to-date',
             type=str,
-            help='End date in YYYY-MM-DD format (default: uses API default timestamp)',
+            help='End date in YYYY-MM-DD format (default: end of the rolling sync window)',
         )
         parser.add_argument(
             '--from-timestamp',
@@ -35,14 +42,34 @@ class Command(BaseCommand):
             type=int,
             help='End timestamp in milliseconds (epoch ms). Overrides --to-date and default',
         )
+        parser.add_argument(
+            '--shard-days',
+            type=int,
+            default=settings.EPHYSIO_EVENT_SHARD_DAYS,
+            help=f'Fetch the range in windows of this many days (default: {settings.EPHYSIO_EVENT_SHARD_DAYS})',
+        )
+        parser.add_argument(
+            '--fetch-workers',
+            type=int,
+            default=settings.EPHYSIO_EVENT_FETCH_WORKERS,
+            help=f'Concurrent window requests (default: {settings.EPHYSIO_EVENT_FETCH_WORKERS})',
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Fetch the full historical range instead of the rolling sync window',
+        )
 
     def handle(self, *args, **options):
         batch_size = options['batch_size']
         
         # Calculate timestamps
-        # Default timestamps from the API URL shared by user
-        DEFAULT_FROM_TIMESTAMP = 1758911400000
-        DEFAULT_TO_TIMESTAMP = 1795631400000
+        # Default: rolling window (lookback + lookahead), or the full range with --full
+        started_at = timezone.now()
+        if options['full']:
+            DEFAULT_FROM_TIMESTAMP, DEFAULT_TO_TIMESTAMP = FULL_FROM_TIMESTAMP, FULL_TO_TIMESTAMP
+        else:
+            DEFAULT_FROM_TIMESTAMP, DEFAULT_TO_TIMESTAMP = get_appointment_sync_window(now=started_at)
         
         from_timestamp = options.get('from_timestamp')
         to_timestamp = options.get('to_timestamp')
@@ -58,7 +85,6 @@ class Command(BaseCommand):
                     )
                     return
             else:
-                # Use default timestamp from API
                 from_timestamp = DEFAULT_FROM_TIMESTAMP
         
         if not to_timestamp:
@@ -72,7 +98,6 @@ class Command(BaseCommand):
                     )
                     return
             else:
-                # Use default timestamp from API
                 to_timestamp = DEFAULT_TO_TIMESTAMP
         
         self.stdout.write(self.style.SUCCESS('Fetching appointments from ephysio...'))
@@ -83,145 +108,49 @@ class Command(BaseCommand):
             )
         )
         
+        # Events are fetched in concurrent sub-windows and upserted in batches:
+        # new events are inserted, changed ones updated, unchanged ones left untouched
+        self.stdout.write(self.style.SUCCESS(f'Upserting appointments in batches of {batch_size}...'))
+        
+        def report(batch_number, batch_len, stats):
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Upserted batch {batch_number}: {batch_len} appointments '
+                    f'(created: {stats["created"]}, updated: {stats["updated"]}, '
+                    f'unchanged: {stats["unchanged"]})'
+                )
+            )
+        
         try:
-            appointments = get_ephysio_appointments(from_timestamp, to_timestamp)
-            self.stdout.write(self.style.SUCCESS(f'Found {len(appointments)} appointments'))
+            stats = upsert_appointments(
+                iter_ephysio_appointments_sharded(
+                    from_timestamp,
+                    to_timestamp,
+                    shard_days=options['shard_days'],
+                    workers=options['fetch_workers']
+                ),
+                batch_size=batch_size,
+                on_batch=report
+            )
         except Exception as e:
             self.stdout.write(self.style.ERROR(f'Error fetching appointments: {str(e)}'))
             return
 
-        if not appointments:
+        if not stats['total']:
             self.stdout.write(self.style.WARNING('No appointments found'))
+            record_appointment_sync(from_timestamp, to_timestamp, started_at)
             return
 
-        # Get existing appointments by ephysio_appointment_id
-        existing_appointments = {
-            str(appt.ephysio_appointment_id): appt
-            for appt in AppointmentSync.objects.filter(
-                ephysio_appointment_id__isnull=False
-            )
-        }
-
-        # Get ContactSync records to link ghl_contact_id
-        contact_sync_map = {
-            str(contact.ephysio_patient_id): contact
-            for contact in ContactSync.objects.filter(
-                ephysio_patient_id__isnull=False
-            )
-        }
-
-        # Prepare AppointmentSync objects for bulk creation and update
-        appointments_to_create = []
-        appointments_to_update = []
-
-        for appointment in appointments:
-            ephysio_appointment_id = str(appointment.get('id'))
-            ephysio_patient_id = str(appointment.get('patientId'))
-            
-            if not ephysio_appointment_id or not ephysio_patient_id:
-                continue
-            
-            # Convert timestamps to datetime
-            start_time = epoch_ms_to_datetime(appointment.get('start'))
-            end_time = epoch_ms_to_datetime(appointment.get('end'))
-            
-            if not start_time or not end_time:
-                continue
-            
-            # Get ghl_contact_id from ContactSync if available
-            ghl_contact_id = None
-            contact_sync = contact_sync_map.get(ephysio_patient_id)
-            if contact_sync and contact_sync.ghl_contact_id:
-                ghl_contact_id = contact_sync.ghl_contact_id
-            
-            # Check if appointment already exists
-            if ephysio_appointment_id in existing_appointments:
-                # Update existing record
-                appt_sync = existing_appointments[ephysio_appointment_id]
-                appt_sync.start_time = start_time
-                appt_sync.end_time = end_time
-                appt_sync.status = str(appointment.get('status', '')) or None
-                appt_sync.event_type_id = appointment.get('eventTypeId')
-                appt_sync.user_id = appointment.get('user_id')
-                appt_sync.client_id = appointment.get('clientId')
-                appt_sync.admin_info_id = appointment.get('adminInfoId')
-                appt_sync.ephysio_patient_id = ephysio_patient_id
-                appt_sync.ghl_contact_id = ghl_contact_id
-                appt_sync.source = 'ephysio'
-                appointments_to_update.append(appt_sync)
-            else:
-                # Create new AppointmentSync object
-                appt_sync = AppointmentSync(
-                    ephysio_appointment_id=ephysio_appointment_id,
-                    ephysio_patient_id=ephysio_patient_id,
-                    ghl_contact_id=ghl_contact_id,
-                    start_time=start_time,
-                    end_time=end_time,
-                    status=str(appointment.get('status', '')) or None,
-                    event_type_id=appointment.get('eventTypeId'),
-                    user_id=appointment.get('user_id'),
-                    client_id=appointment.get('clientId'),
-                    admin_info_id=appointment.get('adminInfoId'),
-                    source='ephysio',
-                    ghl_appointment_id=None  # Will be set when synced to GHL
-                )
-                appointments_to_create.append(appt_sync)
-
-        # Bulk update existing appointments
-        total_updated = 0
-        if appointments_to_update:
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Updating {len(appointments_to_update)} existing appointments '
-                    f'in batches of {batch_size}...'
-                )
-            )
-            
-            update_fields = [
-                'start_time', 'end_time', 'status', 'event_type_id',
-                'user_id', 'client_id', 'admin_info_id', 'ephysio_patient_id',
-                'ghl_contact_id', 'source'
-            ]
-            
-            with transaction.atomic():
-                for i in range(0, len(appointments_to_update), batch_size):
-                    batch = appointments_to_update[i:i + batch_size]
-                    AppointmentSync.objects.bulk_update(batch, update_fields, batch_size=batch_size)
-                    total_updated += len(batch)
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f'Updated batch {i // batch_size + 1}: {len(batch)} appointments '
-                            f'(Total: {total_updated}/{len(appointments_to_update)})'
-                        )
-                    )
-
-        # Bulk create new appointments in batches
-        total_created = 0
-        if appointments_to_create:
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Creating {len(appointments_to_create)} new appointments '
-                    f'in batches of {batch_size}...'
-                )
-            )
-            
-            with transaction.atomic():
-                for i in range(0, len(appointments_to_create), batch_size):
-                    batch = appointments_to_create[i:i + batch_size]
-                    AppointmentSync.objects.bulk_create(batch, ignore_conflicts=True)
-                    total_created += len(batch)
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f'Created batch {i // batch_size + 1}: {len(batch)} appointments '
-                            f'(Total: {total_created}/{len(appointments_to_create)})'
-                        )
-                    )
+        watermark_advanced = record_appointment_sync(from_timestamp, to_timestamp, started_at)
 
         # Summary
         self.stdout.write(self.style.SUCCESS('\n' + '='*50))
         self.stdout.write(self.style.SUCCESS('Sync Summary:'))
-        self.stdout.write(self.style.SUCCESS(f'  Total appointments fetched: {len(appointments)}'))
-        self.stdout.write(self.style.SUCCESS(f'  New appointments created: {total_created}'))
-        self.stdout.write(self.style.SUCCESS(f'  Existing appointments updated: {total_updated}'))
-        self.stdout.write(self.style.SUCCESS(f'  Appointments with GHL contact link: {sum(1 for a in appointments_to_create + appointments_to_update if a.ghl_contact_id)}'))
+        self.stdout.write(self.style.SUCCESS(f'  Total appointments fetched: {stats["total"]}'))
+        self.stdout.write(self.style.SUCCESS(f'  New appointments created: {stats["created"]}'))
+        self.stdout.write(self.style.SUCCESS(f'  Existing appointments updated: {stats["updated"]}'))
+        self.stdout.write(self.style.SUCCESS(f'  Unchanged appointments skipped: {stats["unchanged"]}'))
+        self.stdout.write(self.style.SUCCESS(f'  Appointments with GHL contact link: {stats["linked_to_ghl"]}'))
+        self.stdout.write(self.style.SUCCESS(f'  Queued for the GHL push outbox: {len(stats["pending_ids"])}'))
+        self.stdout.write(self.style.SUCCESS(f'  Sync watermark advanced: {watermark_advanced}'))
         self.stdout.write(self.style.SUCCESS('='*50))
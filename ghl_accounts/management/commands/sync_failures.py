@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ghl_accounts.models import SyncFailure
+
+
+class Command(BaseCommand):
+    help = (
+        'List or reset the GHL push failure ledger: rows GHL rejected that are '
+        'waiting for their backoff, and dead letters that are no longer retried'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--entity',
+            type=str,
+            choices=['contact', 'appointment'],
+            help='Only contacts or only appointments (default: both)',
+        )
+        parser.add_argument(
+            '--dead',
+            action='store_true',
+            help='Only dead letters (rows that reached GHL_PUSH_MAX_ATTEMPTS)',
+        )
+        parser.add_argument(
+            '--ids',
+            type=int,
+            nargs='+',
+            help='Only these ContactSync / AppointmentSync ids',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=50,
+            help='Max entries to list (default: 50)',
+        )
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Delete the matching entries so the rows are pushed again on the next run',
+        )
+
+    def handle(self, *args, **options):
+        failures = SyncFailure.objects.all()
+        if options['entity']:
+            failures = failures.filter(entity=options['entity'])
+        if options['dead']:
+            failures = failures.filter(dead=True)
+        if options['ids']:
+            failures = failures.filter(record_id__in=options['ids'])
+
+        if options['reset']:
+            deleted, _ = failures.delete()
+            self.stdout.write(
+                self.style.SUCCESS(f'Reset {deleted} entries, the rows are pushed again on the next run')
+            )
+            return
+
+        total = failures.count()
+        if total == 0:
+            self.stdout.write(self.style.SUCCESS('No failed GHL pushes recorded.'))
+            return
+
+        dead = failures.filter(dead=True).count()
+        self.stdout.write(
+            self.style.WARNING(f'{total} failed GHL pushes recorded ({dead} dead letters, {total - dead} in backoff)')
+        )
+
+        now = timezone.now()
+        for failure in failures.order_by('-dead', '-last_failed_at')[:options['limit']]:
+            if failure.dead:
+                state = self.style.ERROR('DEAD')
+            elif failure.next_attempt_at <= now:
+                state = 'retry on next run'
+            else:
+                state = f'retry after {failure.next_attempt_at:%Y-%m-%d %H:%M}'
+            status_code = f' [{failure.last_status_code}]' if failure.last_status_code else ''
+
+            self.stdout.write(
+                f'{failure.entity} {failure.record_id}: {failure.attempts} attempts, {state} - '
+                f'{(failure.last_error or "")[:200]}{status_code}'
+            )
+
+        if total > options['limit']:
+            self.stdout.write(f'... and {total - options["limit"]} more (use --limit to show more)')
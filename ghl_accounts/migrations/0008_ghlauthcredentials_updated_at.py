@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-17 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_accounts', '0007_alter_appointmentsync_id_alter_contactsync_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghlauthcredentials',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.10 on 2026-10-17 12:50
+
+from django.db import migrations, models
+
+
+def backfill_normalized_phone(apps, schema_editor):
+    from ephysio.utils import normalize_phone
+
+    ContactSync = apps.get_model('ghl_accounts', 'ContactSync')
+    contacts = []
+    for contact in ContactSync.objects.filter(phone__isnull=False).only('id', 'phone').iterator():
+        contact.normalized_phone = normalize_phone(contact.phone)
+        contacts.append(contact)
+    ContactSync.objects.bulk_update(contacts, ['normalized_phone'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_accounts', '0008_ghlauthcredentials_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contactsync',
+            name='normalized_phone',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+        migrations.RunPython(backfill_normalized_phone, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-17 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_accounts', '0011_syncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointmentsync',
+            name='source_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='contactsync',
+            name='source_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
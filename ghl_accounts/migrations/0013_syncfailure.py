@@ -0,0 +1,31 @@
+# Generated by Django 5.2.10 on 2026-10-17 13:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_accounts', '0012_sync_source_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncFailure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(choices=[('contact', 'Contact'), ('appointment', 'Appointment')], max_length=20)),
+                ('record_id', models.BigIntegerField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('last_status_code', models.IntegerField(blank=True, null=True)),
+                ('next_attempt_at', models.DateTimeField(db_index=True)),
+                ('dead', models.BooleanField(db_index=True, default=False)),
+                ('first_failed_at', models.DateTimeField(auto_now_add=True)),
+                ('last_failed_at', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('entity', 'record_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.10 on 2026-10-17 13:24
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_accounts', '0013_syncfailure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(choices=[('contact', 'Contact'), ('appointment', 'Appointment')], max_length=20)),
+                ('record_id', models.BigIntegerField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claimed_until', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('entity', 'record_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-17 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_accounts', '0014_pushoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='counters',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='last_pk',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
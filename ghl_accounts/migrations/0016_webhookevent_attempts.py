@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-17 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_accounts', '0015_syncstate_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
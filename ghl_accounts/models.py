@@ -1,4 +1,6 @@
 from django.db import models
+from django.utils import timezone
+from ephysio.utils import normalize_phone
 
 # Create your models here.
 
@@ -12,6 +14,9 @@ class GHLAuthCredentials(models.Model):
     company_id = models.CharField(max_length=255, null=True, blank=True)
     location_id = models.CharField(max_length=255, null=True, blank=True)
 
+    # When the current access token was stored; expires_in counts from here
+    updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
+
     def __str__(self):
         return f"{self.user_id} - {self.company_id} - {self.location_id}"
     
@@ -23,6 +28,8 @@ class ContactSync(models.Model):
     # Contact information
     email = models.EmailField(null=True, blank=True)
     phone = models.CharField(max_length=20, null=True, blank=True)
+    # normalize_phone(phone), indexed for webhook patient lookups
+    normalized_phone = models.CharField(max_length=32, null=True, blank=True, db_index=True)
     
     # Patient details from ephysio
     first_name = models.CharField(max_length=100, null=True, blank=True)
@@ -39,10 +46,21 @@ class ContactSync(models.Model):
         choices=(("ghl", "GHL"), ("ephysio", "EPHYSIO"))
     )
 
+    # Fingerprint of the e-Physio data last written to this row (see services.ingestion)
+    source_hash = models.CharField(max_length=64, null=True, blank=True)
+
     last_synced_at = models.DateTimeField(auto_now=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     
+    def save(self, *args, **kwargs):
+        # Keep the phone index in sync (bulk_create/bulk_update must set it explicitly)
+        self.normalized_phone = normalize_phone(self.phone)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'phone' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'normalized_phone'}
+        super().save(*args, **kwargs)
+    
     def __str__(self):
         name = f"{self.first_name} {self.last_name}".strip() or "Unknown"
         return f"{name} | GHL: {self.ghl_contact_id or 'N/A'} | ePhysio: {self.ephysio_patient_id or 'N/A'}"
@@ -83,9 +101,133 @@ class AppointmentSync(models.Model):
         default="ephysio"
     )
 
+    # Fingerprint of the e-Physio data last written to this row (see services.ingestion)
+    source_hash = models.CharField(max_length=64, null=True, blank=True)
+
     last_synced_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         appt_id = self.ghl_appointment_id or self.ephysio_appointment_id or "N/A"
-        return f"Appt: {appt_id} | Patient: {self.ephysio_patient_id}"
\ No newline at end of file
+        return f"Appt: {appt_id} | Patient: {self.ephysio_patient_id}"
+
+
+class WebhookEvent(models.Model):
+    """
+    A received GHL webhook, queued for processing by a Celery task.
+
+    Events with the same entity_key are applied in id (arrival) order.
+    Events that failed for good can be replayed with
+    manage.py replay_webhook_events.
+    """
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    )
+
+    event_type = models.CharField(max_length=50)
+    entity_key = models.CharField(max_length=150, db_index=True)
+    payload = models.JSONField()
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending", db_index=True)
+    result = models.CharField(max_length=100, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    # Failed processing attempts; retryable errors are retried up to WEBHOOK_MAX_ATTEMPTS
+    attempts = models.IntegerField(default=0)
+
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.event_type} | {self.entity_key} | {self.status}"
+
+
+class SyncState(models.Model):
+    """
+    Persisted progress of a sync, e.g. the last successfully fetched
+    e-Physio appointment window, or the checkpoint of a bulk push command
+    (see services/checkpoint.py).
+    """
+    name = models.CharField(max_length=100, unique=True)
+
+    # Last successfully synced window (epoch ms)
+    window_from = models.BigIntegerField(null=True, blank=True)
+    window_to = models.BigIntegerField(null=True, blank=True)
+    last_success_at = models.DateTimeField(null=True, blank=True)
+
+    # Bulk push checkpoint: rows up to this primary key are done, with the
+    # run's counters so far
+    last_pk = models.BigIntegerField(null=True, blank=True)
+    counters = models.JSONField(default=dict, blank=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} | last success: {self.last_success_at or 'never'}"
+
+
+class SyncFailure(models.Model):
+    """
+    Failed GHL pushes of a ContactSync / AppointmentSync row.
+
+    A row with a permanent failure (4xx, unresolved duplicate, missing link)
+    is skipped by the push until next_attempt_at, with exponential backoff.
+    After GHL_PUSH_MAX_ATTEMPTS failures it is a dead letter and is skipped
+    until reset (manage.py sync_failures --reset). Entries are removed when
+    the row is pushed or changes in e-Physio (see services/failures.py).
+    """
+    ENTITY_CHOICES = (
+        ("contact", "Contact"),
+        ("appointment", "Appointment"),
+    )
+
+    entity = models.CharField(max_length=20, choices=ENTITY_CHOICES)
+    # ContactSync.id / AppointmentSync.id
+    record_id = models.BigIntegerField()
+
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    last_status_code = models.IntegerField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(db_index=True)
+    dead = models.BooleanField(default=False, db_index=True)
+
+    first_failed_at = models.DateTimeField(auto_now_add=True)
+    last_failed_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("entity", "record_id")
+
+    def __str__(self):
+        state = "dead" if self.dead else f"retry after {self.next_attempt_at}"
+        return f"{self.entity} {self.record_id} | {self.attempts} attempts | {state}"
+
+
+class PushOutbox(models.Model):
+    """
+    ContactSync / AppointmentSync rows waiting for their GHL push.
+
+    Entries are written in the same transaction as the row change that makes
+    the push necessary (transactional outbox), so a crash between ingestion
+    and push cannot lose them. The dispatch_ghl_outbox task claims entries
+    (claimed_until), pushes the rows and deletes the entries; pushes that
+    failed transiently are retried from available_at.
+    """
+    ENTITY_CHOICES = SyncFailure.ENTITY_CHOICES
+
+    entity = models.CharField(max_length=20, choices=ENTITY_CHOICES)
+    # ContactSync.id / AppointmentSync.id
+    record_id = models.BigIntegerField()
+
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("entity", "record_id")
+
+    def __str__(self):
+        return f"{self.entity} {self.record_id} | {self.attempts} attempts | available {self.available_at}"
@@ -0,0 +1,284 @@
+"""
+Shared HTTP client for the GHL (LeadConnector) API.
+
+All GHL calls go through one pooled requests.Session per process with a
+bounded number of connections, cached auth headers and a single retry policy
+(exponential backoff on 5xx responses, timeouts and connection errors).
+Every attempt first takes a token of the location's rate limit, shared by
+all processes (GHL_RATE_LIMIT, see e_physio_integration/rate_limit.py).
+
+The limit adapts to what GHL reports: the X-RateLimit-Max per
+X-RateLimit-Interval-Milliseconds quota replaces GHL_RATE_LIMIT (minus
+GHL_RATE_HEADROOM), a used-up X-RateLimit-Remaining pauses the bucket for
+one interval, and a 429 pauses it for Retry-After before the request is
+retried.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from e_physio_integration import metrics, rate_limit
+
+logger = logging.getLogger(__name__)
+
+GHL_BASE_URL = "https://services.leadconnectorhq.com"
+
+# Retry settings
+MAX_RETRIES = 3
+RETRY_DELAY = 2  # seconds, doubled on every attempt
+
+# Retries of a rate-limited (429) request, each after GHL's Retry-After
+MAX_RATE_LIMIT_RETRIES = 5
+# Seconds to back off after a 429 without Retry-After or interval header
+RATE_LIMIT_DEFAULT_WAIT = 10
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait according to a Retry-After header, or None.
+
+    Accepts both forms: delta seconds ("3") and an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class GHLClient:
+    """
+    Pooled GHL API client.
+
+    Auth headers are built once per access token and reused until GHL answers
+    401 (which triggers a single-flight token refresh) or the token is
+    refreshed via refresh_ghl_token().
+    """
+
+    def __init__(self, pool_size=None):
+        pool_size = pool_size or settings.GHL_HTTP_POOL_SIZE
+
+        self.session = requests.Session()
+        # pool_block keeps the number of open connections bounded when many
+        # threads share the client (e.g. the sync_contacts_to_ghl workers).
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._headers = None
+        self._location_id = None
+        self._headers_lock = threading.Lock()
+        # scope -> ((rate, burst), monotonic time stored) of the last quota shared
+        self._quotas = {}
+
+    def get_headers(self):
+        """Return cached GHL auth headers, building them on first use."""
+        headers = self._headers
+        if headers is None:
+            from ghl_accounts.services.contacts import get_ghl_auth, get_ghl_headers
+
+            with self._headers_lock:
+                if self._headers is None:
+                    self._headers = get_ghl_headers()
+                    self._location_id = get_ghl_auth()[1]
+                headers = self._headers
+        return headers
+
+    def rate_limit_scope(self, authenticated=True):
+        """Rate limit bucket of a request: the current location (OAuth calls share one)."""
+        return (self._location_id or "default") if authenticated else "oauth"
+
+    def wait_for_rate_limit(self, scope):
+        """Take a token of the scope's rate limit."""
+        rate_limit.acquire("ghl", scope, settings.GHL_RATE_LIMIT, settings.GHL_RATE_BURST)
+
+    def pause_rate_limit(self, scope, seconds):
+        """Hold back every request of the scope (in all processes) for seconds."""
+        rate_limit.pause("ghl", scope, seconds, settings.GHL_RATE_LIMIT, settings.GHL_RATE_BURST)
+
+    def observe_rate_limit(self, response, scope):
+        """
+        Adopt the quota GHL reports in the response headers.
+
+        Returns:
+            float: GHL's rate limit interval in seconds, or None if not reported
+        """
+        max_requests = _int_header(response.headers, "X-RateLimit-Max")
+        interval_ms = _int_header(response.headers, "X-RateLimit-Interval-Milliseconds")
+        if not max_requests or not interval_ms:
+            return None
+
+        interval = interval_ms / 1000
+        # Refill (1 - headroom) of the quota per interval and allow a burst of
+        # the rest, so rate * interval + burst never exceeds the quota
+        headroom = settings.GHL_RATE_HEADROOM
+        quota = (
+            round(max_requests * (1 - headroom) / interval, 3),
+            max(1, int(max_requests * headroom))
+        )
+
+        # Share it when it changes, and often enough to keep it from expiring
+        now = time.monotonic()
+        shared, shared_at = self._quotas.get(scope, (None, 0))
+        if shared != quota or now - shared_at > rate_limit.QUOTA_TTL / 2:
+            self._quotas[scope] = (quota, now)
+            rate_limit.set_quota("ghl", scope, *quota)
+            if shared != quota:
+                logger.info(f"GHL quota for {scope}: {max_requests} requests per {interval:g}s, using {quota[0]}/s")
+
+        remaining = _int_header(response.headers, "X-RateLimit-Remaining")
+        if remaining is not None and remaining <= 0:
+            # Someone else is using the quota too: wait for the next interval
+            self.pause_rate_limit(scope, interval)
+
+        return interval
+
+    def invalidate_headers(self):
+        """Drop cached headers and credentials so the next request reloads the access token."""
+        from ghl_accounts.services.contacts import invalidate_ghl_auth
+
+        with self._headers_lock:
+            invalidate_ghl_auth()
+            self._headers = None
+
+    def request(self, method, path, authenticated=True, timeout=10, max_retries=MAX_RETRIES, **kwargs):
+        """
+        Send a request to GHL with the shared retry policy.
+
+        Args:
+            method: HTTP method
+            path: API path (e.g. "/contacts/") or full URL
+            authenticated: Attach cached auth headers (default: True)
+            timeout: Request timeout in seconds
+            max_retries: Attempts for retryable failures (429s are retried
+                separately, up to MAX_RATE_LIMIT_RETRIES times)
+            **kwargs: Passed through to requests (params, json, data, ...)
+
+        Returns:
+            requests.Response: The final response (may be a non-2xx status)
+
+        Raises:
+            requests.exceptions.Timeout / ConnectionError after the last attempt
+        """
+        url = path if path.startswith("http") else f"{GHL_BASE_URL}{path}"
+        reauthenticated = False
+
+        attempt = 0
+        throttled = 0
+        while True:
+            headers = self.get_headers() if authenticated else None
+            scope = self.rate_limit_scope(authenticated)
+            self.wait_for_rate_limit(scope)
+            try:
+                response = metrics.timed_request(
+                    self.session, "ghl", method, url, path, headers=headers, timeout=timeout, **kwargs
+                )
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                if attempt < max_retries - 1:
+                    metrics.increment("http_retries_total", {"api": "ghl", "reason": "network_error"})
+                    delay = RETRY_DELAY * (2 ** attempt)
+                    logger.warning(
+                        f"Network error on {method} {path} attempt {attempt + 1}/{max_retries}, "
+                        f"retrying in {delay}s... Error: {str(e)[:100]}"
+                    )
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                raise
+
+            interval = self.observe_rate_limit(response, scope)
+
+            # Wait as long as GHL asks (all workers of the location), then retry
+            if response.status_code == 429 and throttled < MAX_RATE_LIMIT_RETRIES:
+                wait = parse_retry_after(response.headers.get("Retry-After"))
+                if wait is None:
+                    wait = interval or RATE_LIMIT_DEFAULT_WAIT
+                metrics.increment("http_retries_total", {"api": "ghl", "reason": "rate_limited"})
+                rate_limit.record_throttle("ghl")
+                logger.warning(
+                    f"GHL rate limit hit on {method} {path} ({throttled + 1}/{MAX_RATE_LIMIT_RETRIES}), "
+                    f"retrying in {wait:g}s"
+                )
+                self.pause_rate_limit(scope, wait)
+                throttled += 1
+                continue
+
+            # Refresh once (or pick up a token another worker already refreshed)
+            if response.status_code == 401 and authenticated and not reauthenticated:
+                from ghl_accounts.services.contacts import refresh_ghl_auth
+
+                logger.info("GHL returned 401, refreshing access token...")
+                metrics.increment("reauth_total", {"api": "ghl"})
+                self.invalidate_headers()
+                refresh_ghl_auth(stale_token=headers["Authorization"][len("Bearer "):])
+                reauthenticated = True
+                continue
+
+            if response.status_code >= 500 and attempt < max_retries - 1:
+                metrics.increment("http_retries_total", {"api": "ghl", "reason": "server_error"})
+                delay = RETRY_DELAY * (2 ** attempt)
+                logger.warning(
+                    f"Server error {response.status_code} on {method} {path} attempt "
+                    f"{attempt + 1}/{max_retries}, retrying in {delay}s... "
+                    f"Error: {response.text[:100]}"
+                )
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_ghl_client():
+    """
+    Return the per-process GHL client.
+
+    The client is recreated after a fork so prefork Celery workers never
+    share pooled sockets with their parent.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = GHLClient()
+                _client_pid = pid
+
+    return _client
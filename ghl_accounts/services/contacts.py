@@ -1,16 +1,25 @@
 import requests
 from ghl_accounts.models import GHLAuthCredentials
+from ghl_accounts.services.client import get_ghl_client
+from e_physio_integration.cache import ExpiringCache
+from e_physio_integration.tokens import TokenManager
 from django.conf import settings
 from decouple import config
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
-GHL_BASE_URL = "https://services.leadconnectorhq.com"
 TOKEN_URL = "https://services.leadconnectorhq.com/oauth/token"
 GHL_CLIENT_ID = config("GHL_CLIENT_ID")
 GHL_CLIENT_SECRET = config("GHL_CLIENT_SECRET")
 
+# Refresh (and drop cached credentials) this long before the token expires
+AUTH_CACHE_EXPIRY_MARGIN = 300  # seconds
+AUTH_CACHE_FALLBACK_TTL = 15 * 60  # seconds, when the token's issue time is unknown
+
+_auth_cache = ExpiringCache()
+
 
 def refresh_ghl_token():
     """
@@ -39,7 +48,10 @@ def refresh_ghl_token():
         }
         
         logger.info("Refreshing GHL access token...")
-        response = requests.post(TOKEN_URL, data=data, timeout=10)
+        # Single attempt: a refresh token may be rotated even if the response is lost
+        response = get_ghl_client().post(
+            TOKEN_URL, authenticated=False, data=data, timeout=10, max_retries=1
+        )
         
         if response.status_code != 200:
             error_text = response.text
@@ -66,6 +78,7 @@ def refresh_ghl_token():
             auth.location_id = response_data.get("locationId")
         
         auth.save()
+        get_ghl_client().invalidate_headers()
         
         logger.info(f"✅ GHL token refreshed successfully. New token expires in {auth.expires_in} seconds.")
         return True, "Token refreshed successfully"
@@ -78,12 +91,46 @@ def refresh_ghl_token():
         return False, f"Unexpected error: {str(e)}"
 
 
-def get_ghl_auth():
+def credentials_expire_at(auth):
+    """
+    Return when the stored GHL access token expires, as epoch seconds.
+    
+    Returns None if the token's issue time is unknown (rows stored before
+    updated_at existed).
+    """
+    if not auth.updated_at or not auth.expires_in:
+        return None
+    return auth.updated_at.timestamp() + auth.expires_in
+
+
+def invalidate_ghl_auth(location_id=None):
+    """
+    Forget cached GHL credentials (all locations when location_id is None).
+    
+    Must be called whenever GHLAuthCredentials are written.
+    """
+    _auth_cache.invalidate(location_id)
+
+
+def get_ghl_auth(location_id=None):
     """
     Get GHL authentication credentials.
     Returns tuple of (access_token, location_id) or (None, None) if not found.
+    
+    Credentials are cached in-process per location until shortly before the
+    access token expires, so bulk runs don't query the database per request.
+    
+    Args:
+        location_id: GHL location ID (default: the first stored credentials)
     """
-    auth = GHLAuthCredentials.objects.first()
+    cached = _auth_cache.get(location_id)
+    if cached is not None:
+        return cached
+    
+    queryset = GHLAuthCredentials.objects.all()
+    if location_id:
+        queryset = queryset.filter(location_id=location_id)
+    auth = queryset.first()
     
     if not auth:
         logger.error("No GHL authentication credentials found. Please authenticate first.")
@@ -93,7 +140,47 @@ def get_ghl_auth():
         logger.error("GHL location_id is missing. Please re-authenticate.")
         return None, None
     
-    return auth.access_token, auth.location_id
+    if ghl_token_manager.needs_refresh(auth):
+        auth = ghl_token_manager.ensure_fresh(auth)
+    
+    expires_at = credentials_expire_at(auth)
+    if expires_at is None:
+        expires_at = time.time() + AUTH_CACHE_FALLBACK_TTL
+    else:
+        expires_at -= AUTH_CACHE_EXPIRY_MARGIN
+    
+    credentials = (auth.access_token, auth.location_id)
+    _auth_cache.set(location_id, credentials, expires_at=expires_at)
+    return credentials
+
+
+def refresh_ghl_auth(stale_token=None):
+    """
+    Refresh the GHL access token after it was rejected with 401.
+    
+    Only one worker refreshes per rejected token; the others reuse the token
+    it stored.
+    
+    Args:
+        stale_token: The access token that got the 401
+    """
+    invalidate_ghl_auth()
+    ghl_token_manager.ensure_fresh(force=True, stale_token=stale_token)
+
+
+def _refresh_ghl_credentials():
+    success, message = refresh_ghl_token()
+    return GHLAuthCredentials.objects.first() if success else None
+
+
+ghl_token_manager = TokenManager(
+    name="ghl",
+    load=lambda: GHLAuthCredentials.objects.first(),
+    refresh=_refresh_ghl_credentials,
+    expires_at=credentials_expire_at,
+    get_token=lambda auth: auth.access_token,
+    refresh_before=AUTH_CACHE_EXPIRY_MARGIN,
+)
 
 
 def get_ghl_headers():
@@ -128,11 +215,8 @@ def get_ghl_contact(contact_id):
     if not access_token or not location_id:
         return None
     
-    headers = get_ghl_headers()
-    
     try:
-        url = f"{GHL_BASE_URL}/contacts/{contact_id}"
-        response = requests.get(url, headers=headers, timeout=10)
+        response = get_ghl_client().get(f"/contacts/{contact_id}", timeout=10)
         
         if response.status_code == 200:
             result = response.json()
@@ -150,6 +234,43 @@ def get_ghl_contact(contact_id):
         return None
 
 
+def find_ghl_duplicate_contact(email=None, phone=None):
+    """
+    Find the GHL contact that GHL considers a duplicate of this email/phone.
+    
+    Uses GHL's duplicate search, which applies the location's duplicate
+    rules (email and phone matching) like contact creation does.
+    
+    Args:
+        email: Contact email
+        phone: Contact phone (as sent to GHL)
+    
+    Returns:
+        dict: Existing contact data if found, None otherwise
+    """
+    access_token, location_id = get_ghl_auth()
+    
+    if not access_token or not location_id or not (email or phone):
+        return None
+    
+    params = {"locationId": location_id}
+    if email:
+        params["email"] = email
+    if phone:
+        params["number"] = phone
+    
+    try:
+        response = get_ghl_client().get("/contacts/search/duplicate", params=params, timeout=10)
+        
+        if response.status_code == 200:
+            return response.json().get("contact") or None
+        logger.warning(f"Error searching duplicate GHL contact: {response.status_code}")
+        return None
+    except Exception as e:
+        logger.error(f"Error searching duplicate GHL contact: {str(e)}")
+        return None
+
+
 def create_ghl_contact(contact_data):
     """
     Create a new contact in GHL.
@@ -166,14 +287,11 @@ def create_ghl_contact(contact_data):
         logger.error("GHL authentication not available")
         return {"error": "Authentication not available"}
     
-    headers = get_ghl_headers()
-    
     # Ensure locationId is in the payload
     contact_data['locationId'] = location_id
     
     try:
-        url = f"{GHL_BASE_URL}/contacts/"
-        response = requests.post(url, json=contact_data, headers=headers, timeout=10)
+        response = get_ghl_client().post("/contacts/", json=contact_data, timeout=10)
         
         if response.status_code in [200, 201]:
             result = response.json()
@@ -186,14 +304,20 @@ def create_ghl_contact(contact_data):
                 return result
         else:
             error_text = response.text
+            error_meta = None
             try:
                 error_data = response.json()
                 error_message = error_data.get('message', error_text)
+                error_meta = error_data.get('meta')
             except:
                 error_message = error_text
             
             logger.error(f"Error creating GHL contact: {response.status_code} - {error_message}")
-            return {"error": error_message, "status_code": response.status_code}
+            error = {"error": error_message, "status_code": response.status_code}
+            # Duplicate errors name the existing contact in meta.contactId
+            if error_meta:
+                error["meta"] = error_meta
+            return error
     except Exception as e:
         logger.error(f"Exception creating GHL contact: {str(e)}")
         return {"error": str(e)}
@@ -216,14 +340,11 @@ def update_ghl_contact(contact_id, contact_data):
         logger.error("GHL authentication not available")
         return {"error": "Authentication not available"}
     
-    headers = get_ghl_headers()
-    
     # Don't include locationId in update (not needed)
     contact_data.pop('locationId', None)
     
     try:
-        url = f"{GHL_BASE_URL}/contacts/{contact_id}"
-        response = requests.put(url, json=contact_data, headers=headers, timeout=10)
+        response = get_ghl_client().put(f"/contacts/{contact_id}", json=contact_data, timeout=10)
         
         if response.status_code == 200:
             result = response.json()
@@ -0,0 +1,155 @@
+"""
+Failure ledger of the GHL push (SyncFailure rows).
+
+Rows GHL rejects for a reason retrying will not fix (4xx responses,
+duplicates that could not be linked, appointments without a GHL contact)
+are recorded with an attempt count and the time they may be pushed again,
+doubling the delay per attempt. The tasks and commands leave rows in
+backoff out of their push (exclude_backed_off), so they stop costing API
+calls every run. Transient failures (network errors, 5xx, 429) are not
+recorded: the next run simply retries them.
+
+An entry is cleared when its row is pushed successfully or changes in
+e-Physio, or with manage.py sync_failures --reset.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from ghl_accounts.models import SyncFailure
+
+logger = logging.getLogger(__name__)
+
+# 4xx responses that can succeed on a later run
+RETRYABLE_STATUS_CODES = {401, 408, 429}
+
+
+def is_permanent_failure(result):
+    """
+    Tell whether a push result should go into the failure ledger.
+
+    Args:
+        result: Result dict of push_contact() / push_appointment()
+
+    Returns:
+        bool: True for skipped rows, errors marked 'permanent' and errors
+        with a non-retryable 4xx status code
+    """
+    status = result.get('status')
+    if status == 'skipped':
+        return True
+    if status != 'error':
+        return False
+    if result.get('permanent'):
+        return True
+
+    status_code = result.get('status_code')
+    return (
+        status_code is not None
+        and 400 <= status_code < 500
+        and status_code not in RETRYABLE_STATUS_CODES
+    )
+
+
+def backoff_delay(attempts):
+    """Seconds to wait before the next push of a row that failed attempts times."""
+    return min(
+        settings.GHL_PUSH_BACKOFF_BASE * 2 ** max(attempts - 1, 0),
+        settings.GHL_PUSH_BACKOFF_MAX
+    )
+
+
+def exclude_backed_off(queryset, entity, now=None):
+    """
+    Leave rows that are in backoff or dead letters out of a push queryset.
+
+    Args:
+        queryset: ContactSync / AppointmentSync queryset
+        entity: "contact" or "appointment"
+        now: Reference time (default: timezone.now())
+
+    Returns:
+        QuerySet: queryset without the blocked rows (one NOT IN subquery)
+    """
+    blocked = SyncFailure.objects.filter(entity=entity).filter(
+        Q(dead=True) | Q(next_attempt_at__gt=now or timezone.now())
+    ).values('record_id')
+    return queryset.exclude(id__in=blocked)
+
+
+def record_failures(entity, failures, now=None):
+    """
+    Count one more failed attempt for each row and schedule its next push.
+
+    Args:
+        entity: "contact" or "appointment"
+        failures: {record_id: push result dict}
+        now: Time of the failure (default: timezone.now())
+
+    Returns:
+        int: Number of rows that just became dead letters
+    """
+    if not failures:
+        return 0
+
+    now = now or timezone.now()
+    existing = {
+        entry.record_id: entry
+        for entry in SyncFailure.objects.filter(entity=entity, record_id__in=list(failures))
+    }
+
+    new_entries = []
+    changed_entries = []
+    dead = 0
+    for record_id, result in failures.items():
+        entry = existing.get(record_id) or SyncFailure(entity=entity, record_id=record_id)
+        was_dead = entry.dead
+        entry.attempts += 1
+        entry.last_error = str(result.get('error') or result.get('status'))[:2000]
+        entry.last_status_code = result.get('status_code')
+        entry.last_failed_at = now
+        entry.next_attempt_at = now + timedelta(seconds=backoff_delay(entry.attempts))
+        entry.dead = entry.attempts >= settings.GHL_PUSH_MAX_ATTEMPTS
+        if entry.dead and not was_dead:
+            dead += 1
+        (changed_entries if entry.pk else new_entries).append(entry)
+
+    # ignore_conflicts: a concurrent run may have recorded the same row meanwhile
+    SyncFailure.objects.bulk_create(new_entries, batch_size=500, ignore_conflicts=True)
+    SyncFailure.objects.bulk_update(
+        changed_entries,
+        ['attempts', 'last_error', 'last_status_code', 'last_failed_at', 'next_attempt_at', 'dead'],
+        batch_size=500
+    )
+
+    if dead:
+        logger.warning(f"{dead} {entity} rows became dead letters after {settings.GHL_PUSH_MAX_ATTEMPTS} failed GHL pushes")
+    return dead
+
+
+def clear_failures(entity, record_ids, chunk_size=1000):
+    """
+    Remove the ledger entries of rows that were pushed or changed.
+
+    Args:
+        entity: "contact" or "appointment"
+        record_ids: Iterable of ContactSync / AppointmentSync ids
+
+    Returns:
+        int: Number of entries removed
+    """
+    record_ids = list(record_ids)
+    # Most runs have nothing in the ledger: skip the deletes then
+    if not record_ids or not SyncFailure.objects.filter(entity=entity).exists():
+        return 0
+
+    removed = 0
+    for start in range(0, len(record_ids), chunk_size):
+        deleted, _ = SyncFailure.objects.filter(
+            entity=entity, record_id__in=record_ids[start:start + chunk_size]
+        ).delete()
+        removed += deleted
+    return removed
@@ -0,0 +1,370 @@
+"""
+Mapping of e-Physio records onto ContactSync / AppointmentSync rows.
+
+Shared by the hourly Celery tasks and the sync_ephysio_* commands. Every
+mapped row carries a fingerprint of its source data (source_hash) so runs
+can skip rows that did not change since the last sync.
+
+Rows are written with one INSERT ... ON CONFLICT ... DO UPDATE statement per
+batch (PostgreSQL). The update only fires when the fingerprint differs, so
+unchanged rows are never rewritten, and the statement reports each row's
+outcome and whether it still has to be pushed to GHL; those rows are added
+to the push outbox in the same transaction. Input may be any
+iterable (including a streamed e-Physio response); it is consumed in
+fixed-size batches.
+
+Each run records its row outcomes and the time spent per stage in metrics:
+fetch (waiting for input records), diff (mapping and fingerprinting) and
+db_write (the upsert statements, where unchanged rows are filtered out).
+"""
+import hashlib
+import json
+import logging
+import re
+from itertools import islice
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from e_physio_integration import metrics
+from ephysio.services.appointments import epoch_ms_to_datetime
+from ephysio.utils import normalize_phone
+from ghl_accounts.models import AppointmentSync, ContactSync
+from ghl_accounts.services.failures import clear_failures
+from ghl_accounts.services.outbox import enqueue
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# ContactSync columns filled from an e-Physio patient
+CONTACT_SOURCE_FIELDS = [
+    'phone', 'normalized_phone', 'email', 'first_name', 'last_name',
+    'salutation', 'street', 'zip', 'city', 'birth_date', 'sex'
+]
+
+# AppointmentSync columns filled from an e-Physio event
+APPOINTMENT_SOURCE_FIELDS = [
+    'start_time', 'end_time', 'status', 'event_type_id',
+    'user_id', 'client_id', 'admin_info_id', 'ephysio_patient_id',
+    'ghl_contact_id'
+]
+
+
+def compute_fingerprint(fields):
+    """
+    Return a stable SHA-256 hex digest of a dict of mapped column values.
+    """
+    canonical = json.dumps(fields, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def fit_to_columns(model, key, fields):
+    """
+    Cut string values longer than their column down to the column length.
+
+    Each cut value is logged, so an oversized e-Physio value shows up in the
+    logs instead of failing the whole batch or being cut by the database
+    unnoticed. Call before compute_fingerprint(), so the fingerprint matches
+    the stored values.
+
+    Args:
+        model: ContactSync or AppointmentSync
+        key: e-Physio ID of the record (for the log message)
+        fields: Mapped column values, updated in place
+
+    Returns:
+        dict: fields
+    """
+    for name, value in fields.items():
+        max_length = getattr(model._meta.get_field(name), 'max_length', None)
+        if isinstance(value, str) and max_length and len(value) > max_length:
+            logger.warning(
+                f"{model.__name__} {key}: {name} is {len(value)} characters long, "
+                f"truncated to {max_length}"
+            )
+            fields[name] = value[:max_length]
+    return fields
+
+
+def contact_fields_from_patient(patient):
+    """
+    Map an e-Physio patient dict to ContactSync column values.
+
+    Returns:
+        dict: Values for CONTACT_SOURCE_FIELDS
+    """
+    phone = patient.get('phone', '') or None
+    return {
+        'phone': phone,
+        'normalized_phone': normalize_phone(phone),
+        'email': patient.get('email', '') or None,
+        'first_name': patient.get('firstName', '') or None,
+        'last_name': patient.get('lastName', '') or None,
+        'salutation': patient.get('salutation', '') or None,
+        'street': patient.get('street', '') or None,
+        'zip': patient.get('zip', '') or None,
+        'city': patient.get('city', '') or None,
+        'birth_date': patient.get('birthDate', '') or None,
+        'sex': patient.get('sex'),
+    }
+
+
+def appointment_fields_from_event(appointment, ghl_contact_id):
+    """
+    Map an e-Physio event dict to AppointmentSync column values.
+
+    Args:
+        appointment: e-Physio event dict
+        ghl_contact_id: GHL contact linked to the event's patient (or None)
+
+    Returns:
+        dict: Values for APPOINTMENT_SOURCE_FIELDS, or None if the event has
+        no usable start/end time
+    """
+    start_time = epoch_ms_to_datetime(appointment.get('start'))
+    end_time = epoch_ms_to_datetime(appointment.get('end'))
+
+    if not start_time or not end_time:
+        return None
+
+    return {
+        'start_time': start_time,
+        'end_time': end_time,
+        'status': str(appointment.get('status', '')) or None,
+        'event_type_id': appointment.get('eventTypeId'),
+        'user_id': appointment.get('user_id'),
+        'client_id': appointment.get('clientId'),
+        'admin_info_id': appointment.get('adminInfoId'),
+        'ephysio_patient_id': str(appointment.get('patientId')),
+        'ghl_contact_id': ghl_contact_id,
+    }
+
+
+# Rows still waiting for their GHL push (see upsert_* 'pending_ids')
+CONTACT_PENDING_SQL = "t.ghl_contact_id IS NULL"
+APPOINTMENT_PENDING_SQL = "t.ghl_appointment_id IS NULL AND t.ghl_contact_id IS NOT NULL"
+
+
+def _upsert_batch(model, key_field, source_fields, rows, pending_sql):
+    """
+    Upsert one batch of (key, fields, fingerprint) rows in a single statement.
+
+    New keys are inserted with source 'ephysio'; existing rows are updated
+    only when their source_hash differs (a row created from a GHL webhook keeps
+    its source). The trailing SELECT reports the rows the upsert left alone,
+    so every key in the batch comes back exactly once.
+
+    Returns:
+        list: (id, status, needs_push) tuples, status being 'created',
+        'updated' or 'unchanged'
+    """
+    table = model._meta.db_table
+    columns = [key_field] + source_fields + ['source_hash']
+    # Explicit casts so NULL-only columns in VALUES get the right type. The
+    # length modifier is dropped (varchar(20) -> varchar): casting to
+    # varchar(n) silently cuts longer values, while the column itself
+    # rejects them
+    casts = [
+        re.sub(r'\(\d+\)$', '', model._meta.get_field(column).db_type(connection))
+        for column in columns
+    ]
+
+    placeholders = "(" + ", ".join(f"%s::{cast}" for cast in casts) + ")"
+    values_sql = ", ".join([placeholders] * len(rows))
+    params = []
+    for key, fields, fingerprint in rows:
+        params.append(key)
+        params.extend(fields[name] for name in source_fields)
+        params.append(fingerprint)
+
+    column_list = ", ".join(columns)
+    input_columns = ", ".join(f"i.{column}" for column in columns)
+    update_sql = ", ".join(
+        f"{column} = EXCLUDED.{column}" for column in source_fields + ['source_hash']
+    )
+
+    sql = f"""
+        WITH input ({column_list}) AS (VALUES {values_sql}),
+        up AS (
+            INSERT INTO {table} AS t ({column_list}, source, last_synced_at, created_at)
+            SELECT {input_columns}, 'ephysio', %s, %s FROM input i
+            ON CONFLICT ({key_field}) DO UPDATE SET
+                {update_sql},
+                source = CASE
+                    WHEN t.source IS NULL OR t.source IN ('', 'ephysio') THEN 'ephysio'
+                    ELSE t.source
+                END,
+                last_synced_at = EXCLUDED.last_synced_at
+            WHERE t.source_hash IS DISTINCT FROM EXCLUDED.source_hash
+            RETURNING t.id, (t.xmax = 0) AS inserted, ({pending_sql}) AS needs_push
+        )
+        SELECT id, CASE WHEN inserted THEN 'created' ELSE 'updated' END, needs_push FROM up
+        UNION ALL
+        SELECT t.id, 'unchanged', ({pending_sql})
+        FROM {table} t JOIN input i ON t.{key_field} = i.{key_field}
+        WHERE NOT EXISTS (SELECT 1 FROM up WHERE up.id = t.id)
+    """
+    now = timezone.now()
+    params.extend([now, now])
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def iter_batches(records, batch_size):
+    """Yield lists of up to batch_size items from any iterable (e.g. a streamed response)."""
+    iterator = iter(records)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _record_ingest_metrics(entity, stats, timer):
+    for outcome in ('created', 'updated', 'unchanged'):
+        metrics.increment('sync_rows_total', {'entity': entity, 'outcome': outcome}, stats[outcome])
+    timer.record()
+
+
+def _upsert_rows(entity, model, key_field, source_fields, rows, pending_sql, stats):
+    """
+    Upsert one batch of rows and add the outcome to stats.
+
+    Rows still waiting for their GHL push are added to the outbox in the
+    same transaction. Changed rows get another push attempt right away:
+    their failure ledger entries (if any) are cleared.
+    """
+    # A key may only appear once per statement; the last occurrence wins
+    rows = list({key: (key, fields, fingerprint) for key, fields, fingerprint in rows}.values())
+    if not rows:
+        return
+
+    with transaction.atomic():
+        results = _upsert_batch(model, key_field, source_fields, rows, pending_sql)
+        # Outbox entries commit together with the rows (see services/outbox.py)
+        pending_ids = [row_id for row_id, _, needs_push in results if needs_push]
+        enqueue(entity, pending_ids)
+
+    stats['pending_ids'].extend(pending_ids)
+    updated_ids = []
+    for row_id, status, _ in results:
+        stats[status] += 1
+        if status == 'updated':
+            updated_ids.append(row_id)
+
+    clear_failures(entity, updated_ids)
+
+
+def upsert_contacts(patients, batch_size=DEFAULT_BATCH_SIZE, on_batch=None):
+    """
+    Insert or update ContactSync rows for e-Physio patients.
+
+    Patients are consumed batch_size at a time, so a streamed iterator
+    (iter_active_patients) is never fully held in memory.
+
+    Args:
+        patients: Iterable of e-Physio patient dicts
+        batch_size: Rows per upsert statement
+        on_batch: Optional callback(batch_number, batch_len, stats) for progress output
+
+    Returns:
+        dict: 'total' patients read, 'created', 'updated' and 'unchanged'
+        counts and 'pending_ids' (ContactSync ids without a GHL contact yet,
+        queued in the outbox)
+    """
+    stats = {'total': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'pending_ids': []}
+    timer = metrics.StageTimer('contact')
+    batches = timer.timed_iter('fetch', iter_batches(patients, batch_size))
+
+    for batch_number, batch in enumerate(batches, start=1):
+        stats['total'] += len(batch)
+
+        with timer.stage('diff'):
+            rows = []
+            for patient in batch:
+                if not patient.get('id'):
+                    continue
+                key = str(patient.get('id'))
+                fields = fit_to_columns(ContactSync, key, contact_fields_from_patient(patient))
+                rows.append((key, fields, compute_fingerprint(fields)))
+
+        with timer.stage('db_write'):
+            _upsert_rows(
+                'contact', ContactSync, 'ephysio_patient_id', CONTACT_SOURCE_FIELDS, rows,
+                CONTACT_PENDING_SQL, stats
+            )
+
+        if on_batch:
+            on_batch(batch_number, len(batch), stats)
+
+    _record_ingest_metrics('contact', stats, timer)
+    return stats
+
+
+def upsert_appointments(appointments, batch_size=DEFAULT_BATCH_SIZE, on_batch=None):
+    """
+    Insert or update AppointmentSync rows for e-Physio events.
+
+    Events are consumed batch_size at a time, so a lazy iterator
+    (iter_ephysio_appointments_sharded) is never fully held in memory. Each
+    event is linked to the GHL contact of its patient when that patient is
+    already synced. The links are looked up per batch, not for the whole table.
+
+    Args:
+        appointments: Iterable of e-Physio event dicts
+        batch_size: Rows per upsert statement
+        on_batch: Optional callback(batch_number, batch_len, stats) for progress output
+
+    Returns:
+        dict: 'total' events read, 'created', 'updated' and 'unchanged'
+        counts, 'linked_to_ghl' and 'pending_ids' (AppointmentSync ids with a
+        GHL contact but no GHL appointment yet, queued in the outbox)
+    """
+    stats = {
+        'total': 0, 'created': 0, 'updated': 0, 'unchanged': 0,
+        'linked_to_ghl': 0, 'pending_ids': []
+    }
+
+    timer = metrics.StageTimer('appointment')
+    batches = timer.timed_iter('fetch', iter_batches(appointments, batch_size))
+
+    for batch_number, batch in enumerate(batches, start=1):
+        stats['total'] += len(batch)
+
+        with timer.stage('diff'):
+            batch = [a for a in batch if a.get('id') and a.get('patientId')]
+
+            patient_ids = {str(a.get('patientId')) for a in batch}
+            ghl_contact_ids = dict(
+                ContactSync.objects.filter(
+                    ephysio_patient_id__in=patient_ids,
+                    ghl_contact_id__isnull=False
+                ).values_list('ephysio_patient_id', 'ghl_contact_id')
+            ) if patient_ids else {}
+
+            rows = []
+            for appointment in batch:
+                ghl_contact_id = ghl_contact_ids.get(str(appointment.get('patientId')))
+                fields = appointment_fields_from_event(appointment, ghl_contact_id)
+                if not fields:
+                    continue
+                if ghl_contact_id:
+                    stats['linked_to_ghl'] += 1
+                key = str(appointment.get('id'))
+                fit_to_columns(AppointmentSync, key, fields)
+                rows.append((key, fields, compute_fingerprint(fields)))
+
+        with timer.stage('db_write'):
+            _upsert_rows(
+                'appointment', AppointmentSync, 'ephysio_appointment_id', APPOINTMENT_SOURCE_FIELDS,
+                rows, APPOINTMENT_PENDING_SQL, stats
+            )
+
+        if on_batch:
+            on_batch(batch_number, len(batch), stats)
+
+    _record_ingest_metrics('appointment', stats, timer)
+    return stats
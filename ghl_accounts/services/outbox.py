@@ -0,0 +1,196 @@
+"""
+Transactional outbox of the GHL push (PushOutbox rows).
+
+Ingestion only records which rows need a push (enqueue(), called inside the
+upsert transaction); the dispatch_ghl_outbox task pushes them. So ingestion
+and push run at their own pace, a crash between the two loses nothing, and
+finding pending work never needs a table scan.
+
+The dispatcher claims entries in batches with FOR UPDATE SKIP LOCKED and a
+lease (claimed_until), so concurrent dispatchers never push the same row and
+entries of a crashed run become available again once the lease expires.
+Rows are pushed with the concurrent, rate-limited push of services/push.py.
+Afterwards an entry is deleted, unless its push failed transiently: then it
+is retried after GHL_OUTBOX_RETRY_DELAY seconds, doubled per attempt.
+Permanent failures go into the failure ledger (services/failures.py) instead.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from ghl_accounts.models import AppointmentSync, ContactSync, PushOutbox
+from ghl_accounts.services.failures import exclude_backed_off, is_permanent_failure
+from ghl_accounts.services.push import (
+    APPOINTMENT_PUSH_FIELDS,
+    CONTACT_PUSH_FIELDS,
+    push_appointments_to_ghl,
+    push_contacts_to_ghl
+)
+
+logger = logging.getLogger(__name__)
+
+# Entities in dispatch order (appointments need their contact in GHL first):
+# entity -> (model, push fields, still-pending filter, push function)
+OUTBOX_ENTITIES = {
+    'contact': (
+        ContactSync, CONTACT_PUSH_FIELDS,
+        {'ghl_contact_id__isnull': True},
+        push_contacts_to_ghl,
+    ),
+    'appointment': (
+        AppointmentSync, APPOINTMENT_PUSH_FIELDS,
+        {'ghl_appointment_id__isnull': True, 'ghl_contact_id__isnull': False},
+        push_appointments_to_ghl,
+    ),
+}
+
+# Longest delay before a transient failure is retried
+MAX_RETRY_DELAY = 3600
+
+
+def enqueue(entity, record_ids):
+    """
+    Add rows to the outbox (rows already in it are left as they are).
+
+    Call it in the transaction that changed the rows, so the entries are
+    committed (or rolled back) together with them.
+
+    Args:
+        entity: "contact" or "appointment"
+        record_ids: Iterable of ContactSync / AppointmentSync ids
+    """
+    entries = [PushOutbox(entity=entity, record_id=record_id) for record_id in record_ids]
+    PushOutbox.objects.bulk_create(entries, batch_size=1000, ignore_conflicts=True)
+
+
+def claim(entity, limit, lease_seconds=None):
+    """
+    Claim up to limit available entries for this dispatcher.
+
+    Returns:
+        list: (outbox id, record_id) tuples, oldest first
+    """
+    lease_seconds = lease_seconds or settings.GHL_OUTBOX_CLAIM_SECONDS
+    now = timezone.now()
+    table = PushOutbox._meta.db_table
+
+    sql = f"""
+        UPDATE {table} SET claimed_until = %s
+        WHERE id IN (
+            SELECT id FROM {table}
+            WHERE entity = %s
+              AND available_at <= %s
+              AND (claimed_until IS NULL OR claimed_until < %s)
+            ORDER BY available_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, record_id
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, [now + timedelta(seconds=lease_seconds), entity, now, now, limit])
+        return sorted(cursor.fetchall())
+
+
+def _retry_later(entries, results, now):
+    """Release entries whose push failed transiently, available again after a delay."""
+    for entry in entries:
+        result = results[entry.record_id]
+        entry.attempts += 1
+        entry.last_error = str(result.get('error'))[:2000]
+        entry.claimed_until = None
+        delay = min(settings.GHL_OUTBOX_RETRY_DELAY * 2 ** (entry.attempts - 1), MAX_RETRY_DELAY)
+        entry.available_at = now + timedelta(seconds=delay)
+
+    PushOutbox.objects.bulk_update(
+        entries, ['attempts', 'last_error', 'claimed_until', 'available_at'], batch_size=500
+    )
+
+
+def dispatch_batch(entity, claimed, workers=None, rate=None):
+    """
+    Push the rows of claimed outbox entries and settle the entries.
+
+    Rows that are gone, already in GHL or in failure backoff are not pushed;
+    their entries are dropped.
+
+    Args:
+        entity: "contact" or "appointment"
+        claimed: (outbox id, record_id) tuples from claim()
+        workers: Push thread count (default: settings.GHL_PUSH_WORKERS)
+        rate: Max rows pushed per second (default: settings.GHL_PUSH_RATE_LIMIT, 0: no cap)
+
+    Returns:
+        dict: Push stats (see run_concurrently()) plus 'retry_later'
+    """
+    model, fields, pending_filter, push = OUTBOX_ENTITIES[entity]
+    record_ids = [record_id for _, record_id in claimed]
+
+    rows = exclude_backed_off(
+        model.objects.filter(id__in=record_ids, **pending_filter), entity
+    ).only(*fields)
+
+    results = {}
+
+    def collect(item, result, processed):
+        results[item.id] = result
+
+    stats = push(rows, workers=workers, rate=rate, on_result=collect)
+
+    transient = {
+        record_id for record_id, result in results.items()
+        if result['status'] == 'error' and not is_permanent_failure(result)
+    }
+    retry_entries = list(PushOutbox.objects.filter(
+        id__in=[outbox_id for outbox_id, record_id in claimed if record_id in transient]
+    ))
+    if retry_entries:
+        _retry_later(retry_entries, results, timezone.now())
+
+    PushOutbox.objects.filter(
+        id__in=[outbox_id for outbox_id, record_id in claimed if record_id not in transient]
+    ).delete()
+
+    stats['retry_later'] = len(retry_entries)
+    return stats
+
+
+def dispatch(entity, deadline=None, batch_size=None, workers=None, rate=None):
+    """
+    Drain the outbox of one entity, batch by batch.
+
+    Args:
+        entity: "contact" or "appointment"
+        deadline: time.monotonic() value after which no new batch is claimed
+        batch_size: Entries per claim (default: settings.GHL_OUTBOX_BATCH_SIZE)
+        workers, rate: See dispatch_batch()
+
+    Returns:
+        dict: Push stats summed over all batches, plus 'claimed' and
+        'retry_later'
+    """
+    batch_size = batch_size or settings.GHL_OUTBOX_BATCH_SIZE
+    totals = {'claimed': 0, 'retry_later': 0}
+
+    while deadline is None or time.monotonic() < deadline:
+        claimed = claim(entity, batch_size)
+        if not claimed:
+            break
+
+        stats = dispatch_batch(entity, claimed, workers=workers, rate=rate)
+        totals['claimed'] += len(claimed)
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+
+        logger.info(f"Outbox {entity} batch of {len(claimed)} dispatched: {stats}")
+
+    return totals
+
+
+def pending_count(entity):
+    """Number of outbox entries of an entity (claimed or not)."""
+    return PushOutbox.objects.filter(entity=entity).count()
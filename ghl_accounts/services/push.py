@@ -0,0 +1,556 @@
+"""
+Concurrent, rate-limited push of ContactSync / AppointmentSync rows to GHL.
+
+Shared by the outbox dispatcher (services/outbox.py) and the sync_*_to_ghl
+management commands. Rows are pushed from a thread pool; every GHL request
+takes a token of the location's shared rate limit, which follows the quota
+GHL reports (e_physio_integration/rate_limit.py, services/client.py). The
+number of pushes in flight starts at GHL_PUSH_WORKERS and is halved whenever
+GHL answers 429, then grows back one at a time (AdaptiveConcurrency), so
+throughput settles just under the real limit. GHL_PUSH_RATE_LIMIT optionally
+caps a run's rows per second. The GHL IDs returned are written back from
+the calling thread in bulk_update batches (WriteBackBuffer) instead of one
+UPDATE per row from every worker; a row whose ID cannot be saved counts as
+an error, not as pushed.
+
+Every push records its outcomes and duration (stage ghl_push) in metrics;
+update_backlog_gauges() refreshes the count of rows still waiting. Rows GHL
+rejects permanently go into the failure ledger (services/failures.py).
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Condition, Lock
+
+from django.conf import settings
+
+from e_physio_integration import metrics, rate_limit
+from e_physio_integration.rate_limit import LocalTokenBucket
+from ghl_accounts.models import AppointmentSync, ContactSync
+from ghl_accounts.services.appointments import create_ghl_appointment
+from ghl_accounts.services.contacts import (
+    build_ghl_contact_payload,
+    create_ghl_contact,
+    find_ghl_duplicate_contact,
+    update_ghl_contact
+)
+from ghl_accounts.services.failures import clear_failures, is_permanent_failure, record_failures
+
+logger = logging.getLogger(__name__)
+
+# Columns the payload builders and the write-back need; load push rows with
+# .only(*CONTACT_PUSH_FIELDS) / .only(*APPOINTMENT_PUSH_FIELDS)
+CONTACT_PUSH_FIELDS = [
+    'id', 'ghl_contact_id', 'first_name', 'last_name', 'email', 'phone',
+    'birth_date', 'street', 'city', 'zip'
+]
+APPOINTMENT_PUSH_FIELDS = [
+    'id', 'ghl_appointment_id', 'ghl_contact_id', 'ephysio_appointment_id',
+    'ephysio_patient_id', 'start_time', 'end_time', 'status'
+]
+
+# Error fragments GHL uses when the record already exists
+CONTACT_DUPLICATE_ERRORS = ['duplicate', 'already exists', 'does not allow duplicated']
+APPOINTMENT_DUPLICATE_ERRORS = ['duplicate', 'already exists', 'conflict']
+
+
+class AdaptiveConcurrency:
+    """
+    Limit on pushes in flight that follows GHL throttling (AIMD).
+
+    Used as a context manager around each push. When GHL answered 429 (in
+    this process) since the last push finished, the limit is halved; after
+    `limit` pushes in a row without one it grows by one, up to maximum.
+    Waiting pushes block on a condition, not on a held lock.
+    """
+
+    def __init__(self, maximum, api="ghl"):
+        self.maximum = maximum
+        self.limit = maximum
+        self.api = api
+        self.active = 0
+        self.clean_streak = 0
+        self.throttles_seen = rate_limit.throttle_count(api)
+        self.condition = Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.condition:
+            self.active -= 1
+            self._adjust()
+            self.condition.notify_all()
+        return False
+
+    def _adjust(self):
+        throttles = rate_limit.throttle_count(self.api)
+        if throttles != self.throttles_seen:
+            self.throttles_seen = throttles
+            self.clean_streak = 0
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                logger.info(f"GHL is throttling, pushing at most {self.limit} rows at a time")
+        else:
+            self.clean_streak += 1
+            if self.clean_streak >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.clean_streak = 0
+        metrics.set_gauge('ghl_push_concurrency', self.limit, {'api': self.api})
+
+
+class WriteBackBuffer:
+    """
+    Collect rows whose GHL ID was set and persist them with bulk_update.
+
+    Flushes every batch_size rows or interval seconds (checked on add), and
+    when used as a context manager also on exit - including on errors - so
+    IDs already created in GHL are not lost. Rows that could not be saved are
+    returned by add() / flush(), so the caller can count them as errors.
+    """
+
+    def __init__(self, model, fields, batch_size=None, interval=None):
+        self.model = model
+        self.fields = fields
+        self.batch_size = batch_size or settings.GHL_WRITE_BACK_BATCH_SIZE
+        self.interval = interval if interval is not None else settings.GHL_WRITE_BACK_INTERVAL
+        self.rows = []
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
+
+    def add(self, row):
+        """Buffer a row; returns flush()'s failures if this add flushed, else {}."""
+        with self.lock:
+            self.rows.append(row)
+            due = (
+                len(self.rows) >= self.batch_size
+                or time.monotonic() - self.last_flush >= self.interval
+            )
+        if due:
+            return self.flush()
+        return {}
+
+    def flush(self):
+        """
+        Write all buffered rows.
+
+        Returns:
+            dict: {row id: error message} of the rows that could not be saved
+        """
+        with self.lock:
+            rows, self.rows = self.rows, []
+            self.last_flush = time.monotonic()
+
+        if not rows:
+            return {}
+
+        try:
+            self.model.objects.bulk_update(rows, self.fields, batch_size=self.batch_size)
+            return {}
+        except Exception as e:
+            # One bad row (e.g. a GHL ID already linked elsewhere) must not lose the rest
+            logger.warning(
+                f"Bulk write-back of {len(rows)} {self.model.__name__} rows failed, "
+                f"saving one by one: {str(e)}"
+            )
+
+        failed = {}
+        for row in rows:
+            try:
+                row.save(update_fields=self.fields)
+            except Exception as e:
+                logger.error(f"Could not save GHL ID for {self.model.__name__} {row.id}: {str(e)}")
+                failed[row.id] = str(e)
+        return failed
+
+
+def run_concurrently(items, handler, workers=None, rate=None, on_result=None, write_back=None):
+    """
+    Call handler(item) for every item from a thread pool.
+
+    Concurrency adapts to GHL throttling (see AdaptiveConcurrency).
+
+    Args:
+        items: Iterable of rows to push
+        handler: Callable returning a result dict with a 'status' key
+        workers: Max concurrent handler calls (default: settings.GHL_PUSH_WORKERS)
+        rate: Max handler calls per second of this run (default:
+            settings.GHL_PUSH_RATE_LIMIT; 0: no cap besides the shared GHL
+            rate limit)
+        on_result: Optional callback(item, result, processed) run in the
+            calling thread as results complete (progress output). Called a
+            second time, with a permanent error result, for an item whose
+            GHL ID could not be written back
+        write_back: Optional WriteBackBuffer; items whose result has
+            'write_back' set are added to it and it is flushed before
+            returning. Items it fails to save count as 'errors', not as
+            their push status
+
+    Returns:
+        dict: Count of results per status ('created', 'updated', 'linked',
+        'skipped', 'errors' and any other status the handler returns)
+    """
+    workers = workers or settings.GHL_PUSH_WORKERS
+    rate = rate or settings.GHL_PUSH_RATE_LIMIT
+    rate_limiter = LocalTokenBucket(rate) if rate else None
+    concurrency = AdaptiveConcurrency(workers)
+
+    def limited(item):
+        with concurrency:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            return handler(item)
+
+    stats = {'created': 0, 'updated': 0, 'linked': 0, 'skipped': 0, 'errors': 0}
+    processed = 0
+
+    future_to_item = {}
+    handled = set()
+    # Items waiting in write_back, with the status they were counted under
+    buffered = {}
+
+    def write_back_failed(failed):
+        # Pushed to GHL but the ID was not saved: the row is not synced
+        for row_id, error in failed.items():
+            item, status = buffered.pop(row_id)
+            stats[status] -= 1
+            stats['errors'] += 1
+            if on_result:
+                on_result(item, {
+                    'status': 'error',
+                    'error': f'GHL ID could not be saved: {error}',
+                    'permanent': True
+                }, processed)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_item = {executor.submit(limited, item): item for item in items}
+
+            try:
+                for future in as_completed(future_to_item):
+                    handled.add(future)
+                    item = future_to_item[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Exception pushing {item.__class__.__name__} {item.id} to GHL: {str(e)}")
+                        result = {'status': 'error', 'error': str(e)}
+
+                    status = 'errors' if result['status'] == 'error' else result['status']
+                    stats[status] = stats.get(status, 0) + 1
+                    processed += 1
+
+                    if on_result:
+                        on_result(item, result, processed)
+
+                    if write_back is not None and result.get('write_back'):
+                        buffered[item.id] = (item, status)
+                        write_back_failed(write_back.add(item))
+            except BaseException:
+                # Don't start queued pushes once the run is aborted
+                for future in future_to_item:
+                    future.cancel()
+                raise
+    finally:
+        if write_back is not None:
+            # Keep IDs of pushes that completed after the loop was aborted
+            for future, item in future_to_item.items():
+                if future in handled or not future.done() or future.cancelled():
+                    continue
+                if future.exception() is None and future.result().get('write_back'):
+                    write_back.add(item)
+            failed = write_back.flush()
+            write_back_failed({row_id: error for row_id, error in failed.items() if row_id in buffered})
+
+    return stats
+
+
+def _is_duplicate_error(result, fragments):
+    error_msg = result.get('error', '') if isinstance(result, dict) else str(result)
+    error_lower = (error_msg or '').lower()
+    return any(fragment in error_lower for fragment in fragments)
+
+
+def _error_message(result, default):
+    return result.get('error', default) if isinstance(result, dict) else default
+
+
+def _error_result(result, default):
+    """Error push result, keeping the HTTP status code for the failure ledger."""
+    error = {'status': 'error', 'error': _error_message(result, default)}
+    if isinstance(result, dict) and result.get('status_code'):
+        error['status_code'] = result['status_code']
+    return error
+
+
+def find_duplicate_contact_id(result, payload):
+    """
+    Return the ID of the existing GHL contact a create was rejected for.
+
+    GHL names it in the error's meta.contactId; otherwise it is looked up
+    with GHL's duplicate search by the payload's email and phone.
+    """
+    meta = result.get('meta') if isinstance(result, dict) else None
+    if isinstance(meta, dict) and meta.get('contactId'):
+        return meta['contactId']
+
+    existing = find_ghl_duplicate_contact(payload.get('email'), payload.get('phone'))
+    return existing.get('id') if existing else None
+
+
+def build_linked_contact_index(contacts, chunk_size=1000):
+    """
+    Map the phones/emails of contacts to GHL IDs already linked to other rows.
+
+    Only the candidates' phones and emails are looked up, with values_list,
+    so a run costs a few small queries instead of two per contact.
+
+    Returns:
+        tuple: ({phone: ghl_contact_id}, {email: ghl_contact_id})
+    """
+    phones = sorted({c.phone for c in contacts if c.phone})
+    emails = sorted({c.email for c in contacts if c.email})
+    by_phone = {}
+    by_email = {}
+
+    for start in range(0, len(phones), chunk_size):
+        for phone, ghl_contact_id in ContactSync.objects.filter(
+            phone__in=phones[start:start + chunk_size],
+            ghl_contact_id__isnull=False
+        ).order_by('-id').values_list('phone', 'ghl_contact_id'):
+            by_phone[phone] = ghl_contact_id
+
+    for start in range(0, len(emails), chunk_size):
+        for email, ghl_contact_id in ContactSync.objects.filter(
+            email__in=emails[start:start + chunk_size],
+            ghl_contact_id__isnull=False
+        ).order_by('-id').values_list('email', 'ghl_contact_id'):
+            by_email[email] = ghl_contact_id
+
+    return by_phone, by_email
+
+
+def linked_to_other_row(contact, ghl_contact_id):
+    """Tell whether a ContactSync row other than contact already owns ghl_contact_id."""
+    return ContactSync.objects.filter(
+        ghl_contact_id=ghl_contact_id
+    ).exclude(pk=contact.pk).exists()
+
+
+def link_existing_contact(contact, ghl_contact_id, payload, status):
+    """
+    Update an existing GHL contact with the row's data and link the row to it.
+
+    Every update/link of a GHL contact the row did not create goes through
+    here, so the contact of another row (e.g. a family member sharing the
+    phone or email) is never overwritten or linked twice.
+
+    Args:
+        contact: ContactSync row without a GHL contact ID
+        ghl_contact_id: Existing GHL contact
+        payload: build_ghl_contact_payload() of the row
+        status: 'updated' (reused by phone/email: a failed update is an
+            error) or 'linked' (GHL rejected the create as a duplicate: the
+            row is linked even if the update fails)
+
+    Returns:
+        dict: Push result, or None if another row owns ghl_contact_id
+    """
+    if linked_to_other_row(contact, ghl_contact_id):
+        return None
+
+    result = update_ghl_contact(ghl_contact_id, payload)
+    if not result or result.get('error'):
+        if status != 'linked':
+            return _error_result(result, 'Update failed')
+        logger.warning(
+            f"Linked contact {contact.id} to existing GHL contact {ghl_contact_id} "
+            f"but could not update it: {_error_message(result, 'Update failed')}"
+        )
+
+    contact.ghl_contact_id = ghl_contact_id
+    return {'status': status, 'ghl_id': ghl_contact_id, 'write_back': True}
+
+
+def push_contact(contact, linked_index=None):
+    """
+    Create (or update) one ContactSync row in GHL and set its GHL contact ID.
+
+    If a GHL contact with the same phone or email is known and no other
+    ContactSync row owns it, that GHL contact is updated instead of creating
+    a duplicate; a contact another row owns is never touched.
+    linked_index (see build_linked_contact_index) avoids a lookup per contact
+    when many contacts are pushed.
+
+    The row is not saved here; results with 'write_back' set must be
+    persisted by the caller (run_concurrently does this via WriteBackBuffer).
+
+    Returns:
+        dict: {'status': 'created' | 'updated' | 'linked' | 'skipped' | 'error', ...}
+        ('linked': GHL already had the contact, its ID was recovered)
+    """
+    try:
+        payload = build_ghl_contact_payload(contact)
+
+        # If contact already has ghl_contact_id, update it
+        if contact.ghl_contact_id:
+            result = update_ghl_contact(contact.ghl_contact_id, payload)
+            if result and not result.get('error'):
+                return {'status': 'updated', 'ghl_id': contact.ghl_contact_id}
+            return _error_result(result, 'Update failed')
+
+        # Reuse the GHL contact of another row with the same phone/email
+        if linked_index is None:
+            linked_index = build_linked_contact_index([contact])
+        by_phone, by_email = linked_index
+        existing_ghl_contact = (
+            (contact.phone and by_phone.get(contact.phone))
+            or (contact.email and by_email.get(contact.email))
+            or None
+        )
+        if existing_ghl_contact:
+            result = link_existing_contact(contact, existing_ghl_contact, payload, 'updated')
+            # None: that GHL contact is another patient's, create this one on its own
+            if result:
+                return result
+
+        # Create new contact
+        result = create_ghl_contact(payload)
+
+        if result and not result.get('error'):
+            contact_data = result.get('contact') or result
+            ghl_contact_id = contact_data.get('id') or result.get('id')
+
+            if not ghl_contact_id:
+                return {'status': 'error', 'error': 'No ID in response'}
+
+            contact.ghl_contact_id = ghl_contact_id
+            return {'status': 'created', 'ghl_id': ghl_contact_id, 'write_back': True}
+
+        # GHL returns "This location does not allow duplicated contacts" for duplicates:
+        # link the row to the existing contact so later runs don't retry the create
+        if _is_duplicate_error(result, CONTACT_DUPLICATE_ERRORS):
+            existing_ghl_contact = find_duplicate_contact_id(result, payload)
+            if not existing_ghl_contact:
+                return {'status': 'skipped', 'error': 'Duplicate in GHL'}
+
+            return link_existing_contact(contact, existing_ghl_contact, payload, 'linked') or {
+                'status': 'skipped',
+                'error': f'Duplicate in GHL: contact {existing_ghl_contact} is linked to another row'
+            }
+
+        return _error_result(result, str(result))
+
+    except Exception as e:
+        logger.error(f"Error syncing contact {contact.id}: {str(e)}")
+        return {'status': 'error', 'error': str(e)}
+
+
+def push_appointment(appt_sync):
+    """
+    Create one AppointmentSync row in GHL and set its GHL appointment ID.
+
+    The row is not saved here; see push_contact().
+
+    Returns:
+        dict: {'status': 'created' | 'skipped' | 'error', ...}
+    """
+    if not appt_sync.ghl_contact_id:
+        return {'status': 'error', 'error': 'Missing ghl_contact_id', 'permanent': True}
+
+    try:
+        result = create_ghl_appointment(appt_sync)
+
+        if result and not result.get('error'):
+            appointment_data = result.get('appointment') or result
+            ghl_appointment_id = appointment_data.get('id') or result.get('id')
+
+            if not ghl_appointment_id:
+                return {'status': 'error', 'error': 'No ID in response'}
+
+            appt_sync.ghl_appointment_id = ghl_appointment_id
+            return {'status': 'created', 'ghl_id': ghl_appointment_id, 'write_back': True}
+
+        if (isinstance(result, dict) and result.get('is_duplicate')) or \
+                _is_duplicate_error(result, APPOINTMENT_DUPLICATE_ERRORS):
+            return {'status': 'skipped', 'error': 'Duplicate in GHL'}
+
+        return _error_result(result, str(result))
+
+    except Exception as e:
+        logger.error(f"Error syncing appointment {appt_sync.id}: {str(e)}")
+        return {'status': 'error', 'error': str(e)}
+
+
+def _push_with_metrics(entity, items, handler, on_result=None, **kwargs):
+    timer = metrics.StageTimer(entity)
+    failures = {}
+    pushed = set()
+
+    def track(item, result, processed):
+        # Runs in the calling thread (see run_concurrently); a second call
+        # for the same item (failed write-back) overrides the first
+        if is_permanent_failure(result):
+            failures[item.id] = result
+            pushed.discard(item.id)
+        elif result['status'] != 'error':
+            pushed.add(item.id)
+        if on_result:
+            on_result(item, result, processed)
+
+    with timer.stage('ghl_push'):
+        stats = run_concurrently(items, handler, on_result=track, **kwargs)
+
+    record_failures(entity, failures)
+    clear_failures(entity, pushed)
+
+    for outcome in ('created', 'updated', 'linked', 'skipped', 'errors'):
+        metrics.increment('ghl_push_total', {'entity': entity, 'outcome': outcome}, stats[outcome])
+    timer.record()
+    return stats
+
+
+def push_contacts_to_ghl(contacts, workers=None, rate=None, on_result=None):
+    """Push ContactSync rows to GHL concurrently. See run_concurrently()."""
+    contacts = list(contacts)
+    linked_index = build_linked_contact_index(contacts)
+
+    return _push_with_metrics(
+        'contact', contacts, lambda contact: push_contact(contact, linked_index),
+        workers=workers, rate=rate, on_result=on_result,
+        write_back=WriteBackBuffer(ContactSync, ['ghl_contact_id'])
+    )
+
+
+def push_appointments_to_ghl(appointments, workers=None, rate=None, on_result=None):
+    """Push AppointmentSync rows to GHL concurrently. See run_concurrently()."""
+    return _push_with_metrics(
+        'appointment', appointments, push_appointment,
+        workers=workers, rate=rate, on_result=on_result,
+        write_back=WriteBackBuffer(AppointmentSync, ['ghl_appointment_id'])
+    )
+
+
+def update_backlog_gauges():
+    """Set the ghl_push_backlog gauges to the number of rows without a GHL ID."""
+    metrics.set_gauge(
+        'ghl_push_backlog',
+        ContactSync.objects.filter(ghl_contact_id__isnull=True).count(),
+        {'entity': 'contact'}
+    )
+    metrics.set_gauge(
+        'ghl_push_backlog',
+        AppointmentSync.objects.filter(ghl_appointment_id__isnull=True).count(),
+        {'entity': 'appointment'}
+    )
@@ -0,0 +1,71 @@
+"""
+Rolling fetch window for the e-Physio appointment sync.
+
+Instead of re-fetching a fixed year-long range every hour, each run fetches
+now - lookback .. now + lookahead. The window is widened back automatically
+when runs were missed, and explicitly on demand (--from-date / --full).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from ephysio.utils import datetime_to_epoch_ms
+from ghl_accounts.models import SyncState
+
+APPOINTMENT_SYNC_STATE = "ephysio_appointments"
+
+# Full range previously fetched on every run; used for explicit backfills (--full)
+FULL_FROM_TIMESTAMP = 1758911400000
+FULL_TO_TIMESTAMP = 1795631400000
+
+
+def get_appointment_sync_window(now=None):
+    """
+    Return the (from_ms, to_ms) window the next appointment sync should fetch.
+    
+    If the last successful run is older than the lookback, the window starts
+    lookback days before that run so nothing changed in between is skipped.
+    """
+    now = now or timezone.now()
+    lookback = timedelta(days=settings.EPHYSIO_APPOINTMENT_LOOKBACK_DAYS)
+    lookahead = timedelta(days=settings.EPHYSIO_APPOINTMENT_LOOKAHEAD_DAYS)
+
+    from_dt = now - lookback
+    to_dt = now + lookahead
+
+    state = SyncState.objects.filter(name=APPOINTMENT_SYNC_STATE).first()
+    if state and state.last_success_at and state.last_success_at - lookback < from_dt:
+        from_dt = state.last_success_at - lookback
+
+    return datetime_to_epoch_ms(from_dt), datetime_to_epoch_ms(to_dt)
+
+
+def record_appointment_sync(from_ms, to_ms, started_at):
+    """
+    Persist a successful appointment sync.
+    
+    The watermark only advances when the synced window covered the whole
+    rolling window, so a narrow manual run can't make later runs skip data.
+    
+    Args:
+        from_ms: Start of the fetched window (epoch ms)
+        to_ms: End of the fetched window (epoch ms)
+        started_at: When the run started (used as the new watermark)
+    
+    Returns:
+        bool: True if the watermark was advanced
+    """
+    default_from, default_to = get_appointment_sync_window(now=started_at)
+    if from_ms > default_from or to_ms < default_to:
+        return False
+
+    SyncState.objects.update_or_create(
+        name=APPOINTMENT_SYNC_STATE,
+        defaults={
+            'window_from': from_ms,
+            'window_to': to_ms,
+            'last_success_at': started_at,
+        }
+    )
+    return True
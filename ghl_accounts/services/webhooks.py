@@ -0,0 +1,221 @@
+"""
+Processing of queued GHL webhook events (see WebhookEvent).
+
+The webhook view only validates and stores the event; these functions do the
+e-Physio work from a Celery task and return a short status string.
+"""
+import requests
+from django.utils.dateparse import parse_datetime
+
+from ephysio.services.appointments import create_ephysio_appointment, resolve_invoices
+from ephysio.services.patients import sync_ghl_contact_to_ephysio
+from ephysio.services.auth import EPhysioAuthError
+from ghl_accounts.models import AppointmentSync, ContactSync
+
+CONTACT_EVENT_TYPES = ["ContactCreate", "ContactUpdate"]
+APPOINTMENT_EVENT_TYPES = ["AppointmentCreate", "AppointmentUpdate"]
+
+# HTTP errors from e-Physio that can succeed when retried later
+RETRYABLE_STATUS_CODES = {401, 408, 429}
+
+
+class RetryableWebhookError(Exception):
+    """The event cannot be applied yet, but may succeed later (e.g. its patient is still syncing)."""
+
+
+def is_retryable_error(error):
+    """
+    Tell whether a failed webhook event should be retried.
+
+    Retried: RetryableWebhookError, e-Physio auth failures, network errors
+    and 5xx / 401 / 408 / 429 responses. Everything else (bad payloads,
+    other 4xx responses) is permanent.
+    """
+    if isinstance(error, (RetryableWebhookError, EPhysioAuthError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status_code = error.response.status_code
+        return status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+def get_entity_key(event_type, data):
+    """
+    Return the ordering key for a webhook event.
+
+    Appointment events are keyed by their contact, so a contact's own events
+    and its appointments' events are applied in the order GHL sent them
+    (an appointment is never processed before its contact is linked).
+    """
+    if event_type in CONTACT_EVENT_TYPES:
+        return f"contact:{data.get('id')}"
+
+    appointment = data.get("appointment", {})
+    return f"contact:{appointment.get('contactId')}"
+
+
+def process_contact_event(data):
+    ghl_contact_id = data.get("id")
+    email = data.get("email")
+    phone = data.get("phone")
+    first_name = data.get("firstName")
+    last_name = data.get("lastName")
+
+    sync = ContactSync.objects.filter(
+        ghl_contact_id=ghl_contact_id
+    ).first()
+
+    if sync:
+        print("✅ Contact already synced")
+        sync.email = email
+        sync.phone = phone
+        sync.save()
+    else:
+        print("🆕 New contact")
+        sync = ContactSync.objects.create(
+            ghl_contact_id=ghl_contact_id,
+            email=email,
+            phone=phone,
+            source="ghl"
+        )
+
+    sync_ghl_contact_to_ephysio({
+        "ghl_contact_id": ghl_contact_id,
+        "first_name": first_name,
+        "last_name": last_name,
+        "phone": phone,
+        "email": email
+    }, sync)
+
+    return "contact synced"
+
+
+def process_appointment_event(data):
+    print("📦 RAW APPOINTMENT PAYLOAD >>>", data)
+
+    appointment = data.get("appointment", {})
+
+    ghl_appointment_id = appointment.get("id")
+    ghl_contact_id = appointment.get("contactId")
+
+    start_time = parse_datetime(appointment.get("startTime"))
+    end_time = parse_datetime(appointment.get("endTime"))
+    status = appointment.get("appointmentStatus")
+
+    # find synced patient
+    contact_sync = ContactSync.objects.filter(
+        ghl_contact_id=ghl_contact_id
+    ).first()
+
+    if not contact_sync or not contact_sync.ephysio_patient_id:
+        # The contact event (or the hourly sync) links the patient shortly
+        raise RetryableWebhookError("Patient not synced yet")
+
+    appt_sync = AppointmentSync.objects.filter(
+        ghl_appointment_id=ghl_appointment_id
+    ).first()
+
+    if appt_sync:
+        print("🔁 Appointment already exists – skipping create")
+        return "already exists"
+
+    print("🆕 Creating appointment")
+
+    appt_sync = AppointmentSync.objects.create(
+        ghl_appointment_id=ghl_appointment_id,
+        ghl_contact_id=ghl_contact_id,
+        ephysio_patient_id=contact_sync.ephysio_patient_id,
+        start_time=start_time,
+        end_time=end_time,
+        status=status,
+        source="ghl"  # Set source as 'ghl' since it's created from GHL webhook
+    )
+
+    sync_ghl_appointment_to_ephysio_create(appt_sync)
+
+    return "appointment created"
+
+
+def sync_ghl_appointment_to_ephysio_create(appt_sync):
+    print("📡 SYNC TO E-PHYSIO (CREATE)")
+    try:
+        result = create_ephysio_appointment(appt_sync)
+
+        # Extract event ID from response
+        # Response structure: {"id": 42109222, "events": [], ...}
+        event_id = result.get("id")
+
+        # Also check if ID is in events array (if present)
+        if not event_id and result.get("events"):
+            events = result.get("events", [])
+            if events and len(events) > 0:
+                event_id = events[0].get("id")
+
+        if event_id:
+            appt_sync.ephysio_appointment_id = str(event_id)
+            appt_sync.save()
+            print(f"✅ Appointment created in e-Physio with ID: {event_id}")
+        else:
+            print("⚠️ Warning: No event ID in response from e-Physio")
+            print(f"Response: {result}")
+
+    except Exception as e:
+        print(f"❌ Error creating appointment in e-Physio: {str(e)}")
+        # Don't raise - the appointment is already saved in our database
+
+
+def prefetch_invoices(events):
+    """
+    Resolve the e-Physio invoices for a batch of queued appointment events at once.
+
+    Used when several appointment events are replayed together; the invoices
+    are looked up concurrently and cached, so each create only posts the event.
+    """
+    appointments = [
+        event.payload.get("appointment", {})
+        for event in events
+        if event.event_type in APPOINTMENT_EVENT_TYPES
+    ]
+    if len(appointments) < 2:
+        return
+
+    # Appointments that already exist are skipped by process_appointment_event
+    existing = set(
+        AppointmentSync.objects.filter(
+            ghl_appointment_id__in=[a.get("id") for a in appointments]
+        ).values_list("ghl_appointment_id", flat=True)
+    )
+    patient_ids = dict(
+        ContactSync.objects.filter(
+            ghl_contact_id__in=[a.get("contactId") for a in appointments],
+            ephysio_patient_id__isnull=False
+        ).values_list("ghl_contact_id", "ephysio_patient_id")
+    )
+
+    pairs = []
+    for appointment in appointments:
+        patient_id = patient_ids.get(appointment.get("contactId"))
+        start_time = parse_datetime(appointment.get("startTime") or "")
+        if appointment.get("id") in existing or not patient_id or not start_time:
+            continue
+        pairs.append((patient_id, start_time))
+
+    if pairs:
+        print(f"🧾 Resolving invoices for {len(pairs)} queued appointments")
+        resolve_invoices(pairs)
+
+
+def process_webhook_event(event):
+    """
+    Apply one stored WebhookEvent.
+
+    Returns:
+        str: Short result status
+    """
+    if event.event_type in CONTACT_EVENT_TYPES:
+        return process_contact_event(event.payload)
+
+    if event.event_type in APPOINTMENT_EVENT_TYPES:
+        return process_appointment_event(event.payload)
+
+    return "ignored"
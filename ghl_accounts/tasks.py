@@ -1,463 +1,494 @@
 """
 Celery tasks for periodic syncing of patients and appointments.
+
+Large sync runs fan out: the patient list and the appointment window are
+split into chunks (SYNC_PATIENT_CHUNK_SIZE patients, SYNC_APPOINTMENT_CHUNK_DAYS
+days) that are upserted by one subtask each, spread over all workers, and
+the chunk results are added up into the usual summary dict. Appointment
+chunks are a chord. Patient chunks are queued one by one while the e-Physio
+response streams in, so the run never holds the whole patient list; they
+add their results up in Redis and the last one to finish builds the summary.
 """
-from celery import shared_task
-from django.db import transaction
+from celery import chord, shared_task
 from django.utils import timezone
-from ghl_accounts.models import ContactSync, AppointmentSync
-from ephysio.services.patients import get_active_patients
-from ephysio.services.appointments import get_ephysio_appointments, epoch_ms_to_datetime
+from django.utils.dateparse import parse_datetime
+from ghl_accounts.models import SyncState, WebhookEvent
+from e_physio_integration.redis_client import get_redis
+from e_physio_integration.task_lock import continue_lease, exclusive_run, release_handed_off
+from ephysio.services.patients import iter_active_patients
+from ephysio.services.appointments import (
+    DAY_MS,
+    iter_ephysio_appointments_sharded,
+    split_window
+)
 from ghl_accounts.services.contacts import (
     get_ghl_auth,
-    create_ghl_contact,
-    build_ghl_contact_payload,
-    refresh_ghl_token
+    refresh_ghl_token,
+    ghl_token_manager
+)
+from ghl_accounts.services.outbox import OUTBOX_ENTITIES, dispatch, pending_count
+from ghl_accounts.services.webhooks import (
+    is_retryable_error,
+    prefetch_invoices,
+    process_webhook_event
 )
-from ghl_accounts.services.appointments import (
-    create_ghl_appointment,
-    build_ghl_appointment_payload
+from ghl_accounts.services.ingestion import (
+    iter_batches,
+    upsert_appointments,
+    upsert_contacts
 )
+from ghl_accounts.services.sync_window import (
+    get_appointment_sync_window,
+    record_appointment_sync
+)
+from django.conf import settings
+import functools
+import itertools
 import logging
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
+# Seconds to wait before retrying when another worker holds an entity's webhook lock
+WEBHOOK_LOCK_RETRY_DELAY = 2
+
+# Redis hash adding up the chunk results of a fanned-out patient sync
+PATIENT_RUN_KEY_PREFIX = "patient-sync-run:"
+# SyncState row holding the summary of the last completed patient sync
+PATIENT_SYNC_STATE = "ephysio_patients"
+
+
+def lease_scope():
+    """Scope of the task leases: the GHL location the tasks sync into."""
+    return get_ghl_auth()[1] or "default"
+
+
+def skipped_result(task_name, location_id):
+    return {
+        'status': 'skipped',
+        'message': f'{task_name} already running for location {location_id}',
+        'timestamp': timezone.now().isoformat()
+    }
+
+
+def run_exclusively(task):
+    """
+    Run a periodic task at most once at a time per GHL location.
+
+    The run holds a lease (e_physio_integration/task_lock.py) while it works;
+    a run started meanwhile waits up to SYNC_TASK_LOCK_WAIT seconds for it
+    and is skipped otherwise, returning status 'skipped'.
+    """
+    @functools.wraps(task)
+    def wrapper(*args, **kwargs):
+        location_id = lease_scope()
+        with exclusive_run(task.__name__, location_id) as lease:
+            if lease is None:
+                return skipped_result(task.__name__, location_id)
+            return task(*args, **kwargs)
+    return wrapper
+
+
+def start_outbox_dispatch():
+    """Start dispatch_ghl_outbox now instead of waiting for its next scheduled run."""
+    try:
+        dispatch_ghl_outbox.delay()
+    except Exception as e:
+        logger.warning(f"Could not start the outbox dispatcher, its next scheduled run pushes the rows: {str(e)}")
+
+
+def chunk_stats(stats):
+    """Ingestion stats of one chunk as a task result (the outbox ids only counted)."""
+    stats = dict(stats)
+    stats['queued_for_ghl'] = len(stats.pop('pending_ids'))
+    return stats
+
+
+def sum_stats(results):
+    """Add up the chunk_stats() of all chunks of a run."""
+    totals = {}
+    for stats in results:
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _claim_run_finish(run_key):
+    """True for exactly one caller once every chunk of the run is counted."""
+    redis_client = get_redis()
+    done, expected = redis_client.hmget(run_key, '_done', '_expected')
+    if expected is None or int(done or 0) < int(expected):
+        return False
+    return bool(redis_client.hsetnx(run_key, '_finishing', 1))
 
-@shared_task(name='sync_patients_incremental')
-def sync_patients_incremental():
+
+def add_chunk_result(run_key, stats):
+    """
+    Add the chunk_stats() of one patient chunk to its run's totals.
+
+    Returns:
+        bool: True if this was the run's last chunk and the caller has to
+        finish the run (finish_patient_sync)
+    """
+    pipe = get_redis().pipeline()
+    for key, value in stats.items():
+        pipe.hincrby(run_key, key, value)
+    pipe.hincrby(run_key, '_done', 1)
+    pipe.expire(run_key, settings.SYNC_TASK_HANDOFF_SECONDS)
+    pipe.execute()
+    return _claim_run_finish(run_key)
+
+
+def set_expected_chunks(run_key, count):
+    """
+    Record how many chunks the run queued, once they all are.
+
+    Returns:
+        bool: True if all of them are done already and the caller has to
+        finish the run
+    """
+    redis_client = get_redis()
+    redis_client.hset(run_key, '_expected', count)
+    redis_client.expire(run_key, settings.SYNC_TASK_HANDOFF_SECONDS)
+    return _claim_run_finish(run_key)
+
+
+def finish_patient_sync_run(stats):
+    """
+    Start the GHL push of the queued contacts and build the run summary
+    (logged and stored in the PATIENT_SYNC_STATE SyncState row).
+
+    Args:
+        stats: chunk_stats() of the whole run
+    """
+    if not stats.get('total'):
+        logger.warning("No patients found in e-Physio")
+        return {
+            'status': 'success',
+            'message': 'No patients found',
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'queued_for_ghl': 0
+        }
+    
+    logger.info(
+        f"Contacts created: {stats['created']}, updated: {stats['updated']}, "
+        f"unchanged: {stats['unchanged']}"
+    )
+    
+    # New contacts and earlier failures (still without ghl_contact_id) were
+    # queued in the push outbox together with the upserts
+    if stats['queued_for_ghl']:
+        logger.info(f"{stats['queued_for_ghl']} contacts queued for GHL")
+        start_outbox_dispatch()
+    
+    result = {
+        'status': 'success',
+        'message': 'Patient sync completed',
+        'total_patients': stats['total'],
+        'created': stats['created'],
+        'updated': stats['updated'],
+        'unchanged': stats['unchanged'],
+        'queued_for_ghl': stats['queued_for_ghl'],
+        'timestamp': timezone.now().isoformat()
+    }
+    
+    logger.info(f"Patient sync completed: {result}")
+    # A fanned-out run's summary is not the result of sync_patients_incremental
+    SyncState.objects.update_or_create(
+        name=PATIENT_SYNC_STATE,
+        defaults={'last_success_at': timezone.now(), 'counters': result}
+    )
+    return result
+
+
+@shared_task(name='sync_patients_incremental', bind=True)
+def sync_patients_incremental(self):
     """
-    Periodic task to sync patients from e-Physio to ContactSync and then to GHL.
+    Periodic task to sync patients from e-Physio to ContactSync.
     
     This task:
     1. Fetches all active patients from e-Physio
-    2. Compares with existing ContactSync records
-    3. Creates/updates ContactSync records for new/updated patients
-    4. Syncs new patients (without ghl_contact_id) to GHL
+    2. Upserts ContactSync records, rewriting only new/changed patients
+       (more than SYNC_PATIENT_CHUNK_SIZE patients: in parallel chunk tasks)
+    3. Queues patients without ghl_contact_id in the push outbox (same
+       transaction) and starts dispatch_ghl_outbox to push them to GHL
     
-    Runs every hour via Celery Beat.
+    Runs every hour via Celery Beat, never overlapping itself: the run holds
+    a lease per GHL location, handed on to its chunk tasks.
     """
     logger.info("Starting incremental patient sync task...")
+    location_id = lease_scope()
     
-    try:
-        # Fetch active patients from e-Physio
-        logger.info("Fetching active patients from e-Physio...")
-        patients = get_active_patients()
-        logger.info(f"Found {len(patients)} active patients")
+    with exclusive_run(self.name, location_id) as lease:
+        if lease is None:
+            return skipped_result(self.name, location_id)
         
-        if not patients:
-            logger.warning("No patients found in e-Physio")
+        try:
+            # Stream active patients from e-Physio straight into batched
+            # upserts (unchanged rows are not rewritten)
+            logger.info("Fetching active patients from e-Physio...")
+            chunks = iter_batches(iter_active_patients(), settings.SYNC_PATIENT_CHUNK_SIZE)
+            first_chunk = next(chunks, [])
+            second_chunk = next(chunks, None)
+            
+            if second_chunk is None:
+                stats = chunk_stats(upsert_contacts(first_chunk))
+                logger.info(f"Found {stats['total']} active patients")
+                return finish_patient_sync_run(stats)
+        
+        except Exception as e:
+            error_msg = f"Error in incremental patient sync: {str(e)}"
+            logger.error(error_msg, exc_info=True)
             return {
-                'status': 'success',
-                'message': 'No patients found',
-                'created': 0,
-                'updated': 0,
-                'synced_to_ghl': 0
+                'status': 'error',
+                'message': error_msg,
+                'timestamp': timezone.now().isoformat()
             }
         
-        # Get existing contacts by ephysio_patient_id
-        existing_contacts = {
-            str(contact.ephysio_patient_id): contact
-            for contact in ContactSync.objects.filter(
-                ephysio_patient_id__isnull=False
-            )
-        }
-        
-        # Prepare ContactSync objects for bulk creation and update
-        contacts_to_create = []
-        contacts_to_update = []
-        contacts_to_sync_to_ghl = []
-        
-        for patient in patients:
-            patient_id = str(patient.get('id'))
-            
-            if not patient_id:
-                continue
-            
-            # Check if contact already exists
-            if patient_id in existing_contacts:
-                # Update existing record
-                contact = existing_contacts[patient_id]
-                contact.phone = patient.get('phone', '') or None
-                contact.email = patient.get('email', '') or None
-                contact.first_name = patient.get('firstName', '') or None
-                contact.last_name = patient.get('lastName', '') or None
-                contact.salutation = patient.get('salutation', '') or None
-                contact.street = patient.get('street', '') or None
-                contact.zip = patient.get('zip', '') or None
-                contact.city = patient.get('city', '') or None
-                contact.birth_date = patient.get('birthDate', '') or None
-                contact.sex = patient.get('sex')
-                # Preserve original source if it was created from GHL webhook.
-                # Only mark as 'ephysio' if source is empty or already 'ephysio'.
-                if not contact.source or contact.source == 'ephysio':
-                    contact.source = 'ephysio'
-                contacts_to_update.append(contact)
-                
-                # If this contact doesn't have ghl_contact_id, add to sync list
-                if not contact.ghl_contact_id:
-                    contacts_to_sync_to_ghl.append(contact)
-            else:
-                # Create new ContactSync object
-                contact = ContactSync(
-                    ephysio_patient_id=patient_id,
-                    phone=patient.get('phone', '') or None,
-                    email=patient.get('email', '') or None,
-                    first_name=patient.get('firstName', '') or None,
-                    last_name=patient.get('lastName', '') or None,
-                    salutation=patient.get('salutation', '') or None,
-                    street=patient.get('street', '') or None,
-                    zip=patient.get('zip', '') or None,
-                    city=patient.get('city', '') or None,
-                    birth_date=patient.get('birthDate', '') or None,
-                    sex=patient.get('sex'),
-                    source='ephysio',
-                    ghl_contact_id=None  # Will be set when synced to GHL
-                )
-                contacts_to_create.append(contact)
-                # New contacts also need to be synced to GHL
-                contacts_to_sync_to_ghl.append(contact)
-        
-        # Bulk update existing contacts
-        total_updated = 0
-        if contacts_to_update:
-            logger.info(f"Updating {len(contacts_to_update)} existing contacts...")
-            update_fields = [
-                'phone', 'email', 'first_name', 'last_name', 'salutation',
-                'street', 'zip', 'city', 'birth_date', 'sex', 'source'
-            ]
-            
-            with transaction.atomic():
-                ContactSync.objects.bulk_update(
-                    contacts_to_update,
-                    update_fields,
-                    batch_size=1000
-                )
-                total_updated = len(contacts_to_update)
+        # The chunk tasks keep the lease alive and the one that completes the
+        # run releases it (release_sync_lease if a chunk fails)
+        token = lease.hand_off()
+        run_key = f"{PATIENT_RUN_KEY_PREFIX}{uuid.uuid4().hex}"
+        release = release_sync_lease.si(self.name, location_id, token)
+        queued = 0
         
-        # Bulk create new contacts
-        total_created = 0
-        created_patient_ids = []
-        if contacts_to_create:
-            logger.info(f"Creating {len(contacts_to_create)} new contacts...")
-            created_patient_ids = [str(c.ephysio_patient_id) for c in contacts_to_create]
-            with transaction.atomic():
-                ContactSync.objects.bulk_create(
-                    contacts_to_create,
-                    ignore_conflicts=True,
-                    batch_size=1000
+        try:
+            # Queue each chunk as soon as it is read from the stream
+            for chunk in itertools.chain([first_chunk, second_chunk], chunks):
+                sync_patients_chunk.apply_async(
+                    (chunk, location_id, token, run_key), link_error=release
                 )
-                total_created = len(contacts_to_create)
-        
-        # Prepare list of contacts to sync to GHL
-        # Include: 1) Existing contacts without ghl_contact_id, 2) Newly created contacts
-        contacts_to_sync_to_ghl = [
-            c for c in contacts_to_sync_to_ghl if c.id  # Only already-saved contacts
-        ]
-        
-        # Add newly created contacts (fetch from DB since bulk_create doesn't return IDs)
-        if created_patient_ids:
-            newly_created = ContactSync.objects.filter(
-                ephysio_patient_id__in=created_patient_ids,
-                ghl_contact_id__isnull=True
-            )
-            contacts_to_sync_to_ghl.extend(newly_created)
+                queued += 1
+        except Exception as e:
+            # The run is never completed: the queued chunks still upsert
+            # their patients, the next run picks up the rest
+            release_handed_off(self.name, location_id, token)
+            error_msg = f"Error in incremental patient sync after {queued} chunks: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return {
+                'status': 'error',
+                'message': error_msg,
+                'timestamp': timezone.now().isoformat()
+            }
         
-        # Sync new/updated contacts to GHL
-        total_synced_to_ghl = 0
-        if contacts_to_sync_to_ghl:
-            logger.info(f"Syncing {len(contacts_to_sync_to_ghl)} contacts to GHL...")
-            
-            # Check GHL authentication
-            access_token, location_id = get_ghl_auth()
-            if not access_token or not location_id:
-                logger.error("GHL authentication not available, skipping GHL sync")
-            else:
-                for contact in contacts_to_sync_to_ghl:
-                    try:
-                        payload = build_ghl_contact_payload(contact)
-                        result = create_ghl_contact(payload)
-                        
-                        if result and not result.get('error'):
-                            # Extract contact ID from response
-                            contact_data = result.get('contact') or result
-                            ghl_contact_id = contact_data.get('id') or result.get('id')
-                            
-                            if ghl_contact_id:
-                                contact.ghl_contact_id = ghl_contact_id
-                                contact.save(update_fields=['ghl_contact_id'])
-                                total_synced_to_ghl += 1
-                            else:
-                                logger.warning(f"No ID in response for contact {contact.id}")
-                        else:
-                            error_msg = result.get('error', '') if isinstance(result, dict) else str(result)
-                            error_lower = error_msg.lower()
-                            # Check if it's a duplicate error
-                            if ('duplicate' in error_lower or 
-                                'already exists' in error_lower or
-                                'does not allow duplicated' in error_lower):
-                                # Contact already exists in GHL - this is expected for incremental sync
-                                # We can't easily find the GHL contact ID without a search API
-                                # So we'll just skip it (it's already in GHL)
-                                logger.info(f"Contact {contact.id} already exists in GHL (duplicate - skipping)")
-                            else:
-                                logger.warning(f"Error syncing contact {contact.id} to GHL: {error_msg}")
-                    except Exception as e:
-                        logger.error(f"Exception syncing contact {contact.id} to GHL: {str(e)}")
+        logger.info(f"Upserting active patients in {queued} chunk tasks")
+        if set_expected_chunks(run_key, queued):
+            # Every chunk finished while the rest were read (e.g. eager mode)
+            return finish_patient_sync(run_key, location_id, token)
         
-        result = {
+        return {
             'status': 'success',
-            'message': 'Patient sync completed',
-            'total_patients': len(patients),
-            'created': total_created,
-            'updated': total_updated,
-            'synced_to_ghl': total_synced_to_ghl,
+            'message': (
+                f'Patient sync queued in {queued} chunk tasks, the last one to '
+                f'finish stores the summary in SyncState {PATIENT_SYNC_STATE!r}'
+            ),
+            'chunks': queued,
             'timestamp': timezone.now().isoformat()
         }
-        
-        logger.info(f"Patient sync completed: {result}")
-        return result
-        
-    except Exception as e:
-        error_msg = f"Error in incremental patient sync: {str(e)}"
-        logger.error(error_msg, exc_info=True)
+
+
+@shared_task(name='sync_patients_chunk')
+def sync_patients_chunk(patients, location_id=None, lease_token=None, run_key=None):
+    """
+    Upsert one chunk of a fanned-out patient sync.
+
+    Returns its chunk_stats(), or the run summary if it completed the run.
+    """
+    with continue_lease('sync_patients_incremental', location_id, lease_token):
+        stats = chunk_stats(upsert_contacts(patients))
+    
+    if run_key and add_chunk_result(run_key, stats):
+        return finish_patient_sync(run_key, location_id, lease_token)
+    return stats
+
+
+def finish_patient_sync(run_key, location_id=None, lease_token=None):
+    """Last step of a fanned-out patient sync: same summary as an inline run."""
+    with continue_lease('sync_patients_incremental', location_id, lease_token, release=True):
+        redis_client = get_redis()
+        totals = redis_client.hgetall(run_key)
+        redis_client.delete(run_key)
+        stats = {
+            key.decode(): int(value) for key, value in totals.items()
+            if not key.startswith(b'_')
+        }
+        return finish_patient_sync_run(stats)
+
+
+def finish_appointment_sync_run(stats, window_from, window_to, started_at):
+    """
+    Start the GHL push of the queued appointments, record the synced window
+    as the new watermark and build the run summary.
+
+    Args:
+        stats: chunk_stats() of the whole run
+        window_from, window_to: Synced window (epoch ms)
+        started_at: When the run started
+    """
+    record_appointment_sync(window_from, window_to, started_at)
+    
+    if not stats.get('total'):
+        logger.warning("No appointments found in e-Physio")
         return {
-            'status': 'error',
-            'message': error_msg,
-            'timestamp': timezone.now().isoformat()
+            'status': 'success',
+            'message': 'No appointments found',
+            'window_from': window_from,
+            'window_to': window_to,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'queued_for_ghl': 0
         }
+    
+    logger.info(
+        f"Appointments created: {stats['created']}, updated: {stats['updated']}, "
+        f"unchanged: {stats['unchanged']}"
+    )
+    
+    # Appointments linked to a GHL contact but not yet pushed to GHL were
+    # queued in the push outbox together with the upserts
+    if stats['queued_for_ghl']:
+        logger.info(f"{stats['queued_for_ghl']} appointments queued for GHL")
+        start_outbox_dispatch()
+    
+    result = {
+        'status': 'success',
+        'message': 'Appointment sync completed',
+        'window_from': window_from,
+        'window_to': window_to,
+        'total_appointments': stats['total'],
+        'created': stats['created'],
+        'updated': stats['updated'],
+        'unchanged': stats['unchanged'],
+        'queued_for_ghl': stats['queued_for_ghl'],
+        'timestamp': timezone.now().isoformat()
+    }
+    
+    logger.info(f"Appointment sync completed: {result}")
+    return result
+
 
+def appointment_chunks(window_from, window_to):
+    """
+    Split the sync window into SYNC_APPOINTMENT_CHUNK_DAYS chunks.
+
+    Chunks end 1 ms before the next one starts, so no event is fetched twice.
+    """
+    chunks = split_window(window_from, window_to, settings.SYNC_APPOINTMENT_CHUNK_DAYS * DAY_MS)
+    return [(start, end - 1) for start, end in chunks[:-1]] + chunks[-1:]
 
-@shared_task(name='sync_appointments_incremental')
-def sync_appointments_incremental():
+
+@shared_task(name='sync_appointments_incremental', bind=True)
+def sync_appointments_incremental(self, from_timestamp=None, to_timestamp=None):
     """
-    Periodic task to sync appointments from e-Physio to AppointmentSync and then to GHL.
+    Periodic task to sync appointments from e-Physio to AppointmentSync.
     
     This task:
-    1. Fetches all appointments from e-Physio (using default date range)
-    2. Compares with existing AppointmentSync records
-    3. Creates/updates AppointmentSync records for new/updated appointments
-    4. Links appointments to ghl_contact_id if patient exists in ContactSync
-    5. Syncs new appointments (without ghl_appointment_id) to GHL
+    1. Fetches appointments from e-Physio in the rolling sync window
+       (lookback + lookahead around now, widened after missed runs)
+    2. Upserts AppointmentSync records, rewriting only new/changed appointments
+       (windows longer than SYNC_APPOINTMENT_CHUNK_DAYS: one chunk task per
+       chunk of the window, in parallel)
+    3. Links appointments to ghl_contact_id if patient exists in ContactSync
+    4. Queues new appointments (without ghl_appointment_id) in the push
+       outbox (same transaction) and starts dispatch_ghl_outbox
+    5. Records the synced window as the new watermark (only once every
+       chunk succeeded)
+    
+    Runs every hour via Celery Beat, never overlapping itself: the run holds
+    a lease per GHL location, handed on to its chunk tasks.
     
-    Runs every hour via Celery Beat.
+    Args:
+        from_timestamp: Optional start (epoch ms) to widen the window on demand
+        to_timestamp: Optional end (epoch ms) to widen the window on demand
     """
     logger.info("Starting incremental appointment sync task...")
+    location_id = lease_scope()
     
-    try:
-        # Default timestamps from the API URL shared by user
-        DEFAULT_FROM_TIMESTAMP = 1758911400000
-        DEFAULT_TO_TIMESTAMP = 1795631400000
-        
-        # Fetch appointments from e-Physio
-        logger.info("Fetching appointments from e-Physio...")
-        appointments = get_ephysio_appointments(DEFAULT_FROM_TIMESTAMP, DEFAULT_TO_TIMESTAMP)
-        logger.info(f"Found {len(appointments)} appointments")
-        
-        if not appointments:
-            logger.warning("No appointments found in e-Physio")
-            return {
-                'status': 'success',
-                'message': 'No appointments found',
-                'created': 0,
-                'updated': 0,
-                'synced_to_ghl': 0
-            }
-        
-        # Get existing appointments by ephysio_appointment_id
-        existing_appointments = {
-            str(appt.ephysio_appointment_id): appt
-            for appt in AppointmentSync.objects.filter(
-                ephysio_appointment_id__isnull=False
-            )
-        }
-        
-        # Get ContactSync records to link ghl_contact_id
-        contact_sync_map = {
-            str(contact.ephysio_patient_id): contact
-            for contact in ContactSync.objects.filter(
-                ephysio_patient_id__isnull=False
-            )
-        }
-        
-        # Prepare AppointmentSync objects for bulk creation and update
-        appointments_to_create = []
-        appointments_to_update = []
-        appointments_to_sync_to_ghl = []
+    with exclusive_run(self.name, location_id) as lease:
+        if lease is None:
+            return skipped_result(self.name, location_id)
         
-        for appointment in appointments:
-            ephysio_appointment_id = str(appointment.get('id'))
-            ephysio_patient_id = str(appointment.get('patientId'))
+        try:
+            started_at = timezone.now()
+            window_from, window_to = get_appointment_sync_window(now=started_at)
+            if from_timestamp is not None:
+                window_from = from_timestamp
+            if to_timestamp is not None:
+                window_to = to_timestamp
             
-            if not ephysio_appointment_id or not ephysio_patient_id:
-                continue
+            chunks = appointment_chunks(window_from, window_to)
+            if len(chunks) == 1:
+                # Fetch appointments from e-Physio in concurrent sub-windows, straight
+                # into batched upserts (unchanged rows are not rewritten)
+                logger.info(f"Fetching appointments from e-Physio (window {window_from} - {window_to})...")
+                stats = chunk_stats(upsert_appointments(
+                    iter_ephysio_appointments_sharded(window_from, window_to)
+                ))
+                logger.info(f"Found {stats['total']} appointments")
+                return finish_appointment_sync_run(stats, window_from, window_to, started_at)
             
-            # Convert timestamps to datetime
-            start_time = epoch_ms_to_datetime(appointment.get('start'))
-            end_time = epoch_ms_to_datetime(appointment.get('end'))
-            
-            if not start_time or not end_time:
-                continue
-            
-            # Get ghl_contact_id from ContactSync if available
-            ghl_contact_id = None
-            contact_sync = contact_sync_map.get(ephysio_patient_id)
-            if contact_sync and contact_sync.ghl_contact_id:
-                ghl_contact_id = contact_sync.ghl_contact_id
-            
-            # Check if appointment already exists
-            if ephysio_appointment_id in existing_appointments:
-                # Update existing record
-                appt_sync = existing_appointments[ephysio_appointment_id]
-                appt_sync.start_time = start_time
-                appt_sync.end_time = end_time
-                appt_sync.status = str(appointment.get('status', '')) or None
-                appt_sync.event_type_id = appointment.get('eventTypeId')
-                appt_sync.user_id = appointment.get('user_id')
-                appt_sync.client_id = appointment.get('clientId')
-                appt_sync.admin_info_id = appointment.get('adminInfoId')
-                appt_sync.ephysio_patient_id = ephysio_patient_id
-                appt_sync.ghl_contact_id = ghl_contact_id
-                # Preserve original source if it was created from GHL webhook
-                # Only mark as 'ephysio' if source is empty or already 'ephysio'
-                if not appt_sync.source or appt_sync.source == 'ephysio':
-                    appt_sync.source = 'ephysio'
-                appointments_to_update.append(appt_sync)
-                
-                # If this appointment doesn't have ghl_appointment_id and has ghl_contact_id, add to sync list
-                if not appt_sync.ghl_appointment_id and ghl_contact_id:
-                    appointments_to_sync_to_ghl.append(appt_sync)
-            else:
-                # Create new AppointmentSync object
-                appt_sync = AppointmentSync(
-                    ephysio_appointment_id=ephysio_appointment_id,
-                    ephysio_patient_id=ephysio_patient_id,
-                    ghl_contact_id=ghl_contact_id,
-                    start_time=start_time,
-                    end_time=end_time,
-                    status=str(appointment.get('status', '')) or None,
-                    event_type_id=appointment.get('eventTypeId'),
-                    user_id=appointment.get('user_id'),
-                    client_id=appointment.get('clientId'),
-                    admin_info_id=appointment.get('adminInfoId'),
-                    source='ephysio',
-                    ghl_appointment_id=None  # Will be set when synced to GHL
-                )
-                appointments_to_create.append(appt_sync)
-                # New appointments with ghl_contact_id also need to be synced to GHL
-                if ghl_contact_id:
-                    appointments_to_sync_to_ghl.append(appt_sync)
-        
-        # Bulk update existing appointments
-        total_updated = 0
-        if appointments_to_update:
-            logger.info(f"Updating {len(appointments_to_update)} existing appointments...")
-            update_fields = [
-                'start_time', 'end_time', 'status', 'event_type_id',
-                'user_id', 'client_id', 'admin_info_id', 'ephysio_patient_id',
-                'ghl_contact_id', 'source'
-            ]
-            
-            with transaction.atomic():
-                AppointmentSync.objects.bulk_update(
-                    appointments_to_update,
-                    update_fields,
-                    batch_size=1000
-                )
-                total_updated = len(appointments_to_update)
-        
-        # Bulk create new appointments
-        total_created = 0
-        created_appointment_ids = []
-        if appointments_to_create:
-            logger.info(f"Creating {len(appointments_to_create)} new appointments...")
-            created_appointment_ids = [str(a.ephysio_appointment_id) for a in appointments_to_create]
-            with transaction.atomic():
-                AppointmentSync.objects.bulk_create(
-                    appointments_to_create,
-                    ignore_conflicts=True,
-                    batch_size=1000
-                )
-                total_created = len(appointments_to_create)
-        
-        # Prepare list of appointments to sync to GHL
-        # Include: 1) Existing appointments without ghl_appointment_id, 2) Newly created appointments
-        appointments_to_sync_to_ghl = [
-            a for a in appointments_to_sync_to_ghl if a.id  # Only already-saved appointments
-        ]
-        
-        # Add newly created appointments (fetch from DB since bulk_create doesn't return IDs)
-        if created_appointment_ids:
-            newly_created = AppointmentSync.objects.filter(
-                ephysio_appointment_id__in=created_appointment_ids,
-                ghl_appointment_id__isnull=True,
-                ghl_contact_id__isnull=False
+            logger.info(
+                f"Syncing appointments of window {window_from} - {window_to} in {len(chunks)} chunk tasks..."
             )
-            appointments_to_sync_to_ghl.extend(newly_created)
         
-        # Sync new/updated appointments to GHL
-        total_synced_to_ghl = 0
-        if appointments_to_sync_to_ghl:
-            logger.info(f"Syncing {len(appointments_to_sync_to_ghl)} appointments to GHL...")
-            
-            # Check GHL authentication
-            access_token, location_id = get_ghl_auth()
-            if not access_token or not location_id:
-                logger.error("GHL authentication not available, skipping GHL sync")
-            else:
-                for appt_sync in appointments_to_sync_to_ghl:
-                    # Only sync if we have ghl_contact_id
-                    if not appt_sync.ghl_contact_id:
-                        logger.warning(f"Appointment {appt_sync.id} missing ghl_contact_id, skipping GHL sync")
-                        continue
-                    
-                    try:
-                        result = create_ghl_appointment(appt_sync)
-                        
-                        if result and not result.get('error'):
-                            # Extract appointment ID from response
-                            appointment_data = result.get('appointment') or result
-                            ghl_appointment_id = appointment_data.get('id') or result.get('id')
-                            
-                            if ghl_appointment_id:
-                                appt_sync.ghl_appointment_id = ghl_appointment_id
-                                appt_sync.save(update_fields=['ghl_appointment_id'])
-                                total_synced_to_ghl += 1
-                            else:
-                                logger.warning(f"No ID in response for appointment {appt_sync.id}")
-                        else:
-                            error_msg = result.get('error', '') if isinstance(result, dict) else str(result)
-                            error_lower = error_msg.lower()
-                            # Check if it's a duplicate error
-                            if ('duplicate' in error_lower or 
-                                'already exists' in error_lower or
-                                result.get('is_duplicate', False)):
-                                # Appointment already exists in GHL - this is expected for incremental sync
-                                logger.info(f"Appointment {appt_sync.id} already exists in GHL (duplicate - skipping)")
-                            else:
-                                logger.warning(f"Error syncing appointment {appt_sync.id} to GHL: {error_msg}")
-                    except Exception as e:
-                        logger.error(f"Exception syncing appointment {appt_sync.id} to GHL: {str(e)}")
-        
-        result = {
-            'status': 'success',
-            'message': 'Appointment sync completed',
-            'total_appointments': len(appointments),
-            'created': total_created,
-            'updated': total_updated,
-            'synced_to_ghl': total_synced_to_ghl,
-            'timestamp': timezone.now().isoformat()
-        }
-        
-        logger.info(f"Appointment sync completed: {result}")
-        return result
+        except Exception as e:
+            error_msg = f"Error in incremental appointment sync: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return {
+                'status': 'error',
+                'message': error_msg,
+                'timestamp': timezone.now().isoformat()
+            }
         
-    except Exception as e:
-        error_msg = f"Error in incremental appointment sync: {str(e)}"
-        logger.error(error_msg, exc_info=True)
-        return {
-            'status': 'error',
-            'message': error_msg,
-            'timestamp': timezone.now().isoformat()
-        }
+        # The chunk tasks keep the lease alive, finish_appointment_sync releases
+        # it (release_sync_lease if a chunk fails). Replacing this task makes
+        # the callback's summary its result.
+        token = lease.hand_off()
+        release = release_sync_lease.si(self.name, location_id, token)
+        return self.replace(chord(
+            [
+                sync_appointments_chunk.s(start, end, location_id, token).on_error(release)
+                for start, end in chunks
+            ],
+            finish_appointment_sync.s(window_from, window_to, started_at.isoformat(), location_id, token)
+        ))
+
+
+@shared_task(name='sync_appointments_chunk')
+def sync_appointments_chunk(window_from, window_to, location_id=None, lease_token=None):
+    """Fetch and upsert one window chunk of a fanned-out appointment sync; returns its chunk_stats()."""
+    with continue_lease('sync_appointments_incremental', location_id, lease_token):
+        return chunk_stats(upsert_appointments(
+            iter_ephysio_appointments_sharded(window_from, window_to)
+        ))
+
+
+@shared_task(name='finish_appointment_sync')
+def finish_appointment_sync(chunk_results, window_from, window_to, started_at,
+                            location_id=None, lease_token=None):
+    """
+    Chord callback of a fanned-out appointment sync: records the watermark
+    and returns the same summary as an inline run. Not called if a chunk
+    failed, so the next run covers the window again.
+    """
+    with continue_lease('sync_appointments_incremental', location_id, lease_token, release=True):
+        return finish_appointment_sync_run(
+            sum_stats(chunk_results), window_from, window_to, parse_datetime(started_at)
+        )
+
+
+@shared_task(name='release_sync_lease')
+def release_sync_lease(task_name, location_id, lease_token):
+    """
+    Error callback of the chunk tasks of a fanned-out sync: a chunk failed,
+    so the last step that would release the run's lease never runs.
+    """
+    logger.warning(f"A chunk of {task_name} failed, releasing its lease for location {location_id}")
+    release_handed_off(task_name, location_id, lease_token)
 
 
 @shared_task(name='refresh_ghl_token_periodic')
@@ -466,14 +497,25 @@ def refresh_ghl_token_periodic():
     Periodic task to refresh GHL access token before it expires.
     
     GHL tokens expire in 24 hours. This task runs every 20 hours to ensure
-    tokens are refreshed before expiration.
+    tokens are refreshed before expiration. API calls also refresh the token
+    proactively shortly before it expires; this task is the safety net for
+    idle periods.
     
     Runs every 20 hours via Celery Beat.
     """
     logger.info("Starting GHL token refresh task...")
     
     try:
-        success, message = refresh_ghl_token()
+        # Same lock as on-demand refreshes so they never rotate the token concurrently
+        with ghl_token_manager.lock() as acquired:
+            if not acquired:
+                logger.warning("Another worker is refreshing the GHL token, skipping this run")
+                return {
+                    'status': 'skipped',
+                    'message': 'GHL token refresh already in progress',
+                    'timestamp': timezone.now().isoformat()
+                }
+            success, message = refresh_ghl_token()
         
         if success:
             result = {
@@ -500,3 +542,116 @@ def refresh_ghl_token_periodic():
             'message': error_msg,
             'timestamp': timezone.now().isoformat()
         }
+
+
+@shared_task(name='process_ghl_webhook_event', bind=True, max_retries=None)
+def process_ghl_webhook_event(self, event_id):
+    """
+    Apply a queued GHL webhook event (and any earlier ones for the same entity).
+    
+    A Redis lock per entity_key serializes processing, and pending events
+    for the entity are applied in id order up to this one. That way an update
+    never overtakes the create it depends on, even if the tasks run out of order.
+    If another worker holds the entity lock, the task retries shortly.
+    
+    An event that fails with a retryable error (see is_retryable_error())
+    stays pending, and the task retries after WEBHOOK_RETRY_DELAY seconds
+    (doubled per attempt); later events of the entity wait for it. After
+    WEBHOOK_MAX_ATTEMPTS attempts, or on a permanent error, the event is
+    marked failed (replay with manage.py replay_webhook_events).
+    """
+    event = WebhookEvent.objects.filter(id=event_id).first()
+    if not event:
+        logger.warning(f"Webhook event {event_id} not found")
+        return {'status': 'missing', 'event_id': event_id}
+    
+    lock = get_redis().lock(f"webhook-entity:{event.entity_key}", timeout=300)
+    if not lock.acquire(blocking=False):
+        raise self.retry(countdown=WEBHOOK_LOCK_RETRY_DELAY)
+    
+    processed = 0
+    retry_in = None
+    try:
+        pending_events = WebhookEvent.objects.filter(
+            entity_key=event.entity_key,
+            status='pending',
+            id__lte=event.id
+        ).order_by('id')
+        
+        # Replayed backlogs: resolve all invoices up front instead of per event
+        try:
+            prefetch_invoices(pending_events)
+        except Exception as e:
+            logger.warning(f"Invoice prefetch for {event.entity_key} failed: {str(e)}")
+        
+        for pending in pending_events:
+            try:
+                pending.result = process_webhook_event(pending)
+                pending.status = 'done'
+            except Exception as e:
+                pending.attempts += 1
+                pending.error = str(e)
+                if is_retryable_error(e) and pending.attempts < settings.WEBHOOK_MAX_ATTEMPTS:
+                    retry_in = settings.WEBHOOK_RETRY_DELAY * 2 ** (pending.attempts - 1)
+                    logger.warning(
+                        f"Webhook event {pending.id} failed (attempt {pending.attempts}), "
+                        f"retrying in {retry_in}s: {str(e)}"
+                    )
+                    pending.save(update_fields=['attempts', 'error'])
+                    # Later events of this entity must not overtake it
+                    break
+                
+                logger.error(f"Error processing webhook event {pending.id}: {str(e)}", exc_info=True)
+                pending.status = 'failed'
+            pending.processed_at = timezone.now()
+            pending.save(update_fields=['status', 'result', 'error', 'attempts', 'processed_at'])
+            processed += 1
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            logger.warning(f"Webhook lock for {event.entity_key} expired before release")
+    
+    if retry_in is not None:
+        raise self.retry(countdown=retry_in)
+    
+    return {'status': 'success', 'event_id': event_id, 'processed': processed}
+
+
+@shared_task(name='dispatch_ghl_outbox')
+@run_exclusively
+def dispatch_ghl_outbox():
+    """
+    Push the rows queued in the outbox to GHL (contacts first, then appointments).
+    
+    Started after every ingestion run and every minute via Celery Beat. One
+    dispatcher runs at a time (run_exclusively), so at most GHL_PUSH_WORKERS
+    pushes are in flight, fewer while GHL throttles. A run stops claiming new
+    batches after GHL_OUTBOX_DISPATCH_SECONDS; the next run picks up the rest.
+    """
+    try:
+        access_token, location_id = get_ghl_auth()
+        if not access_token or not location_id:
+            logger.error("GHL authentication not available, leaving the outbox for the next run")
+            return {'status': 'error', 'message': 'GHL authentication not available'}
+        
+        deadline = time.monotonic() + settings.GHL_OUTBOX_DISPATCH_SECONDS
+        result = {'status': 'success'}
+        for entity in OUTBOX_ENTITIES:
+            stats = dispatch(entity, deadline=deadline)
+            stats['remaining'] = pending_count(entity)
+            result[entity] = stats
+            if stats['claimed']:
+                logger.info(f"GHL {entity} push finished: {stats}")
+        
+        result['timestamp'] = timezone.now().isoformat()
+        return result
+    
+    except Exception as e:
+        error_msg = f"Error dispatching the GHL push outbox: {str(e)}"
+        logger.error(error_msg, exc_info=True)
+        return {
+            'status': 'error',
+            'message': error_msg,
+            'timestamp': timezone.now().isoformat()
+        }
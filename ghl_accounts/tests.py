@@ -1,3 +1,418 @@
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from django.conf import settings
 from django.test import TestCase
+from django.utils import timezone
+
+from e_physio_integration import task_lock
+from e_physio_integration.celery import app as celery_app
+from ghl_accounts import tasks
+from ghl_accounts.models import AppointmentSync, ContactSync, PushOutbox, SyncFailure, SyncState
+from ghl_accounts.services import failures, ingestion, outbox, push
+
+try:
+    import fakeredis
+except ImportError:  # optional, only needed by the fan-out tests
+    fakeredis = None
+
+
+def patient(patient_id, **fields):
+    return {'id': patient_id, 'firstName': 'Anna', 'lastName': 'Muster', 'phone': '+41791234567', **fields}
+
+
+def event(event_id, patient_id, **fields):
+    # 2026-01-05 09:00 - 09:30 UTC
+    return {'id': event_id, 'patientId': patient_id, 'start': 1767603600000, 'end': 1767605400000, **fields}
+
+
+def outbox_ids(entity):
+    return set(PushOutbox.objects.filter(entity=entity).values_list('record_id', flat=True))
+
+
+class PushContactSharedPhoneTests(TestCase):
+    """Two patients sharing a phone (e.g. family members) keep separate GHL contacts."""
+
+    def setUp(self):
+        self.owner = ContactSync.objects.create(
+            ephysio_patient_id='1', ghl_contact_id='ghl-owner',
+            first_name='Anna', phone='+41791234567'
+        )
+        self.sibling = ContactSync.objects.create(
+            ephysio_patient_id='2', first_name='Ben', phone='+41791234567'
+        )
+
+    @mock.patch.object(push, 'update_ghl_contact')
+    @mock.patch.object(push, 'create_ghl_contact', return_value={'contact': {'id': 'ghl-sibling'}})
+    def test_contact_owned_by_other_row_is_not_reused(self, create, update):
+        result = push.push_contact(self.sibling, push.build_linked_contact_index([self.sibling]))
+
+        update.assert_not_called()
+        create.assert_called_once()
+        self.assertEqual(result['status'], 'created')
+        self.assertEqual(self.sibling.ghl_contact_id, 'ghl-sibling')
+
+    @mock.patch.object(push, 'update_ghl_contact', return_value={'contact': {}})
+    @mock.patch.object(push, 'create_ghl_contact')
+    def test_unowned_contact_is_reused(self, create, update):
+        linked_index = ({'+41791234567': 'ghl-unowned'}, {})
+
+        result = push.push_contact(self.sibling, linked_index)
+
+        create.assert_not_called()
+        update.assert_called_once()
+        self.assertEqual(result['status'], 'updated')
+        self.assertEqual(self.sibling.ghl_contact_id, 'ghl-unowned')
+
+    @mock.patch.object(push, 'update_ghl_contact')
+    @mock.patch.object(push, 'create_ghl_contact', return_value={
+        'error': 'This location does not allow duplicated contacts.',
+        'status_code': 400,
+        'meta': {'contactId': 'ghl-owner'}
+    })
+    def test_duplicate_owned_by_other_row_is_skipped(self, create, update):
+        result = push.push_contact(self.sibling, ({}, {}))
+
+        update.assert_not_called()
+        self.assertEqual(result['status'], 'skipped')
+        self.assertIsNone(self.sibling.ghl_contact_id)
+
+    @mock.patch.object(push, 'update_ghl_contact', return_value={'error': 'Update failed'})
+    @mock.patch.object(push, 'create_ghl_contact', return_value={
+        'error': 'This location does not allow duplicated contacts.',
+        'status_code': 400,
+        'meta': {'contactId': 'ghl-unowned'}
+    })
+    def test_unowned_duplicate_is_linked(self, create, update):
+        result = push.push_contact(self.sibling, ({}, {}))
+
+        self.assertEqual(result['status'], 'linked')
+        self.assertEqual(self.sibling.ghl_contact_id, 'ghl-unowned')
+
+
+class UpsertContactsTests(TestCase):
+
+    def test_created_updated_unchanged(self):
+        stats = ingestion.upsert_contacts([patient(1), patient(2)])
+        self.assertEqual((stats['created'], stats['updated'], stats['unchanged']), (2, 0, 0))
+
+        stats = ingestion.upsert_contacts([patient(1), patient(2, city='Bern')])
+        self.assertEqual((stats['created'], stats['updated'], stats['unchanged']), (0, 1, 1))
+        self.assertEqual(ContactSync.objects.get(ephysio_patient_id='2').city, 'Bern')
+
+        stats = ingestion.upsert_contacts([patient(1), patient(2, city='Bern')])
+        self.assertEqual((stats['created'], stats['updated'], stats['unchanged']), (0, 0, 2))
+
+    def test_unchanged_row_is_not_rewritten(self):
+        ingestion.upsert_contacts([patient(1)])
+        ContactSync.objects.filter(ephysio_patient_id='1').update(city='edited locally')
+
+        ingestion.upsert_contacts([patient(1)])
+
+        self.assertEqual(ContactSync.objects.get(ephysio_patient_id='1').city, 'edited locally')
+
+    def test_rows_without_ghl_contact_are_queued(self):
+        stats = ingestion.upsert_contacts([patient(1), patient(2)])
+        ids = set(ContactSync.objects.values_list('id', flat=True))
+        self.assertEqual(set(stats['pending_ids']), ids)
+        self.assertEqual(outbox_ids('contact'), ids)
+
+        PushOutbox.objects.all().delete()
+        ContactSync.objects.filter(ephysio_patient_id='1').update(ghl_contact_id='ghl-1')
+        stats = ingestion.upsert_contacts([patient(1, city='Bern'), patient(2, city='Bern')])
+
+        self.assertEqual(stats['updated'], 2)
+        self.assertEqual(outbox_ids('contact'), {ContactSync.objects.get(ephysio_patient_id='2').id})
+
+    def test_outbox_and_rows_commit_together(self):
+        with mock.patch.object(ingestion, 'enqueue', side_effect=RuntimeError('outbox down')):
+            with self.assertRaises(RuntimeError):
+                ingestion.upsert_contacts([patient(1)])
+
+        self.assertFalse(ContactSync.objects.exists())
+
+    def test_oversized_values_are_truncated_and_logged(self):
+        long_phone = '+41 79 123 45 67 / +41 79 765 43 21'
+
+        with self.assertLogs('ghl_accounts.services.ingestion', 'WARNING') as logs:
+            stats = ingestion.upsert_contacts([patient(1, phone=long_phone)])
+
+        self.assertEqual(stats['created'], 1)
+        self.assertIn('phone is 35 characters long, truncated to 20', logs.output[0])
+        self.assertEqual(ContactSync.objects.get(ephysio_patient_id='1').phone, long_phone[:20])
+
+        # The fingerprint is taken of the stored (truncated) value
+        stats = ingestion.upsert_contacts([patient(1, phone=long_phone)])
+        self.assertEqual(stats['unchanged'], 1)
+
+    def test_duplicate_keys_in_one_batch(self):
+        stats = ingestion.upsert_contacts([patient(1), patient(1, city='Bern')])
+
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(ContactSync.objects.get(ephysio_patient_id='1').city, 'Bern')
+
+
+class UpsertAppointmentsTests(TestCase):
+
+    def test_linked_appointments_are_queued(self):
+        ContactSync.objects.create(ephysio_patient_id='1', ghl_contact_id='ghl-1')
+
+        stats = ingestion.upsert_appointments([event(10, 1), event(11, 2)])
+
+        self.assertEqual((stats['created'], stats['linked_to_ghl']), (2, 1))
+        linked = AppointmentSync.objects.get(ephysio_appointment_id='10')
+        self.assertEqual(linked.ghl_contact_id, 'ghl-1')
+        # Only appointments whose patient is in GHL can be pushed
+        self.assertEqual(outbox_ids('appointment'), {linked.id})
+
+    def test_created_updated_unchanged(self):
+        ingestion.upsert_appointments([event(10, 1), event(11, 1)])
+
+        stats = ingestion.upsert_appointments([event(10, 1), event(11, 1, status=2)])
+
+        self.assertEqual((stats['created'], stats['updated'], stats['unchanged']), (0, 1, 1))
+        self.assertEqual(AppointmentSync.objects.get(ephysio_appointment_id='11').status, '2')
+
+    def test_events_without_times_are_skipped(self):
+        stats = ingestion.upsert_appointments([event(10, 1, start=None)])
+
+        self.assertEqual((stats['total'], stats['created']), (1, 0))
+        self.assertFalse(AppointmentSync.objects.exists())
+
+
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.contacts = [ContactSync.objects.create(ephysio_patient_id=str(i)) for i in range(3)]
+        outbox.enqueue('contact', [c.id for c in self.contacts])
+
+    def dispatch_with(self, results):
+        """dispatch_batch with a fake push returning results[record_id] (default: created)."""
+        pushed = []
+
+        def fake_push(rows, workers=None, rate=None, on_result=None):
+            stats = {'created': 0, 'errors': 0}
+            for row in rows:
+                pushed.append(row.id)
+                result = results.get(row.id, {'status': 'created'})
+                stats['errors' if result['status'] == 'error' else result['status']] += 1
+                on_result(row, result, len(pushed))
+            return stats
+
+        entry = outbox.OUTBOX_ENTITIES['contact']
+        with mock.patch.dict(outbox.OUTBOX_ENTITIES, {'contact': entry[:3] + (fake_push,)}):
+            stats = outbox.dispatch_batch('contact', outbox.claim('contact', 10))
+        return stats, pushed
+
+    def test_enqueue_is_idempotent(self):
+        outbox.enqueue('contact', [self.contacts[0].id])
+
+        self.assertEqual(PushOutbox.objects.count(), 3)
+
+    def test_claimed_entries_are_not_claimed_again(self):
+        first = outbox.claim('contact', 2)
+        second = outbox.claim('contact', 2)
+
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({record_id for _, record_id in first} & {record_id for _, record_id in second})
+        self.assertEqual(outbox.claim('contact', 2), [])
+
+    def test_expired_claim_is_claimed_again(self):
+        claimed = outbox.claim('contact', 3)
+        PushOutbox.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(outbox.claim('contact', 3), claimed)
+
+    def test_pushed_entries_are_deleted(self):
+        stats, pushed = self.dispatch_with({})
+
+        self.assertEqual(stats['created'], 3)
+        self.assertEqual(len(pushed), 3)
+        self.assertFalse(PushOutbox.objects.exists())
+
+    def test_transient_failure_is_retried_later(self):
+        failed = self.contacts[0].id
+        stats, _ = self.dispatch_with({failed: {'status': 'error', 'error': 'timeout', 'status_code': 503}})
+
+        self.assertEqual(stats['retry_later'], 1)
+        entry = PushOutbox.objects.get()
+        self.assertEqual((entry.record_id, entry.attempts, entry.last_error), (failed, 1, 'timeout'))
+        self.assertIsNone(entry.claimed_until)
+        self.assertGreater(entry.available_at, timezone.now())
+        # In backoff: not claimable yet
+        self.assertEqual(outbox.claim('contact', 10), [])
+
+    def test_retry_delay_doubles(self):
+        failed = self.contacts[0].id
+        PushOutbox.objects.exclude(record_id=failed).delete()
+        PushOutbox.objects.update(attempts=2)
+        before = timezone.now()
+
+        with self.settings(GHL_OUTBOX_RETRY_DELAY=60):
+            self.dispatch_with({failed: {'status': 'error', 'error': 'timeout'}})
+
+        entry = PushOutbox.objects.get()
+        self.assertEqual(entry.attempts, 3)
+        self.assertGreaterEqual(entry.available_at, before + timedelta(seconds=60 * 4))
+        self.assertLess(entry.available_at, before + timedelta(seconds=60 * 5))
+
+    def test_permanent_failure_is_dropped(self):
+        failed = self.contacts[0].id
+        self.dispatch_with({failed: {'status': 'error', 'error': 'invalid phone', 'status_code': 422}})
+
+        self.assertFalse(PushOutbox.objects.exists())
+
+    def test_backed_off_and_pushed_rows_are_dropped_unpushed(self):
+        backed_off, already_pushed, pending = self.contacts
+        SyncFailure.objects.create(
+            entity='contact', record_id=backed_off.id, attempts=1,
+            next_attempt_at=timezone.now() + timedelta(hours=1), last_failed_at=timezone.now()
+        )
+        ContactSync.objects.filter(id=already_pushed.id).update(ghl_contact_id='ghl-1')
+
+        _, pushed = self.dispatch_with({})
+
+        self.assertEqual(pushed, [pending.id])
+        self.assertFalse(PushOutbox.objects.exists())
+
+
+class FailureLedgerTests(TestCase):
+
+    def setUp(self):
+        self.contact = ContactSync.objects.create(ephysio_patient_id='1', first_name='Anna')
+        self.rejected = {'status': 'error', 'error': 'invalid phone', 'status_code': 422}
+
+    def test_permanent_failures(self):
+        self.assertTrue(failures.is_permanent_failure(self.rejected))
+        self.assertTrue(failures.is_permanent_failure({'status': 'skipped'}))
+        self.assertTrue(failures.is_permanent_failure({'status': 'error', 'permanent': True}))
+        self.assertFalse(failures.is_permanent_failure({'status': 'error', 'status_code': 429}))
+        self.assertFalse(failures.is_permanent_failure({'status': 'error', 'status_code': 503}))
+        self.assertFalse(failures.is_permanent_failure({'status': 'error', 'error': 'timeout'}))
+        self.assertFalse(failures.is_permanent_failure({'status': 'created'}))
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        with self.settings(GHL_PUSH_BACKOFF_BASE=60, GHL_PUSH_BACKOFF_MAX=600):
+            delays = [failures.backoff_delay(attempts) for attempts in range(1, 7)]
+
+        self.assertEqual(delays, [60, 120, 240, 480, 600, 600])
+
+    def test_record_failures_schedules_next_attempt(self):
+        now = timezone.now()
+        with self.settings(GHL_PUSH_BACKOFF_BASE=60, GHL_PUSH_MAX_ATTEMPTS=8):
+            failures.record_failures('contact', {self.contact.id: self.rejected}, now=now)
+            failures.record_failures('contact', {self.contact.id: self.rejected}, now=now)
+
+        entry = SyncFailure.objects.get(entity='contact', record_id=self.contact.id)
+        self.assertEqual((entry.attempts, entry.last_status_code, entry.dead), (2, 422, False))
+        self.assertEqual(entry.last_error, 'invalid phone')
+        self.assertEqual(entry.next_attempt_at, now + timedelta(seconds=120))
+
+    def test_dead_letter_after_max_attempts(self):
+        with self.settings(GHL_PUSH_MAX_ATTEMPTS=3):
+            newly_dead = [
+                failures.record_failures('contact', {self.contact.id: self.rejected})
+                for _ in range(4)
+            ]
+
+        self.assertEqual(newly_dead, [0, 0, 1, 0])
+        self.assertTrue(SyncFailure.objects.get(record_id=self.contact.id).dead)
+
+    def test_exclude_backed_off(self):
+        other = ContactSync.objects.create(ephysio_patient_id='2')
+        dead = ContactSync.objects.create(ephysio_patient_id='3')
+        now = timezone.now()
+        failures.record_failures('contact', {self.contact.id: self.rejected}, now=now)
+        SyncFailure.objects.create(
+            entity='contact', record_id=dead.id, attempts=8, dead=True,
+            next_attempt_at=now - timedelta(days=1), last_failed_at=now
+        )
+
+        pushable = failures.exclude_backed_off(ContactSync.objects.all(), 'contact', now=now)
+        self.assertEqual(list(pushable), [other])
+
+        # Once the backoff is over the row is pushed again; dead letters stay out
+        later = now + timedelta(seconds=settings.GHL_PUSH_BACKOFF_BASE + 1)
+        pushable = failures.exclude_backed_off(ContactSync.objects.all(), 'contact', now=later)
+        self.assertEqual(set(pushable), {self.contact, other})
+
+    def test_ledger_entry_cleared_by_successful_push(self):
+        failures.record_failures('contact', {self.contact.id: self.rejected})
+
+        def created(contact):
+            contact.ghl_contact_id = 'ghl-1'
+            return {'status': 'created', 'write_back': True}
+
+        push._push_with_metrics(
+            'contact', [self.contact], created,
+            write_back=push.WriteBackBuffer(ContactSync, ['ghl_contact_id'])
+        )
+
+        self.assertFalse(SyncFailure.objects.exists())
+
+    def test_failed_push_is_recorded(self):
+        push._push_with_metrics('contact', [self.contact], lambda contact: self.rejected)
+
+        self.assertEqual(SyncFailure.objects.get().record_id, self.contact.id)
+
+    def test_ledger_entry_cleared_by_ephysio_change(self):
+        ingestion.upsert_contacts([patient(1)])
+        contact = ContactSync.objects.get(ephysio_patient_id='1')
+        failures.record_failures('contact', {contact.id: self.rejected})
+
+        ingestion.upsert_contacts([patient(1)])
+        self.assertTrue(SyncFailure.objects.exists())
+
+        ingestion.upsert_contacts([patient(1, phone='+41797654321')])
+        self.assertFalse(SyncFailure.objects.exists())
+
+
+@skipUnless(fakeredis, 'fakeredis is not installed')
+class PatientSyncFanOutTests(TestCase):
+    """sync_patients_incremental with its chunk tasks run inline."""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.patients = [patient(i) for i in range(1, 26)]
+        patchers = [
+            mock.patch.object(task_lock, 'get_redis', return_value=self.redis),
+            mock.patch.object(tasks, 'get_redis', return_value=self.redis),
+            mock.patch.object(tasks, 'lease_scope', return_value='location-1'),
+            mock.patch.object(tasks, 'iter_active_patients', lambda: iter(self.patients)),
+            mock.patch.object(tasks, 'start_outbox_dispatch'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        always_eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', always_eager)
+
+    def run_sync(self):
+        with self.settings(SYNC_PATIENT_CHUNK_SIZE=10):
+            return tasks.sync_patients_incremental.apply()
+
+    def test_summary_is_stored_and_lease_released(self):
+        result = self.run_sync().get()
+
+        self.assertEqual((result['total_patients'], result['created']), (25, 25))
+        self.assertEqual(SyncState.objects.get(name=tasks.PATIENT_SYNC_STATE).counters['created'], 25)
+        self.assertEqual(self.redis.keys('*'), [])
+
+    def test_failed_chunk_releases_lease(self):
+        upsert_contacts = ingestion.upsert_contacts
+        calls = []
+
+        def fail_second_chunk(patients):
+            calls.append(len(patients))
+            if len(calls) == 2:
+                raise RuntimeError('database gone')
+            return upsert_contacts(patients)
+
+        with mock.patch.object(tasks, 'upsert_contacts', fail_second_chunk):
+            self.run_sync()
 
-# Create your tests here.
+        self.assertFalse(self.redis.exists(f'{task_lock.REDIS_KEY_PREFIX}sync_patients_incremental:location-1'))
+        self.assertFalse(SyncState.objects.filter(name=tasks.PATIENT_SYNC_STATE).exists())
@@ -7,4 +7,5 @@ urlpatterns = [
     path("auth/callback/", callback, name="oauth_callback"),
     
     path("webhooks/", ghl_webhook),
+    path("metrics/", metrics_view, name="metrics"),
 ]
\ No newline at end of file
@@ -9,7 +9,7 @@ import logging
 from django.views import View
 from django.utils.decorators import method_decorator
 import traceback
-from ephysio.services.patients import sync_ghl_contact_to_ephysio
+from ghl_accounts.services.client import get_ghl_client
 
 logger = logging.getLogger(__name__)
 
@@ -55,7 +55,8 @@ def tokens(request):
         "code": authorization_code,
     }
 
-    response = requests.post(TOKEN_URL, data=data)
+    # Single attempt: an authorization code can only be exchanged once
+    response = get_ghl_client().post(TOKEN_URL, authenticated=False, data=data, max_retries=1)
 
     try:
         response_data = response.json()
@@ -75,6 +76,7 @@ def tokens(request):
 
             }
         )
+        get_ghl_client().invalidate_headers()
         return JsonResponse({
             "message": "Authentication successful",
             "access_token": response_data.get('access_token'),
@@ -90,14 +92,31 @@ def tokens(request):
         
         
 import json
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import ContactSync, AppointmentSync
+from e_physio_integration import metrics
+from .models import WebhookEvent
+from .services.push import update_backlog_gauges
+from .services.webhooks import (
+    APPOINTMENT_EVENT_TYPES,
+    CONTACT_EVENT_TYPES,
+    get_entity_key,
+)
+from .tasks import process_ghl_webhook_event
 
 
 @csrf_exempt
 def ghl_webhook(request):
+    """
+    Receive a GHL webhook, store it and hand it to Celery.
+
+    Only cheap payload validation happens here; the e-Physio calls run in
+    process_ghl_webhook_event so GHL gets a 202 within milliseconds.
+    """
     if request.method != "POST":
         return JsonResponse({"error": "Invalid request method"}, status=405)
 
@@ -115,133 +134,64 @@ def ghl_webhook(request):
     # -------------------------
     # ROUTING BY EVENT TYPE
     # -------------------------
-    if event_type in ["ContactCreate", "ContactUpdate"]:
-        return handle_contact_event(data)
+    if event_type in CONTACT_EVENT_TYPES:
+        return handle_contact_event(event_type, data)
 
-    if event_type in ["AppointmentCreate", "AppointmentUpdate"]:
-        return handle_appointment_event(data)
+    if event_type in APPOINTMENT_EVENT_TYPES:
+        return handle_appointment_event(event_type, data)
 
     print("⚠️ Unhandled GHL event:", event_type)
     return JsonResponse({"status": "ignored"})
 
 
-def handle_contact_event(data):
-    ghl_contact_id = data.get("id")
-    email = data.get("email")
-    phone = data.get("phone")
-    first_name = data.get("firstName")
-    last_name = data.get("lastName")
-
-    if not ghl_contact_id:
+def handle_contact_event(event_type, data):
+    if not data.get("id"):
         return JsonResponse({"error": "Missing contact id"}, status=400)
 
-    sync = ContactSync.objects.filter(
-        ghl_contact_id=ghl_contact_id
-    ).first()
-
-    if sync:
-        print("✅ Contact already synced")
-        sync.email = email
-        sync.phone = phone
-        sync.save()
-    else:
-        print("🆕 New contact")
-        sync = ContactSync.objects.create(
-            ghl_contact_id=ghl_contact_id,
-            email=email,
-            phone=phone,
-            source="ghl"
-        )
-
-    sync_ghl_contact_to_ephysio({
-        "ghl_contact_id": ghl_contact_id,
-        "first_name": first_name,
-        "last_name": last_name,
-        "phone": phone,
-        "email": email
-    }, sync)
-
-    return JsonResponse({"status": "contact synced"})
-
-from django.http import JsonResponse
-from django.utils.dateparse import parse_datetime
-from .models import AppointmentSync, ContactSync
-from ephysio.services.appointments import create_ephysio_appointment
+    return enqueue_webhook_event(event_type, data)
 
-def handle_appointment_event(data):
-    print("📦 RAW APPOINTMENT PAYLOAD >>>", data)
 
+def handle_appointment_event(event_type, data):
     appointment = data.get("appointment", {})
 
-    ghl_appointment_id = appointment.get("id")
-    ghl_contact_id = appointment.get("contactId")
-
-    start_time = parse_datetime(appointment.get("startTime"))
-    end_time = parse_datetime(appointment.get("endTime"))
-    status = appointment.get("appointmentStatus")
-
-    if not ghl_appointment_id or not ghl_contact_id:
+    if not appointment.get("id") or not appointment.get("contactId"):
         return JsonResponse({"error": "Missing appointment or contact ID"}, status=400)
 
-    if not start_time or not end_time:
+    if not parse_datetime(appointment.get("startTime") or "") or not parse_datetime(appointment.get("endTime") or ""):
         return JsonResponse({"error": "Invalid start/end time"}, status=400)
 
-    # find synced patient
-    contact_sync = ContactSync.objects.filter(
-        ghl_contact_id=ghl_contact_id
-    ).first()
-
-    if not contact_sync:
-        return JsonResponse({"error": "Patient not synced yet"}, status=400)
+    return enqueue_webhook_event(event_type, data)
 
-    appt_sync = AppointmentSync.objects.filter(
-        ghl_appointment_id=ghl_appointment_id
-    ).first()
 
-    if appt_sync:
-        print("🔁 Appointment already exists – skipping create")
-        return JsonResponse({"status": "already exists"})
+def enqueue_webhook_event(event_type, data):
+    event = WebhookEvent.objects.create(
+        event_type=event_type,
+        entity_key=get_entity_key(event_type, data),
+        payload=data,
+    )
+    transaction.on_commit(lambda: process_ghl_webhook_event.delay(event.id))
 
-    print("🆕 Creating appointment")
+    return JsonResponse({"status": "queued", "event_id": event.id}, status=202)
 
-    appt_sync = AppointmentSync.objects.create(
-        ghl_appointment_id=ghl_appointment_id,
-        ghl_contact_id=ghl_contact_id,
-        ephysio_patient_id=contact_sync.ephysio_patient_id,
-        start_time=start_time,
-        end_time=end_time,
-        status=status,
-        source="ghl"  # Set source as 'ghl' since it's created from GHL webhook
-    )
 
-    sync_ghl_appointment_to_ephysio_create(appt_sync)
+def metrics_view(request):
+    """
+    Expose the sync metrics of all processes in the Prometheus text format.
 
-    return JsonResponse({"status": "appointment created"})
+    Requires "Authorization: Bearer <METRICS_TOKEN>"; without METRICS_TOKEN
+    configured the endpoint is disabled.
+    """
+    if not settings.METRICS_TOKEN:
+        return JsonResponse({"error": "Metrics endpoint disabled"}, status=403)
+    if request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+        return JsonResponse({"error": "Unauthorized"}, status=401)
 
-def sync_ghl_appointment_to_ephysio_create(appt_sync):
-    print("📡 SYNC TO E-PHYSIO (CREATE)")
     try:
-        result = create_ephysio_appointment(appt_sync)
-
-        # Extract event ID from response
-        # Response structure: {"id": 42109222, "events": [], ...}
-        event_id = result.get("id")
-        
-        # Also check if ID is in events array (if present)
-        if not event_id and result.get("events"):
-            events = result.get("events", [])
-            if events and len(events) > 0:
-                event_id = events[0].get("id")
-        
-        if event_id:
-            appt_sync.ephysio_appointment_id = str(event_id)
-            appt_sync.save()
-            print(f"✅ Appointment created in e-Physio with ID: {event_id}")
-        else:
-            print("⚠️ Warning: No event ID in response from e-Physio")
-            print(f"Response: {result}")
-            
+        update_backlog_gauges()
+        metrics.flush()
+        body = metrics.render()
     except Exception as e:
-        print(f"❌ Error creating appointment in e-Physio: {str(e)}")
-        # Don't raise - allow webhook to return success even if e-Physio creation fails
-        # The appointment is already saved in our database
+        logger.error(f"Could not render metrics: {str(e)}")
+        return JsonResponse({"error": "Metrics unavailable"}, status=503)
+
+    return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")